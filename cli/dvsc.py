@@ -1,15 +1,11 @@
 import os
 import os.path
-import urllib3
 import logging
 import datetime
 import requests
 import json
 import sys
-import boto3
 import time
-import shutil
-import subprocess
 import io
 import copy
 
@@ -44,13 +40,17 @@ except ModuleNotFoundError:
 
 ################################################################
 ###
-### metadata plugins are functions that take a file descriptor and return a dictionary of name: value pairs
+### metadata plugins see each block of a file as it is hashed and return a dictionary of name: value pairs.
+### See dvs/dvs_plugins.py. Plugins in other packages are registered with 'dvs.plugins' entry points.
 ###
-# for now, just import the metata plugins
 sys.path.append(dirname(abspath(__file__)))
-from plugins.metadata_das_header import metadata_das_header as plug1
 
-plugins = [plug1]
+def load_plugins(names):
+    """Register the plugins that come with dvsc and enable names, a comma-separated list or 'all'"""
+    from plugins.metadata_das_header import DASHeaderPlugin
+    from dvs import dvs_plugins
+    dvs_plugins.register('das_header', DASHeaderPlugin)
+    dvs_plugins.enable(names)
 ################################################################
 
 
@@ -76,6 +76,16 @@ def do_commit(dc, paths):
     return dc.commit()
 
 
+def do_commit_manifest(dc, paths, manifest, threads):
+    """Register paths and the paths in a manifest file, or stdin if manifest is '-', as they are read"""
+    from itertools import chain
+    from dvs.dvs_helpers import read_manifest
+    f = sys.stdin.buffer if manifest=='-' else open(manifest, 'rb')
+    with f:
+        dc.add_manifest(dc.COMMIT_BEFORE, chain(paths, read_manifest(f)), threads=threads)
+    return dc.commit()
+
+
 def do_search(dc, paths, debug=False):
     """Ask the server to do a broad search for a string. Return the results."""
     search_list = [{SEARCH_ANY: path,
@@ -83,9 +93,19 @@ def do_search(dc, paths, debug=False):
     return dc.search(search_list)
 
 
+def do_text_search(dc, words, cursor=None):
+    """Full-text search of commit messages, authors and datasets. Prints one commit per line,
+    best match first, and the cursor for the next page."""
+    results = dc.text_search(" ".join(words), cursor=cursor)
+    for result in results:
+        print(obj2line(result))
+    if results:
+        print(f"next page: --cursor {results[-1][dvs.dvs_constants.CURSOR]}")
+
+
 def obj2line(c, hashlen=8):
     f = io.StringIO()
-    print(c['created'],c['hexhash'][0:hashlen],end='  ',file=f)
+    print(c.get('created',''),c['hexhash'][0:hashlen],end='  ',file=f)
     obj = c['object']
     if 'hostname' in obj:
         print(obj['hostname']+":",end='',file=f)
@@ -152,8 +172,8 @@ def print_graph(objs):
                 add_hash(h2)
                 links.append({'source':h2, 'target':hexhash, 'strength':1.0})
 
-        if 'object' in obj and 'before' in obj['object']:
-            for h2 in obj['object']['before']:
+        if 'object' in obj and 'after' in obj['object']:
+            for h2 in obj['object']['after']:
                 add_hash(h2)
                 links.append({'source':hexhash, 'target':h2, 'strength':0.1})
 
@@ -162,6 +182,32 @@ def print_graph(objs):
     print( json.dumps(ret, indent=4, default=str))
 
 
+def do_lineage(dc, hexhash, *, direction, depth, graph=False):
+    """Print the lineage of hexhash as it is streamed from the server,
+    either one object per line indented by depth, or as a graph."""
+    from dvs.dvs_constants import NODE, LINK, DEPTH, PARENT, CHILD, ROLE, COMMIT_AFTER
+    nodes = {}
+    links = []
+    for record in dc.lineage(hexhash, direction=direction, depth=depth):
+        if NODE in record:
+            node = record[NODE]
+            if graph:
+                nodes[node[HEXHASH]] = {'id':node[HEXHASH]}
+            elif isinstance(node[OBJECT], dict):
+                print("  "*node[DEPTH] + obj2line(node))
+            else:
+                print("  "*node[DEPTH] + node[HEXHASH] + "  " + str(node[OBJECT]))
+        elif LINK in record and graph:
+            # Links go in the direction that data flows: inputs to commits, and commits to outputs
+            link = record[LINK]
+            if link[ROLE]==COMMIT_AFTER:
+                links.append({'source':link[PARENT], 'target':link[CHILD], 'strength':0.1})
+            else:
+                links.append({'source':link[CHILD], 'target':link[PARENT], 'strength':0.1 if link[ROLE]==BEFORE else 1.0})
+    if graph:
+        print( json.dumps({'nodes':list(nodes.values()), 'links':links}, indent=4, default=str))
+
+
 def print_last(objs):
     for obj in objs:
         print(obj2line(obj, shortest_prefix_for_objects(objs)))
@@ -217,18 +263,12 @@ def do_dumpobj(dc, hexhash, debug):
 
 
 def do_cp(dc, src_path, dst_path):
-    """Implement a file copy, with the fact of the copy recorded in the DVS"""
+    """Implement a file copy, with the fact of the copy recorded in the DVS.
+    The source is read once: it is hashed as it is copied, and the destination is verified by its size and ETag."""
+    from dvs.dvs_copy import copy_with_hashes
 
     dc.add_git_commit(src=__file__)
-    use_s3 = False
-    if src_path.startswith("s3://"):
-        use_s3  = True
-        dc.add_s3_paths_or_prefixes(dc.COMMIT_BEFORE, [src_path])
-    else:
-        dc.add_local_paths(dc.COMMIT_BEFORE, [src_path])
-
     if dst_path.startswith("s3://"):
-        use_s3  = True
         if dst_path.endswith("/"):
             dst_path += os.path.basename(src_path)
     else:
@@ -237,18 +277,42 @@ def do_cp(dc, src_path, dst_path):
         if os.path.exists(dst_path):
             raise FileExistsError(dst_path)
 
-    if use_s3:
-        cmd = ['aws','s3','cp',src_path,dst_path]
-        print(" ".join(cmd))
-        subprocess.check_call(cmd)
-    else:
-        shutil.copyfile(src_path,dst_path)
+    (src_obs, dst_obs) = copy_with_hashes(src_path, dst_path, acl=dc.ACL)
+    dc.add(dc.COMMIT_BEFORE, obj=src_obs)
+    dc.add(dc.COMMIT_AFTER, obj=dst_obs)
+    return dc.commit()
 
-    if dst_path.startswith("s3://"):
-        dc.add_s3_paths_or_prefixes(dc.COMMIT_AFTER, [dst_path])
+
+def do_verify(dc, paths, *, commit=None, threads=dvs.dvs_constants.DEFAULT_THREADS, full=False):
+    """Check that paths, or the files in a commit, still match what was recorded. Prints one line for each
+    file that is not OK and a summary. Returns True if every file is OK."""
+    from dvs import dvs_verify
+    if commit:
+        recorded = dvs_verify.recorded_for_commit(dc, commit)
     else:
-        dc.add_local_paths(dc.COMMIT_AFTER, [dst_path])
-    return dc.commit()
+        recorded = dvs_verify.recorded_for_paths(dc, paths)
+    (results, stats) = dvs_verify.verify(recorded, paths=paths, threads=threads, full=full)
+    for (path, status, reason) in results:
+        if status != dvs_verify.VERIFY_OK:
+            print(f"{status:8} {path} {reason}".rstrip())
+    seconds = max(stats['seconds'], 0.001)
+    print(f"{len(results):,} files: {stats[dvs_verify.VERIFY_OK]:,} OK, {stats[dvs_verify.VERIFY_CHANGED]:,} changed, "
+          f"{stats[dvs_verify.VERIFY_MISSING]:,} missing, {stats[dvs_verify.VERIFY_UNKNOWN]:,} unknown, "
+          f"{stats[dvs_verify.VERIFY_ERROR]:,} unreadable")
+    print(f"{stats['hashed']:,} files hashed, {stats['bytes']/1e6:,.1f} MB in {seconds:.2f}s "
+          f"({len(results)/seconds:,.0f} files/s, {stats['bytes']/1e6/seconds:,.1f} MB/s)")
+    return len(results) == stats[dvs_verify.VERIFY_OK]
+
+
+def do_diff(dc, hexhash, roots, threads=dvs.dvs_constants.DEFAULT_THREADS):
+    """Print the files under each root that were added (A), removed (D) or modified (M) since the commit hexhash,
+    and those that could not be read (E)"""
+    from dvs.dvs_diff import diff_tree, DIFF_ADDED, DIFF_REMOVED, DIFF_MODIFIED, DIFF_ERROR
+    for root in roots:
+        diff = diff_tree(dc, hexhash, root, threads=threads)
+        for (code, key) in (('A', DIFF_ADDED), ('D', DIFF_REMOVED), ('M', DIFF_MODIFIED), ('E', DIFF_ERROR)):
+            for path in diff[key]:
+                print(code, path)
 
 
 if __name__ == "__main__":
@@ -265,7 +329,7 @@ if __name__ == "__main__":
     group.add_argument("--search",   "-s", help="Search for information about the path", action='store_true')
     group.add_argument("--register", "-r", help="Register a file or path. ", action='store_true')
     group.add_argument("--commit",   "-c", help="Commit. Synonym for register", action='store_true')
-    group.add_argument("--dumpdb",         help="Dump database. Optional arguments are LIMIT and OFFSET", action='store_true')
+    group.add_argument("--dumpdb",         help="Dump database, one JSON object per line. Optional arguments are LIMIT and OFFSET", action='store_true')
     group.add_argument("--dumpobj",         help="Dump a single object that is uniquely specified.")
 
     group.add_argument("--cp",
@@ -273,8 +337,35 @@ if __name__ == "__main__":
                        action='store_true')
 
     group.add_argument("--last", type=int, help="print last N commits, one per line")
-
-    parser.add_argument("--graph", help="If --last, render in graph format", action='store_true')
+    group.add_argument("--where-used", action='store_true', help="print the commits that use each hexhash given as a path")
+    group.add_argument("--lineage", help="print the objects that a hexhash was produced from (or, with --descendants, produced)")
+    group.add_argument("--verify", action='store_true',
+                       help="check that each path, or with --verify-commit the files in a commit, matches its recorded size, mtime and hashes")
+    group.add_argument("--diff", metavar='HEXHASH',
+                       help="print the files under each path that were added, removed or modified since the commit HEXHASH produced them")
+    group.add_argument("--push", action='store_true', help=f"copy the commits in the local store (${dvs.dvs_constants.DVS_LOCAL_STORE_ENV}) to the server")
+
+    parser.add_argument("--graph", help="If --last or --lineage, render in graph format", action='store_true')
+    parser.add_argument("--depth", type=int, help="If --lineage, the number of links to follow")
+    parser.add_argument("--descendants", action='store_true', help="If --lineage, follow the lineage forward rather than back")
+    parser.add_argument("--kind", choices=sorted(dvs.dvs_constants.KINDS), help="If --dumpdb, only dump objects of this kind")
+    parser.add_argument("--since", help="If --dumpdb, only dump objects created at or after this time ('YYYY-MM-DD HH:MM:SS')")
+    parser.add_argument("--until", help="If --dumpdb, only dump objects created before this time ('YYYY-MM-DD HH:MM:SS')")
+    parser.add_argument("--cursor", help="If --dumpdb, continue after this objectid. If --search --text, continue after this result")
+    parser.add_argument("--text", action='store_true', help="If --search, do a full-text search of commit messages, authors and datasets")
+    parser.add_argument("--oldest-first", action='store_true', help="If --dumpdb, dump the oldest objects first")
+    parser.add_argument("--from-manifest", metavar='FILE',
+                        help="If --register or --commit, also register the paths in FILE ('-' for stdin), "
+                        "separated by NULs (find -print0) or newlines")
+    parser.add_argument("--threads", type=int, default=dvs.dvs_constants.DEFAULT_THREADS,
+                        help="If --from-manifest, --verify or --diff, the number of files hashed at once")
+    parser.add_argument("--plugins", default=os.environ.get(dvs.dvs_constants.DVS_PLUGINS_ENV, ''),
+                        help="Comma-separated metadata plugins to run on each file as it is hashed, or 'all'. "
+                        "Default is none; plugins add metadata to the observations, which changes their hexhashes")
+    parser.add_argument("--no-cache", action='store_true',
+                        help=f"Do not use or update the client cache of search results (${dvs.dvs_constants.DVS_CLIENT_CACHE_ENV})")
+    parser.add_argument("--verify-commit", metavar='HEXHASH', help="If --verify, check the files in this commit and its child commits")
+    parser.add_argument("--full", action='store_true', help="If --verify, hash every file, even if its size and mtime match")
 
     if ctools is not None:
         ctools.clogging.add_argument(parser,loglevel_default='WARNING')
@@ -284,6 +375,8 @@ if __name__ == "__main__":
     if ctools is not None:
         ctools.clogging.setup(args.loglevel)
 
+    load_plugins(args.plugins)
+
     if args.garfi303:
         set_debug_endpoints("~garfi303adm/html")
 
@@ -293,7 +386,11 @@ if __name__ == "__main__":
         urllib3.disable_warnings()
         verify = False
 
-    dc = dvs.DVS(verify=verify)
+    client_cache = False
+    if not args.no_cache:
+        from dvs.dvs_cache import DEFAULT_CLIENT_CACHE
+        client_cache = os.environ.get(dvs.dvs_constants.DVS_CLIENT_CACHE_ENV) or DEFAULT_CLIENT_CACHE
+    dc = dvs.DVS(verify=verify, client_cache=client_cache)
 
     if args.message:
         dc.set_message(args.message)
@@ -301,25 +398,49 @@ if __name__ == "__main__":
     if args.dataset:
         dc.set_dataset(args.dataset)
 
-    if args.search:
+    if args.search and args.text:
+        do_text_search(dc, args.path, cursor=args.cursor)
+    elif args.search:
         for search_result in do_search(dc, args.path, debug=args.debug):
             render_search_result(search_result)
     elif args.register or args.commit:
         if args.git:
             dc.add_git_commit( src=args.path[0])
-        json_print( 'COMMIT', do_commit(dc, args.path))
+        if args.from_manifest:
+            json_print( 'COMMIT', do_commit_manifest(dc, args.path, args.from_manifest, args.threads))
+        else:
+            json_print( 'COMMIT', do_commit(dc, args.path))
     elif args.dumpdb:
         limit  = int(args.path[0]) if len(args.path)>0 else None
         offset = int(args.path[1]) if len(args.path)>1 else None
-        json_print( 'DUMP', dc.dump_objects(limit=limit, offset=offset))
+        if offset and (args.kind or args.since or args.until or args.cursor or args.oldest_first):
+            parser.error("--dumpdb with an OFFSET cannot be combined with --kind, --since, --until, --cursor or --oldest-first")
+        for obj in dc.dump_objects(limit=limit, offset=offset, kind=args.kind,
+                                   cursor=int(args.cursor) if args.cursor else None,
+                                   since=args.since, until=args.until,
+                                   order=dvs.dvs_constants.ORDER_ASC if args.oldest_first else None):
+            print(json.dumps(obj, default=str, sort_keys=True))
     elif args.dumpobj:
         do_dumpobj(dc, args.dumpobj, debug=args.debug)
     elif args.last:
-        objs = dc.dump_objects(limit=args.last, offset=0)
+        objs = list(dc.dump_objects(limit=args.last))
         if args.graph:
             print_graph( objs )
         else:
             print_last( objs )
+    elif args.lineage:
+        do_lineage(dc, args.lineage, depth=args.depth, graph=args.graph,
+                   direction=(dvs.dvs_constants.LINEAGE_DESCENDANTS if args.descendants else dvs.dvs_constants.LINEAGE_ANCESTORS))
+    elif args.where_used:
+        for link in dc.where_used(args.path):
+            print(link[dvs.dvs_constants.CHILD], link[dvs.dvs_constants.ROLE], link[dvs.dvs_constants.PARENT])
+    elif args.verify:
+        if not do_verify(dc, args.path, commit=args.verify_commit, threads=args.threads, full=args.full):
+            exit(1)
+    elif args.diff:
+        do_diff(dc, args.diff, args.path or ['.'], threads=args.threads)
+    elif args.push:
+        print(f"{dc.push():,} objects sent to the server")
     elif args.cp:
         if len(args.path)!=2:
             print("--cp requires 2 arguments",file=sys.stderr)
@@ -2,6 +2,13 @@
 
 """
 dvs plugin reads an input file and returns a dictionary of metadata
+
+The DAS header is the lines at the start of a file that begin with '#'. DASHeaderParser is given the
+file a block at a time, keeps a line that is split across blocks until the rest of it arrives, and
+stops at the first line that does not begin with '#' or after MAXREAD bytes, so the size of the file
+does not matter. Lines that are not UTF-8 are decoded with replacement characters.
+The SHA1 of the whole header is computed by the header_digests plugin in dvs.dvs_plugins, which has
+the same definition of the header; enable it along with this plugin to store it.
 """
 
 import sys
@@ -12,24 +19,87 @@ MAXREAD = 65536
 
 def process_header(ret, line):
     assert line[0]=='#'
-    if 'Git Repo Info' in line:
+    if 'Git Repo Info' in line and ':' in line:
         (header,data) = line.split(':',1)
         header=header.replace('# ','').replace(' Info','')+' '
         for commit in data.split('|'):
             words = commit.split()
-            if words[1]=='commit':
+            if len(words)>=3 and words[1]=='commit':
                 ret[header+words[0]] = words[2]
 
 
-def metadata_das_header(buf):
-    ret = {}
-    inheader = True
-    lines = buf.decode('utf-8').split("\n")
-    for line in lines:
-        if inheader:
-            if line[0]!='#':
-                inheader = False
-            else:
-                process_header(ret, line)
-                continue
-    return ret
+class DASHeaderParser:
+    """Incremental parser of the DAS header.
+    :param max_bytes: the most bytes of the file to examine.
+    """
+    def __init__(self, max_bytes=MAXREAD):
+        self.max_bytes = max_bytes
+        self.count     = 0          # bytes examined
+        self.partial   = b''        # the start of a header line whose end has not been seen
+        self.done      = False      # the header ended, or max_bytes were examined
+        self.finished  = False
+        self.metadata  = {}
+
+    def add_line(self, line):
+        process_header(self.metadata, line.rstrip(b'\r\n').decode('utf-8', errors='replace'))
+
+    def feed(self, block):
+        """Parse the next block of the file. Returns False once no more blocks are needed."""
+        if self.done:
+            return False
+        block       = block[0:self.max_bytes - self.count]
+        self.count += len(block)
+        data        = self.partial + block
+        start       = 0
+        while True:
+            if start < len(data) and data[start:start+1] != b'#':
+                self.done = True
+                break
+            nl = data.find(b'\n', start)
+            if nl < 0:
+                break
+            self.add_line(data[start:nl+1])
+            start = nl+1
+        self.partial = b'' if self.done else data[start:]
+        if self.count >= self.max_bytes:
+            self.done = True
+        return not self.done
+
+    def result(self):
+        """Return the metadata. If the file ended in the header, its last line is parsed even without a newline."""
+        if not self.finished:
+            self.finished = True
+            if not self.done and self.partial:
+                self.add_line(self.partial)
+            self.partial = b''
+            self.done    = True
+        return dict(self.metadata)
+
+
+def metadata_das_header(buf, max_bytes=MAXREAD):
+    """Return the metadata in the DAS header at the start of buf, examining no more than max_bytes of it"""
+    parser = DASHeaderParser(max_bytes)
+    parser.feed(buf)
+    return parser.result()
+
+
+def metadata_das_header_file(f, max_bytes=MAXREAD, block_size=4096):
+    """Return the metadata in the DAS header of the binary file f, reading only as much of f as is needed"""
+    parser = DASHeaderParser(max_bytes)
+    while True:
+        block = f.read(block_size)
+        if not block or not parser.feed(block):
+            break
+    return parser.result()
+
+
+class DASHeaderPlugin:
+    """dvs_plugins plugin that parses the DAS header while the file is hashed, and stops when the header ends"""
+    def __init__(self):
+        self.parser = DASHeaderParser()
+
+    def update(self, block):
+        return self.parser.feed(block)
+
+    def result(self):
+        return self.parser.result()
@@ -2,6 +2,7 @@ import sys
 import os
 import os.path
 import warnings
+import hashlib
 
 #from os.path import basename,dirname,abspath
 
@@ -16,3 +17,50 @@ def test_metadata_das_header():
         buf = f.read(65536)
         obj = metadata_das_header(buf)
         assert obj['US Git Repo python_dvs']=='e7b2a6d3502216543b48be5570110f087792725f'
+
+def test_das_header_plugin():
+    with open( DATAFILE, "rb") as f:
+        data = f.read()
+    header_len = data.index(b"\n1|") + 1
+    for block_size in (1, 7, 100, 65536):
+        plugin = DASHeaderPlugin()
+        for i in range(0, len(data), block_size):
+            if plugin.update(data[i:i+block_size]) is False:
+                break
+        # The plugin stops in the block with the first line that is not part of the header
+        assert plugin.parser.count <= header_len + block_size
+        obj = plugin.result()
+        assert obj['US Git Repo python_dvs']=='e7b2a6d3502216543b48be5570110f087792725f'
+
+def test_das_header_with_header_digests():
+    """The header digest comes from the header_digests plugin, which agrees with the DAS header's extent"""
+    from dvs.dvs_plugins import PluginPipeline,HeaderDigestsPlugin
+    with open( DATAFILE, "rb") as f:
+        data = f.read()
+    header_len = data.index(b"\n1|") + 1
+    pipeline   = PluginPipeline({'das_header':DASHeaderPlugin, 'header_digests':HeaderDigestsPlugin})
+    for i in range(0, len(data), 100):
+        pipeline.update(data[i:i+100])
+    obj = pipeline.result()
+    assert obj['US Git Repo python_dvs']=='e7b2a6d3502216543b48be5570110f087792725f'
+    assert obj['header_bytes']==header_len
+    assert obj['header_sha1']==hashlib.sha1(data[0:header_len]).hexdigest()
+    assert not [key for key in obj if key.startswith('das_header')]
+
+def test_metadata_das_header_edge_cases():
+    # An empty line ends the header, and lines that are not UTF-8 do not stop it
+    assert metadata_das_header(b"") == {}
+    assert metadata_das_header(b"\n# US Git Repo Info:dvs commit abc\n") == {}
+    obj = metadata_das_header(b"# \xff\xfe\n# US Git Repo Info:dvs commit abc|bad\n\n# PR Git Repo Info:dvs commit def\n")
+    assert obj['US Git Repo dvs']=='abc' and 'PR Git Repo dvs' not in obj
+    # A header without a final newline is parsed to its end
+    assert metadata_das_header(b"# US Git Repo Info:dvs commit abc")['US Git Repo dvs']=='abc'
+    # No more than max_bytes are examined
+    assert metadata_das_header(b"# comment\n" * 100 + b"# US Git Repo Info:dvs commit abc\n", max_bytes=500) == {}
+
+def test_metadata_das_header_file():
+    import io
+    data = b"# US Git Repo Info:dvs commit abc\n" + b"x" * 1000000
+    f    = io.BytesIO(data)
+    assert metadata_das_header_file(f)['US Git Repo dvs']=='abc'
+    assert f.tell() <= 4096
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+"""
+dvs backfill_links:
+Populate dvs_links from the before/method/after lists of the commits already in dvs_objects.
+Commits are read oldest first with the keyset-paginated dump, so the backfill can be stopped and
+restarted with --cursor set to the last objectid it printed. When it reaches the newest commit, it
+records that dvs_links is complete in dvs_state; daemon/gc_ephemeral.py will not delete objects until then.
+Entries of legacy commits that are not hexhashes cannot be linked; they are skipped and reported.
+
+ctools and dvs must be in the path
+
+"""
+
+import os
+import sys
+import time
+import logging
+
+from os.path import dirname, abspath, basename, realpath
+
+POSSIBLE_DAS_DECENNIAL=dirname(dirname(dirname(dirname(realpath(__file__)))))
+if basename(POSSIBLE_DAS_DECENNIAL)=='das_decennial':
+    sys.path.append(os.path.join(POSSIBLE_DAS_DECENNIAL,'das_framework'))
+    sys.path.append(os.path.join(POSSIBLE_DAS_DECENNIAL,'programs/python_dvs'))
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+import ctools
+import ctools.clogging
+from ctools import dbfile
+import dvs.server
+
+from dvs.dvs_constants import KIND_COMMIT, ORDER_ASC, OBJECTID, HEXHASH, OBJECT
+from dvs.dvs_helpers import is_hexhash
+
+COMMITS_PER_BATCH = 1000
+
+
+def linkable(hexhash, commit):
+    """Return the before, method and after lists of commit with only their hexhashes, and the number of entries left out"""
+    ret     = {}
+    skipped = []
+    for role in dvs.server.LINK_ROLES:
+        entries   = commit.get(role, []) if isinstance(commit,dict) else []
+        entries   = entries if isinstance(entries,list) else [entries]
+        ret[role] = [entry for entry in entries if is_hexhash(entry)]
+        skipped  += [entry for entry in entries if not is_hexhash(entry)]
+    if skipped:
+        logging.warning("%s: skipped %d %s entries that are not hexhashes, e.g. %r",
+                        hexhash, len(skipped), "/".join(dvs.server.LINK_ROLES), skipped[0])
+    return (ret, len(skipped))
+
+
+def backfill_links(auth, *, cursor=None, batch_size=COMMITS_PER_BATCH):
+    """Store the links for every commit after cursor. Returns the number of commits processed."""
+    count   = 0
+    skipped = 0
+    t0      = time.time()
+    commits = {}
+    for row in dvs.server.iter_dump_objects(auth, kind=KIND_COMMIT, order=ORDER_ASC, cursor=cursor):
+        (commits[row[HEXHASH]], n) = linkable(row[HEXHASH], row[OBJECT])
+        skipped += n
+        cursor = row[OBJECTID]
+        if len(commits) >= batch_size:
+            dvs.server.store_links(auth, commits)
+            count += len(commits)
+            commits = {}
+            print(f"{count:,} commits ({count/(time.time()-t0):,.0f}/sec) cursor={cursor}", file=sys.stderr)
+    dvs.server.store_links(auth, commits)
+    count += len(commits)
+    dvs.server.set_state(auth, dvs.server.STATE_LINKS_BACKFILLED, time.strftime("%Y-%m-%d %H:%M:%S"))
+    print(f"{count:,} commits done. {skipped:,} entries that are not hexhashes skipped. cursor={cursor}", file=sys.stderr)
+    return count
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--env", default=os.path.join(os.getenv('HOME','.'),'dbwriter.bash'),
+                        help="bash file with the MYSQL_ variables for a database writer")
+    parser.add_argument("--cursor", type=int, help="only backfill commits with an objectid greater than this")
+    parser.add_argument("--batch", type=int, default=COMMITS_PER_BATCH, help="commits per batch")
+    if ctools is not None:
+        ctools.clogging.add_argument(parser,loglevel_default='WARNING')
+    args = parser.parse_args()
+    ctools.clogging.setup(args.loglevel)
+    auth = dbfile.DBMySQLAuth.FromEnv(args.env)
+    backfill_links(auth, cursor=args.cursor, batch_size=args.batch)
@@ -5,6 +5,30 @@ dvs batch:
 Read objects specified by the batch location and load them into the database directly.
 Supports offline operation.
 
+When DVS_OBJECT_CACHE is set, DVS.commit() writes each commit to the object cache as a blob named
+by its hexhash instead of sending it to the server. The blob is {'source':'dvs', 'data':data}, where data
+has the JSON of the commit's objects and of the commit, and the hexhash is that of the canonical JSON
+of data. This program loads those blobs into the v2 store:
+
+- The cache is listed in partitions, concurrently, and the blobs are fetched concurrently. Blobs named
+  by their hexhash alone are partitioned by its first hex digit; blobs named by date and time are
+  partitioned by date. Each partition has its own position in the checkpoint.
+- Each blob's hexhash and each object's hexhash is verified. Blobs that fail are reported and skipped.
+- A commit that was made offline refers to its child commits by their blob hexhashes. Blobs are stored
+  in dependency order, children before parents, and a blob that refers to objects that are neither
+  stored nor in the cache is retried later.
+- Each blob is stored as a URL object under its hexhash, with its objects and its commit;
+  the blob and the commit both get the commit's links.
+- Progress is kept in a checkpoint file, so a restart continues where the last run stopped.
+- Commits that were written in packs (see dvs_spool.py) are found by their index, and each commit in
+  the pack is loaded as a blob. Its URL is that of the index, with the hexhash as the fragment.
+
+With --follow, the program runs continuously. Blobs are named by the date and time they were written
+(see dvs_helpers.object_cache_key), so each poll lists only the date partitions since a persisted
+high-water mark, starting a lag window before it to catch blobs that were written late. A local cache
+directory is only listed when its modification time changes. The poll interval backs off when there
+is nothing new and when there are errors.
+
 ctools and dvs must be in the path
 
 """
@@ -15,9 +39,15 @@ import random
 import json
 import warnings
 import time
+import logging
+import hashlib
+import re
 import boto3
+import pymysql
+from botocore.exceptions import BotoCoreError,ClientError
 
 from os.path import dirname, abspath, basename, realpath
+from concurrent.futures import ThreadPoolExecutor
 
 
 MAX_OBJECT_SIZE = 4*1024*1024
@@ -28,40 +58,427 @@ if basename(POSSIBLE_DAS_DECENNIAL)=='das_decennial':
     sys.path.append(os.path.join(POSSIBLE_DAS_DECENNIAL,'programs/python_dvs'))
 
 sys.path.append(os.path.join(dirname(dirname(dirname(dirname( realpath(__file__))))),'bin'))
+sys.path.append(dirname(dirname(abspath(__file__))))
 
 import ctools
 import ctools.clogging
+from ctools import dbfile
 import dvs
+import dvs.server
 
+from dvs.dvs_constants import *
 from dvs.observations import get_bucket_key
-from dvs.dvs_helpers import is_hexadecimal
+from dvs.dvs_helpers import is_hexadecimal,canonical_json,canonical_json_hexhash,hexhash_string
+from dvs.dvs_helpers import object_cache_hexhash,object_cache_key_time
+from dvs.dvs_spool import PACK_SUFFIX,INDEX_SUFFIX
+
+HEX_DIGITS     = "0123456789abcdef"
+KEYS_PER_ROUND = 1000           # keys listed from each partition in each round
+FETCH_THREADS  = 32
+DEFAULT_CHECKPOINT = os.path.join(os.getenv('HOME','.'), '.dvs_batch_checkpoint.json')
+DEFAULT_POLL   = 2              # seconds between polls in --follow mode
+MAX_POLL       = 60             # seconds; the poll interval backs off to this when nothing is new
+DEFAULT_LAG    = 300            # seconds; blobs may appear this long after the time in their names
+DATE_DIR       = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+def is_blob_key(key):
+    """True if key names a blob or the index of a pack of blobs"""
+    return key.endswith(INDEX_SUFFIX) or is_hexadecimal(object_cache_hexhash(key))
+
+def dates_between(start, end):
+    """Return the UTC dates, as YYYY-MM-DD, from time_t start to time_t end"""
+    dates = []
+    day   = start - start % 86400
+    while day <= end:
+        dates.append(time.strftime("%Y-%m-%d", time.gmtime(day)))
+        day += 86400
+    return dates
+
+
+def key_partition(key):
+    """Return the partition of a key relative to the cache: its date directory, or the first hex digit of its name"""
+    (date, name) = os.path.split(key)
+    return date if DATE_DIR.match(date) else name[0:1]
+
+
+class S3Source:
+    """Blobs in an S3 prefix. Undated blobs are listed in 16 partitions by the first hex digit of their
+    names, and dated blobs in a partition for each date."""
+    def __init__(self, path):
+        self.name = path
+        (self.bucket, prefix) = get_bucket_key(path)
+        self.prefix = prefix.rstrip('/') + '/' if prefix else ''
+        self.client = boto3.client('s3')
+
+    def dates(self):
+        """The date directories under the prefix"""
+        return [cp['Prefix'][len(self.prefix):].rstrip('/')
+                for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix, Delimiter='/')
+                for cp in page.get('CommonPrefixes',[])
+                if DATE_DIR.match(cp['Prefix'][len(self.prefix):].rstrip('/'))]
+
+    def partitions(self):
+        return list(HEX_DIGITS) + self.dates()
+
+    def partition(self, key):
+        return key_partition(key[len(self.prefix):])
+
+    def list(self, partition, after, limit):
+        """Return up to limit (key, size) pairs in partition that come after the key after, in order.
+        The delimiter keeps the date directories out of the hex partitions."""
+        prefix = self.prefix + (partition + '/' if DATE_DIR.match(partition) else partition)
+        args = {'Bucket':self.bucket, 'Prefix':prefix, 'Delimiter':'/', 'PaginationConfig':{'MaxItems':limit}}
+        if after:
+            args['StartAfter'] = after
+        return [(obj['Key'], obj['Size'])
+                for page in self.client.get_paginator('list_objects_v2').paginate(**args)
+                for obj in page.get('Contents',[])
+                if is_blob_key(obj['Key'])]
+
+    def list_dated(self, date, after=None):
+        """Return the (key, size) pairs in the date partition with names after the time after (HHMMSS)"""
+        args = {'Bucket':self.bucket, 'Prefix':self.prefix + date + '/'}
+        if after:
+            args['StartAfter'] = self.prefix + date + '/' + after
+        return [(obj['Key'], obj['Size'])
+                for page in self.client.get_paginator('list_objects_v2').paginate(**args)
+                for obj in page.get('Contents',[])
+                if is_blob_key(obj['Key'])]
+
+    def mark_listed(self):
+        pass
+
+    def fetch(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def url(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+
+class LocalSource:
+    """Blobs in a local directory and its date subdirectories. Keys are paths relative to the directory."""
+    def __init__(self, path):
+        self.name    = os.path.abspath(path)
+        self.mtimes  = {}       # date -> mtime of the date directory when it was last listed and ingested
+        self.pending = {}       # date -> mtime of the date directory when it was listed, until mark_listed()
+
+    def partitions(self):
+        """The undated blobs in the directory are one partition, and each date directory is another"""
+        return [''] + sorted([subdir for subdir in os.listdir(self.name) if DATE_DIR.match(subdir)])
+
+    def partition(self, key):
+        date = key_partition(key)
+        return date if DATE_DIR.match(date) else ''
+
+    def names(self, subdir=''):
+        return [os.path.join(subdir, entry.name) for entry in os.scandir(os.path.join(self.name, subdir))
+                if entry.is_file() and is_blob_key(entry.name)]
+
+    def list(self, partition, after, limit):
+        names = sorted([name for name in self.names(partition) if after is None or name > after])[:limit]
+        return [(name, os.path.getsize(os.path.join(self.name, name))) for name in names]
+
+    def list_dated(self, date, after=None):
+        """Return the (key, size) pairs in the date directory with names after the time after (HHMMSS).
+        Returns nothing if the directory has not changed since the last listing that was marked with mark_listed()."""
+        path = os.path.join(self.name, date)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return []
+        if self.mtimes.get(date)==mtime:
+            return []
+        self.pending[date] = mtime
+        names = sorted([name for name in self.names(date) if after is None or basename(name) > after])
+        return [(name, os.path.getsize(os.path.join(self.name, name))) for name in names]
 
+    def mark_listed(self):
+        """Record that the blobs of the last listings were ingested, so unchanged directories are not listed again"""
+        self.mtimes.update(self.pending)
+        self.pending = {}
 
-def process_s3object(s3object):
-    if s3object.size > MAX_OBJECT_SIZE:
-        return
-    obj = json.loads(s3object.get()['Body'].read())
-    print(obj)
+    def fetch(self, key):
+        with open(os.path.join(self.name, key), 'rb') as f:
+            return f.read()
 
+    def url(self, key):
+        return 'file://' + os.path.join(self.name, key)
 
 
-def process_s3path(path):
-    (bucket_name,prefix) = get_bucket_key(path)
-    for s3object in boto3.resource('s3').Bucket(bucket_name).objects.page_size(100).filter(Prefix=prefix):
-        if is_hexadecimal( basename( s3object.key)):
-            process_s3object(s3object)
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
+def save_checkpoint(path, checkpoint):
+    """Write the checkpoint atomically, so that a crash leaves either the old or the new checkpoint"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f, indent=4, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Blob:
+    """A commit read from the object cache.
+    :param key: the key of the blob, or of the index of the pack that has it.
+    :param body: the blob, {'source':'dvs', 'data':data}, or for a blob in a pack, the canonical JSON of data.
+    :param hexhash: for a blob in a pack, its hexhash.
+    """
+    def __init__(self, key, body, hexhash=None):
+        self.key     = key
+        self.packed  = hexhash is not None
+        self.hexhash = hexhash if self.packed else object_cache_hexhash(key)
+        try:
+            doc = json.loads(body)
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+            raise ValueError("not valid JSON")
+        if self.packed:
+            data = doc
+            if hashlib.sha1(body).hexdigest() != self.hexhash:
+                raise ValueError("contents do not match the hexhash")
+        else:
+            data = doc.get('data') if isinstance(doc,dict) else None
+        if not isinstance(data,dict) or API_OBJECTS not in data or API_COMMIT not in data:
+            raise ValueError("not a DVS object cache blob")
+        if not self.packed and hexhash_string(canonical_json(data)) != self.hexhash:
+            raise ValueError("contents do not match the hexhash")
+        self.objects = json.loads(data[API_OBJECTS])
+        self.commit  = json.loads(data[API_COMMIT])
+        if not isinstance(self.objects,dict):
+            raise ValueError("objects is not a dictionary")
+        error = dvs.server.validate_commit(self.commit)
+        if error:
+            raise ValueError(error)
+
+    def refs(self):
+        """The hexhashes in the commit's before, method and after lists"""
+        return set([hexhash for role in dvs.server.LINK_ROLES for hexhash in self.commit.get(role,[])])
+
+    def url(self, source):
+        return source.url(self.key) + (f"#{self.hexhash}" if self.packed else "")
+
+
+def fetch_pack(source, key):
+    """Returns [(key, Blob or None, reason)] for the blobs in the pack whose index is key"""
+    try:
+        index = json.loads(source.fetch(key))
+        pack  = source.fetch(key[0:-len(INDEX_SUFFIX)] + PACK_SUFFIX)
+    except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+        return [(key, None, "index is not valid JSON")]
+    results = []
+    for (hexhash, (offset, length)) in index.get('blobs',{}).items():
+        if length > MAX_OBJECT_SIZE:
+            results.append((key, None, f"{hexhash} larger than {MAX_OBJECT_SIZE} bytes"))
+            continue
+        try:
+            results.append((key, Blob(key, pack[offset:offset+length], hexhash), None))
+        except ValueError as e:
+            results.append((key, None, f"{hexhash}: {e}"))
+    return results
+
+
+def fetch_blob(source, key, size):
+    """Returns [(key, Blob or None, reason)], with one entry for each blob in a pack"""
+    if key.endswith(INDEX_SUFFIX):
+        return fetch_pack(source, key)
+    if size > MAX_OBJECT_SIZE:
+        return [(key, None, f"larger than {MAX_OBJECT_SIZE} bytes")]
+    try:
+        return [(key, Blob(key, source.fetch(key)), None)]
+    except ValueError as e:
+        return [(key, None, str(e))]
+
+
+def dependency_levels(blobs):
+    """Group blobs into levels, so that each blob's commit only refers to blobs in earlier levels.
+    :param blobs: {hexhash:Blob}
+    :return: list of lists of hexhashes
+    """
+    refs      = {hexhash:blob.refs() & set(blobs) for (hexhash, blob) in blobs.items()}
+    levels    = []
+    done      = set()
+    remaining = set(blobs)
+    while remaining:
+        level = sorted([hexhash for hexhash in remaining if refs[hexhash] <= done])
+        if not level:
+            raise RuntimeError(f"circular references among {len(remaining)} blobs")
+        levels.append(level)
+        done.update(level)
+        remaining.difference_update(level)
+    return levels
+
+
+def store_blobs(auth, source, blobs, texts):
+    """Store the blobs' objects and commits, a URL object for each blob, and their links"""
+    objects = {}
+    links   = {}
+    for blob in blobs:
+        commit_hexhash = canonical_json_hexhash(blob.commit)
+        objects.update(blob.objects)
+        objects[commit_hexhash] = blob.commit
+        objects[blob.hexhash]   = blob.url(source)
+        links[commit_hexhash]   = blob.commit
+        links[blob.hexhash]     = blob.commit
+    dvs.server.store_objects(auth, objects, texts)
+    dvs.server.store_links(auth, links)
+
+
+def ingest_keys(auth, source, keys, pool, stats):
+    """Fetch, verify and store the blobs for a list of (key, size). Returns the keys to retry later."""
+    blobs = {}
+    for (key, blob, reason) in [result for results in pool.map(lambda ks: fetch_blob(source, *ks), keys)
+                                for result in results]:
+        if blob is None:
+            logging.warning("%s: %s", key, reason)
+            stats['rejected'] += 1
+        else:
+            blobs[blob.hexhash] = blob
+
+    # Verify every object in every blob. A blob with an invalid object is rejected.
+    (objects, texts, errors) = dvs.server.validate_objects([item for blob in blobs.values() for item in blob.objects.items()])
+    for (hexhash, blob) in list(blobs.items()):
+        invalid = set(blob.objects) & set(errors)
+        if invalid:
+            logging.warning("%s: %d invalid objects, e.g. %s", blob.key, len(invalid), errors[sorted(invalid)[0]])
+            stats['rejected'] += 1
+            del blobs[hexhash]
+
+    # References to objects outside of this run must already be stored
+    outside = set().union(*[blob.refs() - set(blob.objects) - set(blobs) for blob in blobs.values()])
+    stored  = dvs.server.existing_hexhashes(auth, outside) if outside else set()
+
+    # A pack is retried as a whole. The blobs in it that were stored are stored again, which does nothing.
+    retry = []
+    for level in dependency_levels(blobs):
+        ready = []
+        for hexhash in level:
+            blob    = blobs[hexhash]
+            missing = blob.refs() - set(blob.objects) - stored
+            if missing:
+                logging.info("%s: waiting for %d objects, e.g. %s", blob.key, len(missing), sorted(missing)[0])
+                if blob.key not in retry:
+                    retry.append(blob.key)
+            else:
+                ready.append(blob)
+        if ready:
+            store_blobs(auth, source, ready, texts)
+            stored.update([blob.hexhash for blob in ready])
+            stats['stored'] += len(ready)
+    stats['deferred'] = len(retry)
+    return retry
+
+
+def ingest(auth, source, *, checkpoint_path=DEFAULT_CHECKPOINT, keys_per_round=KEYS_PER_ROUND, threads=FETCH_THREADS):
+    checkpoint = load_checkpoint(checkpoint_path)
+    state      = checkpoint.setdefault(source.name, {'after':{}, 'retry':[]})
+    stats      = {'stored':0, 'rejected':0, 'deferred':0}
+    partitions = source.partitions()
+    t0         = time.time()
+    # Checkpoints from before dated and undated blobs were listed separately may have a position in
+    # the wrong kind of partition. Those partitions are listed again from the start.
+    state['after'] = {p:after for (p, after) in state['after'].items() if source.partition(after)==p}
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            listed = dict(zip(partitions,
+                              pool.map(lambda p: source.list(p, state['after'].get(p), keys_per_round), partitions)))
+            keys   = [ks for p in partitions for ks in listed[p]]
+            retry  = state['retry']
+            if not keys:
+                break
+            # Blobs that were waiting for their children are tried again with each round
+            retry_keys     = set(retry) - set([key for (key, size) in keys])
+            state['retry'] = ingest_keys(auth, source, keys + [(key, 0) for key in sorted(retry_keys)], pool, stats)
+            for p in partitions:
+                if listed[p]:
+                    state['after'][p] = listed[p][-1][0]
+            save_checkpoint(checkpoint_path, checkpoint)
+            print(f"{stats['stored']:,} stored {stats['rejected']:,} rejected {stats['deferred']:,} waiting "
+                  f"({stats['stored']/(time.time()-t0):,.0f}/sec)", file=sys.stderr)
+
+        # Try the blobs that are waiting once more, now that everything has been listed
+        if state['retry']:
+            state['retry'] = ingest_keys(auth, source, [(key, 0) for key in state['retry']], pool, stats)
+            save_checkpoint(checkpoint_path, checkpoint)
+    print(f"done. {stats['stored']:,} stored {stats['rejected']:,} rejected {len(state['retry']):,} waiting",
+          file=sys.stderr)
+    return stats
+
+
+def follow(auth, source, *, checkpoint_path=DEFAULT_CHECKPOINT, poll=DEFAULT_POLL, max_poll=MAX_POLL,
+           lag=DEFAULT_LAG, threads=FETCH_THREADS):
+    """Ingest new blobs as they are written, forever.
+    The checkpoint keeps the high-water mark (the time of the newest blob seen) and the keys seen in
+    the lag window before it, which are listed again by every poll."""
+    checkpoint = load_checkpoint(checkpoint_path)
+    state      = checkpoint.setdefault(source.name, {'after':{}, 'retry':[]})
+    tail       = state.setdefault('follow', {'hwm':None, 'seen':[]})
+    stats      = {'stored':0, 'rejected':0, 'deferred':0}
+    interval   = poll
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        while True:
+            try:
+                now   = time.time()
+                hwm   = tail['hwm'] if tail['hwm'] is not None else now
+                start = hwm - lag
+                dates = dates_between(start, now)
+                # Only the first date partition starts part way through
+                keys  = source.list_dated(dates[0], time.strftime("%H%M%S", time.gmtime(start)))
+                for date in dates[1:]:
+                    keys += source.list_dated(date)
+                seen  = set(tail['seen'])
+                new   = [(key, size) for (key, size) in keys if key not in seen]
+                if new or state['retry']:
+                    retry_keys     = set(state['retry']) - set([key for (key, size) in new])
+                    state['retry'] = ingest_keys(auth, source, new + [(key, 0) for key in sorted(retry_keys)], pool, stats)
+                times = [object_cache_key_time(key) for (key, size) in new]
+                tail['hwm']  = max([hwm] + [t for t in times if t is not None])
+                tail['seen'] = sorted([key for key in seen.union([key for (key, size) in new])
+                                       if (object_cache_key_time(key) or 0) >= tail['hwm'] - lag])
+                save_checkpoint(checkpoint_path, checkpoint)
+                source.mark_listed()
+                if new:
+                    print(f"{stats['stored']:,} stored {stats['rejected']:,} rejected {len(state['retry']):,} waiting",
+                          file=sys.stderr)
+                    interval = poll
+                else:
+                    interval = min(interval*2, max_poll)
+            except (OSError, BotoCoreError, ClientError, pymysql.err.MySQLError) as e:
+                # Keep following through S3 and database errors, backing off while they last
+                logging.warning("poll failed: %s", e)
+                interval = min(interval*2, max_poll)
+            time.sleep(interval)
 
 
 if __name__ == "__main__":
     from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
-    parser.add_argument("path", nargs='*', help="One or more files or directories to process")
+    parser.add_argument("path", nargs='*', help="One or more object cache locations (s3:// prefixes or directories). "
+                        f"Default is ${DVS_OBJECT_CACHE_ENV}")
+    parser.add_argument("--env", default=os.path.join(os.getenv('HOME','.'),'dbwriter.bash'),
+                        help="bash file with the MYSQL_ variables for a database writer")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT, help="checkpoint file")
+    parser.add_argument("--threads", type=int, default=FETCH_THREADS, help="threads for listing and fetching")
+    parser.add_argument("--keys", type=int, default=KEYS_PER_ROUND, help="keys listed from each partition per round")
+    parser.add_argument("--follow", action='store_true', help="run continuously, ingesting new blobs as they are written")
+    parser.add_argument("--poll", type=float, default=DEFAULT_POLL, help="with --follow, seconds between polls")
+    parser.add_argument("--max-poll", type=float, default=MAX_POLL, help="with --follow, longest interval between polls")
+    parser.add_argument("--lag", type=float, default=DEFAULT_LAG,
+                        help="with --follow, seconds that a blob may appear after the time in its name")
     if ctools is not None:
         ctools.clogging.add_argument(parser,loglevel_default='WARNING')
     args = parser.parse_args()
-    for path in args.path:
-        if path.startswith('s3://'):
-            process_s3path(path)
-        else:
-            process_path(path)
+    ctools.clogging.setup(args.loglevel)
+    auth = dbfile.DBMySQLAuth.FromEnv(args.env)
+    paths = args.path or [os.environ[DVS_OBJECT_CACHE_ENV]]
+    sources = [S3Source(path) if path.startswith('s3://') else LocalSource(path) for path in paths]
+    if args.follow:
+        if len(sources)!=1:
+            parser.error("--follow requires a single location")
+        follow(auth, sources[0], checkpoint_path=args.checkpoint, poll=args.poll, max_poll=args.max_poll,
+               lag=args.lag, threads=args.threads)
+    for source in sources:
+        ingest(auth, source, checkpoint_path=args.checkpoint, keys_per_round=args.keys, threads=args.threads)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+dvs compress_objects:
+Compress the objects that were stored before the server was run with DVS_COMPRESS_OBJECTS.
+Commits are not compressed, nor are objects with names that are not interned; run
+intern_names.py first. Objects are read oldest first with the keyset-paginated dump, so the
+migration can be stopped and restarted with --cursor set to the last objectid it printed.
+
+With --train, first train a zstd dictionary on a sample of the stored objects and store it in
+dvs_zdicts; it is then used for the objects compressed by this run and by the server.
+zstd requires the zstandard module.
+
+ctools and dvs must be in the path
+
+"""
+
+import os
+import sys
+import time
+
+from os.path import dirname, abspath, basename, realpath
+
+POSSIBLE_DAS_DECENNIAL=dirname(dirname(dirname(dirname(realpath(__file__)))))
+if basename(POSSIBLE_DAS_DECENNIAL)=='das_decennial':
+    sys.path.append(os.path.join(POSSIBLE_DAS_DECENNIAL,'das_framework'))
+    sys.path.append(os.path.join(POSSIBLE_DAS_DECENNIAL,'programs/python_dvs'))
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+import ctools
+import ctools.clogging
+from ctools import dbfile
+import dvs.server
+import dvs.dvs_compress
+
+from dvs.dvs_constants import ORDER_ASC, ORDER_DESC, KIND_FILE, OBJECTID, HEXHASH, OBJECT
+from dvs.dvs_helpers import canonical_json
+
+OBJECTS_PER_BATCH = 1000
+TRAINING_SAMPLES  = 10000
+
+
+def train(auth, *, samples=TRAINING_SAMPLES):
+    """Train a zstd dictionary on the newest file observations and store it. Returns its zdictid."""
+    texts = [canonical_json(row[OBJECT])
+             for row in dvs.server.iter_dump_objects(auth, kind=KIND_FILE, order=ORDER_DESC, limit=samples)
+             if dvs.server.compressible(row[OBJECT])]
+    zdict   = dvs.dvs_compress.train_dictionary(texts)
+    zdictid = dvs.server.store_zdict(auth, zdict)
+    print(f"trained a {len(zdict):,} byte dictionary on {len(texts):,} objects: zdictid={zdictid}", file=sys.stderr)
+    return zdictid
+
+
+def compress_objects(auth, zformat, *, cursor=None, batch_size=OBJECTS_PER_BATCH):
+    """Compress every object after cursor. Returns the number of objects compressed."""
+    count      = 0
+    compressed = 0
+    t0         = time.time()
+    objects    = {}
+    for row in dvs.server.iter_dump_objects(auth, order=ORDER_ASC, cursor=cursor):
+        if isinstance(row[OBJECT], dict):
+            objects[row[HEXHASH]] = row[OBJECT]
+        count += 1
+        cursor = row[OBJECTID]
+        if len(objects) >= batch_size:
+            compressed += dvs.server.compress_stored_objects(auth, objects, zformat)
+            objects = {}
+            print(f"{count:,} objects ({count/(time.time()-t0):,.0f}/sec) {compressed:,} compressed cursor={cursor}",
+                  file=sys.stderr)
+    compressed += dvs.server.compress_stored_objects(auth, objects, zformat)
+    print(f"{count:,} objects done. {compressed:,} compressed cursor={cursor}", file=sys.stderr)
+    return compressed
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--env", default=os.path.join(os.getenv('HOME','.'),'dbwriter.bash'),
+                        help="bash file with the MYSQL_ variables for a database writer")
+    parser.add_argument("--format", choices=sorted(dvs.dvs_compress.ZFORMATS), default='zstd' if dvs.dvs_compress.have_zstd() else 'zlib',
+                        help="compression format")
+    parser.add_argument("--train", action='store_true', help="train a new zstd dictionary before compressing")
+    parser.add_argument("--samples", type=int, default=TRAINING_SAMPLES, help="objects to train the dictionary on")
+    parser.add_argument("--cursor", type=int, help="only compress objects with an objectid greater than this")
+    parser.add_argument("--batch", type=int, default=OBJECTS_PER_BATCH, help="objects per batch")
+    if ctools is not None:
+        ctools.clogging.add_argument(parser,loglevel_default='WARNING')
+    args = parser.parse_args()
+    ctools.clogging.setup(args.loglevel)
+    auth = dbfile.DBMySQLAuth.FromEnv(args.env)
+    zformat = dvs.dvs_compress.ZFORMATS[args.format]
+    if args.train:
+        if zformat!=dvs.dvs_compress.ZFORMAT_ZSTD:
+            parser.error("--train requires --format zstd")
+        train(auth, samples=args.samples)
+    compress_objects(auth, zformat, cursor=args.cursor, batch_size=args.batch)
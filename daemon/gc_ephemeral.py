@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+dvs gc_ephemeral:
+Garbage collector for objects stored with ATTRIBUTE_EPHEMERAL.
+
+An ephemeral object is deleted once it is older than the retention period and no stored commit
+uses it (see dvs.server.gc_candidates). Deleting an ephemeral commit releases its objects, so each
+pass collects one more level of a tree of ephemeral commits; an object used by a commit that is not
+ephemeral is never deleted. dvs_links must be complete before this is run: use daemon/backfill_links.py,
+which records in dvs_state that it finished. Objects are not deleted until it has.
+
+Objects are deleted in small batches, with a pause between them, so the collector can run continuously
+(--loop) without holding long locks. The default is a dry run that reports what would be deleted;
+--delete deletes.
+
+ctools and dvs must be in the path
+
+"""
+
+import os
+import sys
+import time
+
+from os.path import dirname, abspath, basename, realpath
+
+POSSIBLE_DAS_DECENNIAL=dirname(dirname(dirname(dirname(realpath(__file__)))))
+if basename(POSSIBLE_DAS_DECENNIAL)=='das_decennial':
+    sys.path.append(os.path.join(POSSIBLE_DAS_DECENNIAL,'das_framework'))
+    sys.path.append(os.path.join(POSSIBLE_DAS_DECENNIAL,'programs/python_dvs'))
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+import ctools
+import ctools.clogging
+from ctools import dbfile
+import dvs.server
+
+from dvs.dvs_constants import OBJECTID, HEXHASH
+
+DEFAULT_RETENTION_DAYS = 30
+DEFAULT_PAUSE          = 0.5    # seconds between batches
+DEFAULT_LOOP_PAUSE     = 600    # seconds between passes with --loop
+
+
+def gc_pass(auth, *, retention_days=DEFAULT_RETENTION_DAYS, batch_size=dvs.server.GC_BATCH_SIZE,
+            pause=DEFAULT_PAUSE, dry_run=True, limit=None):
+    """Make one pass over dvs_objects. Returns (objects, bytes) deleted, or that would be deleted if dry_run."""
+    if not dry_run and dvs.server.get_state(auth, dvs.server.STATE_LINKS_BACKFILLED) is None:
+        raise RuntimeError("dvs_links has not been backfilled; run daemon/backfill_links.py first")
+    older_than = time.time() - retention_days*24*60*60
+    cursor     = None
+    count      = 0
+    nbytes     = 0
+    t0         = time.time()
+    while limit is None or count < limit:
+        batch = dvs.server.gc_candidates(auth, older_than=older_than, cursor=cursor,
+                                         limit=batch_size if limit is None else min(batch_size, limit-count))
+        if not batch:
+            break
+        cursor = batch[-1][OBJECTID]
+        if dry_run:
+            for row in batch:
+                print(f"would delete {row[HEXHASH]} objectid={row[OBJECTID]} bytes={row['bytes']}")
+            deleted = batch
+        else:
+            hexhashes = set(dvs.server.delete_objects(auth, batch))
+            deleted   = [row for row in batch if row[HEXHASH] in hexhashes]
+        count  += len(deleted)
+        nbytes += sum(row['bytes'] for row in deleted)
+        print(f"{count:,} objects {nbytes:,} bytes ({count/(time.time()-t0):,.0f}/sec) cursor={cursor}", file=sys.stderr)
+        if not dry_run:
+            time.sleep(pause)
+    print(f"{'dry run: would delete' if dry_run else 'deleted'} {count:,} objects {nbytes:,} bytes", file=sys.stderr)
+    if dry_run:
+        print("ephemeral objects used by the commits above will be found by later passes", file=sys.stderr)
+    return (count, nbytes)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--env", default=os.path.join(os.getenv('HOME','.'),'dbwriter.bash'),
+                        help="bash file with the MYSQL_ variables for a database writer")
+    parser.add_argument("--days", type=float, default=DEFAULT_RETENTION_DAYS,
+                        help="keep ephemeral objects for this many days")
+    parser.add_argument("--delete", action='store_true', help="delete the objects. Default is a dry run")
+    parser.add_argument("--batch", type=int, default=dvs.server.GC_BATCH_SIZE, help="objects per batch")
+    parser.add_argument("--pause", type=float, default=DEFAULT_PAUSE, help="seconds to pause between batches")
+    parser.add_argument("--limit", type=int, help="stop after this many objects in each pass")
+    parser.add_argument("--loop", action='store_true', help="run passes continuously")
+    parser.add_argument("--loop-pause", type=float, default=DEFAULT_LOOP_PAUSE,
+                        help="with --loop, seconds to pause after a pass that deletes nothing")
+    if ctools is not None:
+        ctools.clogging.add_argument(parser,loglevel_default='WARNING')
+    args = parser.parse_args()
+    ctools.clogging.setup(args.loglevel)
+    auth = dbfile.DBMySQLAuth.FromEnv(args.env)
+    while True:
+        (count, nbytes) = gc_pass(auth, retention_days=args.days, batch_size=args.batch, pause=args.pause,
+                                  dry_run=not args.delete, limit=args.limit)
+        if not args.loop or not args.delete:
+            break
+        if count==0:
+            time.sleep(args.loop_pause)
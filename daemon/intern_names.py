@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""
+dvs intern_names:
+Intern the hostnames, dirnames, filenames, users and groups of the objects that were stored
+before the server interned them (see INTERNED_FIELDS in dvs/server.py). Each name is moved out of
+the object's JSON into a lookup table, and the object row gets the name's id.
+Objects whose names are all interned are no longer flagged with names_in_json, so name searches
+stop looking in their JSON.
+Objects are read oldest first with the keyset-paginated dump, so the migration can be stopped and
+restarted with --cursor set to the last objectid it printed. Interning an object twice does no harm.
+
+ctools and dvs must be in the path
+
+"""
+
+import os
+import sys
+import time
+
+from os.path import dirname, abspath, basename, realpath
+
+POSSIBLE_DAS_DECENNIAL=dirname(dirname(dirname(dirname(realpath(__file__)))))
+if basename(POSSIBLE_DAS_DECENNIAL)=='das_decennial':
+    sys.path.append(os.path.join(POSSIBLE_DAS_DECENNIAL,'das_framework'))
+    sys.path.append(os.path.join(POSSIBLE_DAS_DECENNIAL,'programs/python_dvs'))
+
+sys.path.append(dirname(dirname(abspath(__file__))))
+
+import ctools
+import ctools.clogging
+from ctools import dbfile
+import dvs.server
+
+from dvs.dvs_constants import ORDER_ASC, OBJECTID, HEXHASH, OBJECT
+
+OBJECTS_PER_BATCH = 1000
+
+
+def intern_names(auth, *, cursor=None, batch_size=OBJECTS_PER_BATCH):
+    """Intern the names of every object after cursor. Returns the number of objects updated."""
+    count   = 0
+    updated = 0
+    t0      = time.time()
+    objects = {}
+    for row in dvs.server.iter_dump_objects(auth, order=ORDER_ASC, cursor=cursor):
+        if isinstance(row[OBJECT], dict):
+            objects[row[HEXHASH]] = row[OBJECT]
+        count += 1
+        cursor = row[OBJECTID]
+        if len(objects) >= batch_size:
+            updated += dvs.server.intern_stored_objects(auth, objects)
+            objects = {}
+            print(f"{count:,} objects ({count/(time.time()-t0):,.0f}/sec) {updated:,} updated cursor={cursor}", file=sys.stderr)
+    updated += dvs.server.intern_stored_objects(auth, objects)
+    print(f"{count:,} objects done. {updated:,} updated cursor={cursor}", file=sys.stderr)
+    return updated
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--env", default=os.path.join(os.getenv('HOME','.'),'dbwriter.bash'),
+                        help="bash file with the MYSQL_ variables for a database writer")
+    parser.add_argument("--cursor", type=int, help="only intern objects with an objectid greater than this")
+    parser.add_argument("--batch", type=int, default=OBJECTS_PER_BATCH, help="objects per batch")
+    if ctools is not None:
+        ctools.clogging.add_argument(parser,loglevel_default='WARNING')
+    args = parser.parse_args()
+    ctools.clogging.setup(args.loglevel)
+    auth = dbfile.DBMySQLAuth.FromEnv(args.env)
+    intern_names(auth, cursor=args.cursor, batch_size=args.batch)
@@ -3,14 +3,9 @@ import warnings
 import logging
 import json
 import requests
-import subprocess
 import os
-import inspect
 import sys
 import socket
-import boto3
-from urllib.parse import urlparse
-from hashlib import sha1
 
 
 r"""
@@ -41,10 +36,23 @@ TODO:
 """
 
 from .dvs_constants import *
-from .dvs_helpers   import objects_dict,canonical_json,dvs_debug_obj_str
+from .dvs_helpers   import objects_dict,canonical_json,dvs_debug_obj_str,is_hexadecimal
+from .dvs_spool     import pack_writer
+from .dvs_local     import LocalStore,PUSH_BATCH_SIZE
 from .observations  import get_s3objs_observations, get_file_observations, get_bucket_key, requests_retry_session
+from .observations  import get_path_observation
 from .exceptions    import *
 
+# Submodules that are slow to import, such as the server, which imports ctools and the database
+# drivers, are imported the first time they are used, so that "import dvs" stays fast (PEP 562).
+LAZY_SUBMODULES = ('server', 'dvs_metrics', 'dvs_cache', 'dvs_compress')
+
+def __getattr__(name):
+    if name in LAZY_SUBMODULES:
+        import importlib
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 # This should be simplified to be a single API_ENDPOINT which handles v1/search v1/commit and v1/dump
 # And perhaps storage endpoint where files can just be dumped. The files are text files of JSON objects, one per line, in the format:
 # hexhash,<<JSON_OBJECT>>\n
@@ -59,6 +67,14 @@ API_V1 = {SEARCH: "/v1/search",
           COMMIT: "/v1/commit",
           DUMP  : "/v1/dump" }
 
+API_V2 = {DUMP  : "/v2/dump",
+          LINKS : "/v2/links",
+          LINEAGE : "/v2/lineage",
+          EXISTS : "/v2/exists",
+          STORE : "/v2/store" }
+
+DUMP_PAGE_SIZE = 10000          # objects requested per v2 dump request
+
 class DVS_Singleton:
     """The Python singleton pattern. There are many singleton objects,
     but they all reference the same embedded object,
@@ -73,8 +89,13 @@ class DVS_Singleton:
 
 class DVS():
     def __init__(self, base=None, api_endpoint=None, verify=DEFAULT_VERIFY,
-                 debug=False, ACL=None, timeout=DEFAULT_TIMEOUT, options=dict()):
-        """Start a DVS transaction"""
+                 debug=False, ACL=None, timeout=DEFAULT_TIMEOUT, options=dict(), local_store=None, client_cache=None):
+        """Start a DVS transaction.
+        :param local_store: directory of a LocalStore to commit to and search instead of the server.
+                            Default is $DVS_LOCAL_STORE.
+        :param client_cache: path of a dvs_cache.ClientCache for search results, a ClientCache, or False for none.
+                            Default is $DVS_CLIENT_CACHE, and no cache if it is not set.
+        """
         self.the_commit    = base if base is not None else {}
         self.file_obj_dict = {} # where the file objects will end up
         self.api_endpoint  = api_endpoint if api_endpoint is not None else API_ENDPOINT
@@ -91,6 +112,17 @@ class DVS():
         if ACL is None and DVS_AWS_S3_ACL_ENV in os.environ:
             self.ACL = os.environ[DVS_AWS_S3_ACL_ENV]
         self.children      = [] # stores tuples of (which, DVS) objects.
+        self.committed     = [] # stores tuples of (which, hexhash) of child commits that are already committed.
+        local_store        = local_store or os.environ.get(DVS_LOCAL_STORE_ENV)
+        self.local_store   = LocalStore(local_store) if isinstance(local_store, str) else local_store
+        self.client_cache  = None
+        if client_cache is None and os.environ.get(DVS_CLIENT_CACHE_ENV):
+            client_cache   = os.environ[DVS_CLIENT_CACHE_ENV]
+        if isinstance(client_cache, str):
+            from .dvs_cache import ClientCache
+            self.client_cache = ClientCache(client_cache)
+        elif client_cache:
+            self.client_cache = client_cache
 
 
     def set_attribute(self, attrib, value='true'):
@@ -155,7 +187,9 @@ class DVS():
         """
 
         logging.debug('=== add_git_commit ===')
+        import subprocess
         if auto:
+            import inspect
             src = inspect.stack()[1].filename
 
         if commit is None and src is None:
@@ -224,6 +258,7 @@ class DVS():
         Add a path or prefix from S3. If it is a prefix, add all of the s3 objects underneath.
         Internally, we get the boto3.resource.factory.s3.Object and put those in the array.
         """
+        import boto3
         assert which in [COMMIT_BEFORE, COMMIT_METHOD, COMMIT_AFTER]
         s3objs = []
         for s3pop in s3pops:
@@ -262,6 +297,105 @@ class DVS():
             self.add( which, obj=obj)
 
 
+    def new_child(self):
+        """Return a DVS for a child commit, which goes to the same place as this one and has its attributes"""
+        child = DVS(api_endpoint=self.api_endpoint, verify=self.verify, ACL=self.ACL, timeout=self.timeout,
+                    options=dict(self.options), local_store=self.local_store)
+        for attrib in ATTRIBUTES:
+            if attrib in self.the_commit:
+                child.set_attribute( attrib, self.the_commit[attrib] )
+        return child
+
+    def add_manifest(self, which, paths, *, threads=DEFAULT_THREADS, progress=sys.stderr, progress_seconds=5):
+        """Add a stream of local and s3:// paths, such as those read with dvs_helpers.read_manifest.
+        The paths are stat'ed and hashed on threads, and each MAX_OBJECTS_LIST of them is committed as a child
+        commit as soon as it is hashed, so memory does not grow with the number of paths. When there are more
+        than MAX_OBJECTS_LIST child commits, they are grouped into commits of their own, as commit() does.
+        Paths that cannot be read are logged and skipped. Directories, which find lists along with their files,
+        are skipped silently.
+        :param progress: where to print progress and throughput, or None.
+        Returns {'files':, 'bytes':, 'skipped':, 'commits':}.
+        """
+        assert which in [COMMIT_BEFORE, COMMIT_METHOD, COMMIT_AFTER]
+        from concurrent.futures import ThreadPoolExecutor
+        from itertools import islice
+        stats  = {'files':0, 'bytes':0, 'skipped':0, 'commits':0}
+        DIRECTORY = object()
+        levels = [[]]           # levels[n] has the hexhashes of uncommitted commits at depth n from the files
+        t0     = time.time()
+        last   = t0
+
+        def observe(path):
+            try:
+                return get_path_observation(path)
+            except IsADirectoryError:
+                return DIRECTORY
+            except (OSError, ValueError) as e:
+                logging.warning("%s: %s", path, e)
+                return None
+
+        def commit_group(level, hexhashes):
+            group = self.new_child()
+            group.committed = [(which, hexhash) for hexhash in hexhashes]
+            add_commit(level+1, group.commit())
+
+        def add_commit(level, child_commit):
+            stats['commits'] += 1
+            if len(levels) <= level:
+                levels.append([])
+            levels[level].extend(child_commit.keys())
+            if len(levels[level]) >= MAX_OBJECTS_LIST:
+                (hexhashes, levels[level]) = (levels[level], [])
+                commit_group(level, hexhashes)
+
+        def commit_batch(futures):
+            nonlocal last
+            child = self.new_child()
+            for future in futures:
+                obj = future.result()
+                if obj is DIRECTORY:
+                    continue
+                if obj is None:
+                    stats['skipped'] += 1
+                    continue
+                child.add(which, obj=obj)
+                stats['files'] += 1
+                stats['bytes'] += obj.get(FILE_METADATA,{}).get(ST_SIZE,0)
+            if child.file_obj_dict:
+                add_commit(0, child.commit())
+            if progress is not None and time.time() - last >= progress_seconds:
+                last    = time.time()
+                elapsed = last - t0
+                print(f"{stats['files']:,} files {stats['bytes']:,} bytes {stats['skipped']:,} skipped "
+                      f"({stats['files']/elapsed:,.0f} files/sec, {stats['bytes']/elapsed/1e6:,.1f} MB/sec)", file=progress)
+
+        paths = iter(paths)
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            # Each batch is hashed while the one before it is committed
+            previous = None
+            while True:
+                batch = list(islice(paths, MAX_OBJECTS_LIST))
+                futures = [pool.submit(observe, path) for path in batch]
+                if previous:
+                    commit_batch(previous)
+                if not batch:
+                    break
+                previous = futures
+
+        # Group what is left at each level into the level above it, so that no commit has more than MAX_OBJECTS_LIST
+        level = 0
+        while level < len(levels)-1:
+            if levels[level]:
+                (hexhashes, levels[level]) = (levels[level], [])
+                commit_group(level, hexhashes)
+            level += 1
+        self.committed.extend([(which, hexhash) for hexhash in levels[-1]])
+        if progress is not None:
+            elapsed = max(time.time() - t0, 0.001)
+            print(f"done. {stats['files']:,} files {stats['bytes']:,} bytes {stats['skipped']:,} skipped "
+                  f"in {elapsed:,.1f} seconds ({stats['files']/elapsed:,.0f} files/sec)", file=progress)
+        return stats
+
     def add_child(self, which, child):
         logging.debug('add(%s,%s)', which, child)
         assert which in [COMMIT_BEFORE, COMMIT_METHOD, COMMIT_AFTER]
@@ -274,6 +408,8 @@ class DVS():
         self.file_objec_dict - A dictionary with optional COMMIT_BEFORE, COMMIT_METHOD, and COMMIT_AFTER objects,
                      which will be seralized and stored as part of the transaction.
         :returns : a dictionary of {hexhash:commit_dict}, either generated by the server or as stored in S3.
+        With DVS_OBJECT_CACHE, the commit is only spooled when this returns; it is stored when the spool is
+        uploaded, which dvs_spool.flush_all() forces (see dvs_spool).
         """
 
         # Scan the objects being commited
@@ -316,7 +452,7 @@ class DVS():
             self.the_commit[which] = list(objects.keys())
             all_objects   = {**all_objects, **objects}
 
-        if len(all_objects)==0 and len(self.children)==0:
+        if len(all_objects)==0 and len(self.children)==0 and len(self.committed)==0:
             raise DVSCommitError("Will not commit with no BEFORE, METHOD, or AFTER objects")
 
         ### DEBUG CODE START
@@ -334,27 +470,30 @@ class DVS():
             for attrib in ATTRIBUTES:
                 if attrib in self.the_commit:
                     child.set_attribute( attrib, self.the_commit[attrib] )
+            child.local_store = self.local_store
 
             child_commit = child.commit()
             if which not in self.the_commit:
                 self.the_commit[which] = []
             assert len(list(child_commit))==1
             self.the_commit[which].append(list(child_commit.keys())[0])
+        for (which, hexhash) in self.committed:
+            self.the_commit.setdefault(which, []).append(hexhash)
 
         data = {API_OBJECTS:canonical_json(all_objects),
                 API_COMMIT:canonical_json(self.the_commit)}
 
-        # If we are using the S3 object cache, then upload the object to S3 and return the object.
+        # If we are using a local store, then commit there.
+        if self.local_store is not None:
+            try:
+                return self.local_store.commit(all_objects, self.the_commit)
+            except ValueError as e:
+                raise DVSCommitError(str(e))
+
+        # If we are using the object cache, then spool the commit to be uploaded in a pack and return the object.
+        # The canonical JSON is both hashed and stored.
         if DVS_OBJECT_CACHE_ENV in os.environ:
-            # https://github.com/boto/boto3/issues/894
-            boto3.set_stream_logger('boto3.resources', logging.INFO, format_string='%(message).1600s')
-            data_bytes = canonical_json(data).encode('utf-8')
-            m = sha1()
-            m.update(data_bytes)
-            hexhash = m.hexdigest()
-            url = os.environ[DVS_OBJECT_CACHE_ENV]+'/'+hexhash
-            p = urlparse(url)
-            boto3.resource('s3').Object(p.netloc, p.path[1:]).put(Body=json.dumps({'source':'dvs', 'data':data}).encode('utf-8'), ACL=self.ACL)
+            hexhash = pack_writer(os.environ[DVS_OBJECT_CACHE_ENV], acl=self.ACL).add(canonical_json(data).encode('utf-8'))
             return {hexhash:data}
 
 
@@ -382,8 +521,51 @@ class DVS():
         # Return the commit object
         return r.json()
 
-    def dump_objects(self, *, limit=None, offset=None):
-        """Request the last N objects from the server. Low-level primitive"""
+    def dump_objects(self, *, limit=None, offset=None, cursor=None, kind=None, since=None, until=None, order=None):
+        """Generator that returns objects from the server, newest first unless order=ORDER_ASC.
+        Objects are fetched lazily with the v2 dump, which pages by objectid rather than OFFSET.
+        :param limit: maximum number of objects to return, or None for all of them.
+        :param offset: if provided, use the v1 dump, which skips the first offset objects.
+        :param cursor: objectid of the last object already seen; continue after it.
+        :param kind: only return objects of kind KIND_COMMIT, KIND_FILE or KIND_URL.
+        :param since: only return objects created at or after this time_t or timestamp string.
+        :param until: only return objects created before this time_t or timestamp string.
+        Raises ValueError if offset is combined with cursor, kind, since, until or order, which the v1 dump does not support.
+        """
+        if offset and any([arg is not None for arg in (cursor, kind, since, until, order)]):
+            raise ValueError("offset cannot be combined with cursor, kind, since, until or order")
+        if self.local_store is not None:
+            yield from self.local_store.dump_objects(limit=limit, cursor=cursor, kind=kind, since=since, until=until, order=order)
+            return
+        if offset:
+            yield from self.dump_objects_v1(limit=limit, offset=offset)
+            return
+
+        dump_url = self.api_endpoint + API_V2[DUMP]
+        while limit is None or limit > 0:
+            page = DUMP_PAGE_SIZE if limit is None else min(DUMP_PAGE_SIZE, limit)
+            dump_request = {LIMIT:page, CURSOR:cursor, KIND:kind, SINCE:since, UNTIL:until, ORDER:order}
+            data = {'dump':json.dumps({k:v for (k,v) in dump_request.items() if v is not None}, default=str)}
+            try:
+                r = requests_retry_session().post(dump_url, data=data, verify=self.verify, timeout=self.timeout, stream=True)
+            except requests.exceptions.Timeout as e:
+                raise DVSServerTimeout(dump_url)
+            if r.status_code!=HTTP_OK:
+                raise DVSServerError(f"Error on backend: result={r.status_code}  note:\n{r.text}")
+            count = 0
+            for line in r.iter_lines():
+                if line:
+                    obj = json.loads(line)
+                    cursor = obj[OBJECTID]
+                    count += 1
+                    yield obj
+            if count < page:
+                return
+            if limit is not None:
+                limit -= count
+
+    def dump_objects_v1(self, *, limit=None, offset=None):
+        """Request the last N objects from the server with the v1 dump. Low-level primitive"""
         dump_request = {}
         if limit is not None:
             dump_request[LIMIT] = limit
@@ -400,7 +582,127 @@ class DVS():
             return r.json()
         raise DVSServerError(f"Error on backend: result={r.status_code}  note:\n{r.text}")
 
+    def get_links(self, hexhashes, *, direction=LINKS_WHERE_USED, role=None):
+        """Ask the server for the links of hexhashes. Returns a list of {PARENT:, CHILD:, ROLE:} dictionaries."""
+        links = {HEXHASHES:list(hexhashes), DIRECTION:direction}
+        if role is not None:
+            links[ROLE] = role
+        data = {'links':json.dumps(links, default=str)}
+        try:
+            links_url = self.api_endpoint + API_V2[LINKS]
+            r = requests_retry_session().post(links_url, data=data, verify=self.verify, timeout=self.timeout)
+        except requests.exceptions.Timeout as e:
+            raise DVSServerTimeout(links_url)
+        if r.status_code==HTTP_OK:
+            return r.json()
+        raise DVSServerError(f"Error on backend: result={r.status_code}  note:\n{r.text}")
+
+    def where_used(self, hexhashes, role=None):
+        """Return the links to the commits that have any of hexhashes in their before, method or after"""
+        return self.get_links(hexhashes, direction=LINKS_WHERE_USED, role=role)
+
+    def uses(self, hexhashes, role=None):
+        """Return the links from the commits in hexhashes to the objects they include"""
+        return self.get_links(hexhashes, direction=LINKS_USES, role=role)
+
+    def lineage(self, hexhash, *, direction=LINEAGE_ANCESTORS, depth=None):
+        """Generator for the lineage of hexhash. Yields {NODE:{HEXHASH:, DEPTH:, OBJECT:}} records for the
+        objects in the graph and then {LINK:{PARENT:, CHILD:, ROLE:}} records for the links between them.
+        :param direction: LINEAGE_ANCESTORS or LINEAGE_DESCENDANTS
+        :param depth: number of links to follow, or None for the server's default.
+        """
+        request = {HEXHASH:hexhash, DIRECTION:direction}
+        if depth is not None:
+            request[DEPTH] = depth
+        if self.client_cache is None:
+            yield from self.server_lineage(request)
+            return
+        # Lineage changes as objects are added, so it is cached like a search
+        key     = canonical_json({LINEAGE:request})
+        records = self.client_cache.get_results(key)
+        if records is None:
+            try:
+                records = list(self.server_lineage(request))
+            except (DVSServerTimeout, requests.exceptions.ConnectionError):
+                records = self.client_cache.get_results(key, stale=True)
+                if records is None:
+                    raise
+                logging.warning("server cannot be reached; using an expired lineage")
+            else:
+                self.client_cache.set_results(key, records)
+        yield from records
+
+    def server_lineage(self, request):
+        """Generator for the records of a lineage request, as they are streamed from the server"""
+        data = {'lineage':json.dumps(request, default=str)}
+        try:
+            lineage_url = self.api_endpoint + API_V2[LINEAGE]
+            r = requests_retry_session().post(lineage_url, data=data, verify=self.verify, timeout=self.timeout, stream=True)
+        except requests.exceptions.Timeout as e:
+            raise DVSServerTimeout(lineage_url)
+        if r.status_code!=HTTP_OK:
+            raise DVSServerError(f"Error on backend: result={r.status_code}  note:\n{r.text}")
+        for line in r.iter_lines():
+            if line:
+                yield json.loads(line)
+
+    def text_search(self, text, *, cursor=None):
+        """Full-text search of commit messages, authors and datasets.
+        Returns a page of results, best match first. Each result has a CURSOR;
+        pass the last one back as cursor to get the next page."""
+        search = {TEXT:text}
+        if cursor is not None:
+            search[CURSOR] = cursor
+        return self.search([search])[0][RESULTS]
+
     def search(self, search_list, limit=dvs_constants.API_SEARCH_LIMIT):
+        """Run a list of searches. Returns a list of {SEARCH:search, RESULTS:[rows]}.
+        Names are SQL LIKE patterns, matched case-insensitively. The FILENAME, DIRNAME and HOSTNAME of a
+        search must all match, while SEARCH_ANY matches a hash prefix or any of the names.
+        With a client cache, a search for exactly one full hexhash returns the object with that hexhash,
+        and is only sent to the server the first time. Other searches are sent again when their cached
+        results expire, and expired results are used if the server cannot be reached."""
+        if self.local_store is not None:
+            return self.local_store.search(search_list, limit)
+        if self.client_cache is None:
+            return self.server_search(search_list, limit)
+
+        results = [None] * len(search_list)
+        exact   = {i:search[HEXHASH] for (i, search) in enumerate(search_list)
+                   if list(search.keys())==[HEXHASH] and is_hexadecimal(search[HEXHASH]) and len(search[HEXHASH])==HEXHASH_LEN}
+        rows    = self.client_cache.get_rows(set(exact.values()))
+        keys    = {}
+        for (i, search) in enumerate(search_list):
+            if i in exact:
+                if exact[i] in rows:
+                    results[i] = {SEARCH:search, RESULTS:[rows[exact[i]]]}
+            else:
+                keys[i]    = canonical_json({SEARCH:search, LIMIT:limit})
+                results[i] = self.client_cache.get_results(keys[i])
+        todo = [i for i in range(len(search_list)) if results[i] is None]
+        if not todo:
+            return results
+        try:
+            answers = self.server_search([search_list[i] for i in todo], limit)
+        except (DVSServerTimeout, requests.exceptions.ConnectionError):
+            for i in todo:
+                results[i] = self.client_cache.get_results(keys[i], stale=True) if i in keys else None
+            if any([result is None for result in results]):
+                raise
+            logging.warning("server cannot be reached; using expired search results")
+            return results
+        for (i, answer) in zip(todo, answers):
+            results[i] = answer
+            if i in keys:
+                self.client_cache.set_results(keys[i], answer)
+        # Only the object that an exact search asked for is cached as the answer to that search;
+        # rows of other searches may have fields, such as a SCORE or a CURSOR, that belong to their search.
+        self.client_cache.set_rows([row for (i, answer) in zip(todo, answers) if i in exact
+                                    for row in answer[RESULTS] if row.get(HEXHASH)==exact[i]])
+        return results
+
+    def server_search(self, search_list, limit=dvs_constants.API_SEARCH_LIMIT):
+        """Send a list of searches to the server"""
         data = {'searches':json.dumps(search_list, default=str),
                 'limit':limit}
         try:
@@ -414,6 +716,69 @@ class DVS():
             return r.json()
         raise DVSServerError(f"Error on backend: result={r.status_code}  note:\n{r.text}")
 
+    def search_iter(self, search_list, limit=dvs_constants.API_SEARCH_LIMIT):
+        """Generator version of search. Yields (search, result) for each result as it arrives from the server,
+        so that large results are never held in memory all at once."""
+        if self.local_store is not None:
+            for result in self.local_store.search(search_list, limit):
+                for row in result[RESULTS]:
+                    yield (result[SEARCH], row)
+            return
+        data = {'searches':json.dumps(search_list, default=str),
+                'limit':limit,
+                FORMAT:FORMAT_NDJSON}
+        try:
+            search_url = self.api_endpoint + API_V1[SEARCH]
+            r = requests_retry_session().post(search_url, data=data, verify=self.verify, timeout=self.timeout, stream=True)
+        except requests.exceptions.Timeout as e:
+            raise DVSServerTimeout(search_url)
+        if r.status_code!=HTTP_OK:
+            raise DVSServerError(f"Error on backend: result={r.status_code}  note:\n{r.text}")
+        for line in r.iter_lines():
+            if line:
+                obj = json.loads(line)
+                yield (search_list[obj[SEARCH]], obj[RESULT])
+
+    def exists(self, hexhashes):
+        """Ask the server which of hexhashes are stored. Returns a set."""
+        data = {HEXHASHES:json.dumps(list(hexhashes))}
+        try:
+            exists_url = self.api_endpoint + API_V2[EXISTS]
+            r = requests_retry_session().post(exists_url, data=data, verify=self.verify, timeout=self.timeout)
+        except requests.exceptions.Timeout as e:
+            raise DVSServerTimeout(exists_url)
+        if r.status_code==HTTP_OK:
+            return set(r.json())
+        raise DVSServerError(f"Error on backend: result={r.status_code}  note:\n{r.text}")
+
+    def store_object_lines(self, text):
+        """Send objects in the API_OBJECT_LINES format to the server to be stored as they are"""
+        try:
+            store_url = self.api_endpoint + API_V2[STORE]
+            r = requests_retry_session().post(store_url, data={API_OBJECT_LINES:text}, verify=self.verify, timeout=self.timeout)
+        except requests.exceptions.Timeout as e:
+            raise DVSServerTimeout(store_url)
+        if r.status_code==HTTP_OK:
+            return r.json()
+        raise DVSServerError(f"Error from server: {r.status_code}: {r.text}")
+
+    def push(self, *, batch_size=PUSH_BATCH_SIZE):
+        """Copy the objects in the local store that have not been pushed to the server.
+        Each batch is checked with the server first, and only the objects that it does not have are sent.
+        Objects are pushed in the order they were stored, so a commit is never sent before its objects.
+        Returns the number of objects that were sent."""
+        if self.local_store is None:
+            raise DVSClientError("push requires a local store")
+        sent = 0
+        for (count, hexhashes) in self.local_store.unpushed(batch_size):
+            existing = self.exists(hexhashes)
+            missing  = [hexhash for hexhash in hexhashes if hexhash not in existing]
+            if missing:
+                self.store_object_lines("".join([f"{hexhash} {self.local_store.get_text(hexhash)}\n" for hexhash in missing]))
+                sent += len(missing)
+            self.local_store.set_pushed(count)
+        return sent
+
 
 """
 TODO: Take logic in dvs.py/do_commit_send and move here.
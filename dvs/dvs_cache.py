@@ -0,0 +1,351 @@
+"""
+In-memory caches used by DVS.
+
+Objects in the DVS object store are content-addressed: the value stored under a hexhash can never change.
+That makes them ideal for caching. LRUCache is a bounded, thread-safe least-recently-used cache that can
+be limited by number of entries and by total size. ObjectCache layers an optional shared cache
+(anything with the get_many/set_many interface of a memcached client, such as pymemcache) under the LRU,
+so that several server processes on one host can share what they have already seen.
+ReverseDNSCache resolves addresses to hostnames on background threads, so that a slow resolver
+never blocks the caller. ClientCache is the client's persistent cache of search results, in SQLite.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import socket
+import logging
+import functools
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .dvs_constants import *
+
+DEFAULT_CACHE_ITEMS = 100_000
+DEFAULT_CACHE_BYTES = 256*1024*1024
+DEFAULT_DNS_TTL          = 3600     # seconds to cache a hostname
+DEFAULT_DNS_NEGATIVE_TTL = 300      # seconds to cache an address that has no hostname
+DEFAULT_DNS_WORKERS      = 4
+DEFAULT_CLIENT_CACHE     = os.path.join('~', '.cache', 'dvs', 'client_cache.sqlite3')
+DEFAULT_CLIENT_CACHE_BYTES = 64*1024*1024
+DEFAULT_SEARCH_TTL       = 300      # seconds to cache the results of a search that is not for one hexhash
+
+
+class LRUCache:
+    """A thread-safe LRU cache.
+    :param max_items: maximum number of entries, or None for no limit.
+    :param max_bytes: maximum total size of the entries, as measured by sizeof, or None for no limit.
+    :param ttl: seconds after which an entry expires, or None for entries that never expire.
+    :param sizeof: function that returns the size of a value. Default is len().
+    """
+    def __init__(self, max_items=DEFAULT_CACHE_ITEMS, max_bytes=None, ttl=None, sizeof=len):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl       = ttl
+        self.sizeof    = sizeof
+        self.entries   = OrderedDict() # key -> (value, size, expires)
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.lock      = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _remove(self, key):
+        (value, size, expires) = self.entries.pop(key)
+        self.nbytes -= size
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[2] is not None and entry[2] < time.time():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_many(self, keys):
+        """Return a dictionary of the keys that are in the cache and their values"""
+        ret = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                ret[key] = value
+        return ret
+
+    def set(self, key, value, ttl=None):
+        """Add key to the cache. value may not be None. ttl overrides the cache's ttl for this entry."""
+        assert value is not None
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, expires)
+            self.nbytes += size
+            while ((self.max_items is not None and len(self.entries) > self.max_items) or
+                   (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                self._remove(next(iter(self.entries)))
+
+    def set_many(self, mapping, ttl=None):
+        for (key, value) in mapping.items():
+            self.set(key, value, ttl=ttl)
+
+    def discard(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+
+def shared_cache_from_env():
+    """If DVS_SHARED_CACHE_ENV is set to host:port, return a memcached client for it, otherwise None.
+    Requires pymemcache."""
+    server = os.environ.get(DVS_SHARED_CACHE_ENV)
+    if not server:
+        return None
+    try:
+        from pymemcache.client.base import Client
+    except ModuleNotFoundError:
+        warnings.warn(f"{DVS_SHARED_CACHE_ENV} is set but pymemcache is not installed; shared cache disabled")
+        return None
+    (host, port) = server.rsplit(':',1)
+    return Client((host, int(port)), connect_timeout=1, timeout=1)
+
+
+def shared_cache_errors():
+    """Return the exceptions that a memcached client raises when the shared cache is down or misbehaves"""
+    try:
+        from pymemcache.exceptions import MemcacheError
+    except ModuleNotFoundError:
+        return (OSError,)
+    return (MemcacheError, OSError)
+
+
+class ObjectCache:
+    """Cache of stored objects, keyed by hexhash.
+    Values are the text that is stored in the object store: the canonical JSON of an object,
+    or the URL of a remote object. A cached object is returned as text so that callers
+    cannot modify the cached copy.
+    :param lru: the in-process LRUCache.
+    :param shared: optional shared cache with get_many(keys) and set_many(mapping) methods.
+    :param errors: the exceptions of the shared cache that are logged and ignored, so that a shared cache
+                   that is down never breaks the server. Default is shared_cache_errors().
+    """
+    def __init__(self, lru=None, shared=None, errors=None):
+        self.lru    = lru if lru is not None else LRUCache()
+        self.shared = shared
+        self.errors = errors if errors is not None else shared_cache_errors()
+
+    def get_many(self, hexhashes):
+        """Return a dictionary of {hexhash:text} for the hexhashes that are cached"""
+        found = self.lru.get_many(hexhashes)
+        missing = [hexhash for hexhash in hexhashes if hexhash not in found]
+        if missing and self.shared is not None:
+            try:
+                shared = self.shared.get_many(missing)
+            except self.errors as e:
+                logging.warning("shared cache get_many failed: %s", e)
+            else:
+                shared = {k:(v.decode('utf-8') if isinstance(v,bytes) else v) for (k,v) in shared.items()}
+                self.lru.set_many(shared)
+                found.update(shared)
+        return found
+
+    def missing(self, hexhashes):
+        """Return the set of hexhashes that are not in the cache"""
+        return set(hexhashes) - set(self.get_many(list(hexhashes)).keys())
+
+    def set_many(self, mapping):
+        """Add {hexhash:text} to the cache"""
+        self.lru.set_many(mapping)
+        if self.shared is not None and mapping:
+            try:
+                self.shared.set_many(mapping)
+            except self.errors as e:
+                logging.warning("shared cache set_many failed: %s", e)
+
+    def discard(self, hexhash):
+        self.lru.discard(hexhash)
+        if self.shared is not None:
+            try:
+                self.shared.delete(hexhash)
+            except self.errors as e:
+                logging.warning("shared cache delete failed: %s", e)
+
+
+class ReverseDNSCache:
+    """Non-blocking reverse DNS with positive and negative caching.
+    get() returns a cached hostname or None; resolve() starts a lookup on a background thread
+    if one is needed. Like socket.getfqdn(), an address without a hostname resolves to itself;
+    those results are cached for negative_ttl seconds so that a missing PTR record is not looked up on every request.
+    :param resolver: function that maps an address to a hostname. Default is socket.getfqdn.
+    """
+    def __init__(self, *, ttl=DEFAULT_DNS_TTL, negative_ttl=DEFAULT_DNS_NEGATIVE_TTL, max_items=10_000,
+                 workers=DEFAULT_DNS_WORKERS, resolver=socket.getfqdn):
+        self.cache        = LRUCache(max_items=max_items, ttl=ttl, sizeof=lambda v:1)
+        self.negative_ttl = negative_ttl
+        self.resolver     = resolver
+        self.executor     = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dvs-rdns')
+        self.pending      = {}    # address -> list of callbacks waiting for it
+        self.lock         = threading.Lock()
+
+    def get(self, addr):
+        """Return the cached hostname for addr, or None if it has not been resolved"""
+        return self.cache.get(addr)
+
+    def resolve(self, addr, callback=None):
+        """Resolve addr in the background and call callback(addr, hostname) when it is done.
+        If addr is cached, callback is called immediately in this thread. Concurrent requests for
+        the same address share a single lookup."""
+        hostname = self.cache.get(addr)
+        if hostname is not None:
+            if callback is not None:
+                callback(addr, hostname)
+            return
+        with self.lock:
+            if addr in self.pending:
+                if callback is not None:
+                    self.pending[addr].append(callback)
+                return
+            self.pending[addr] = [callback] if callback is not None else []
+        self.executor.submit(self._lookup, addr)
+
+    def _lookup(self, addr):
+        try:
+            hostname = self.resolver(addr)
+        except (socket.herror, socket.gaierror, OSError) as e:
+            logging.warning("reverse DNS lookup of %s failed: %s", addr, e)
+            hostname = addr
+        self.cache.set(addr, hostname, ttl=self.negative_ttl if hostname==addr else None)
+        with self.lock:
+            callbacks = self.pending.pop(addr, [])
+        # Each callback runs as its own task, so that one that fails does not stop the others
+        for callback in callbacks:
+            self.executor.submit(callback, addr, hostname).add_done_callback(functools.partial(self._callback_done, addr))
+
+    @staticmethod
+    def _callback_done(addr, future):
+        if future.exception() is not None:
+            logging.error("reverse DNS callback for %s failed: %s", addr, future.exception())
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class ClientCache:
+    """A persistent cache of what the client has fetched from the server, in an SQLite database.
+    Objects are content-addressed, so the search result row of an object is cached by its hexhash
+    forever; a search for exactly one full hexhash is answered from it without asking the server,
+    which also works when the server cannot be reached. The results of other searches and of lineage
+    requests are cached for ttl seconds. When the database is larger than max_bytes, the entries
+    that were used least recently are removed.
+    """
+    def __init__(self, path=DEFAULT_CLIENT_CACHE, *, ttl=DEFAULT_SEARCH_TTL, max_bytes=DEFAULT_CLIENT_CACHE_BYTES):
+        self.path      = os.path.expanduser(path)
+        self.ttl       = ttl
+        self.max_bytes = max_bytes
+        self.lock      = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.conn      = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS objects (hexhash TEXT PRIMARY KEY, row TEXT, size INTEGER, used REAL);"
+            "CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, results TEXT, size INTEGER, used REAL, expires REAL);"
+            "CREATE INDEX IF NOT EXISTS objects_used ON objects (used);"
+            "CREATE INDEX IF NOT EXISTS searches_used ON searches (used);")
+        self.conn.commit()
+
+    def get_rows(self, hexhashes):
+        """Return {hexhash:row} for the hexhashes whose rows are cached"""
+        found = {}
+        now   = time.time()
+        with self.lock:
+            for hexhash in hexhashes:
+                r = self.conn.execute("SELECT row FROM objects WHERE hexhash=?", (hexhash,)).fetchone()
+                if r is not None:
+                    found[hexhash] = json.loads(r[0])
+            self.conn.executemany("UPDATE objects SET used=? WHERE hexhash=?", [(now, hexhash) for hexhash in found])
+            self.conn.commit()
+        return found
+
+    def set_rows(self, rows):
+        """Cache search result rows, which have a HEXHASH and an OBJECT"""
+        now    = time.time()
+        values = []
+        for row in rows:
+            text = json.dumps(row, default=str, sort_keys=True)
+            values.append((row[HEXHASH], text, len(text), now))
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO objects (hexhash,row,size,used) VALUES (?,?,?,?)", values)
+            self.conn.commit()
+        self.evict()
+
+    def get_results(self, key, stale=False):
+        """Return the cached results for key, or None. Expired results are returned only if stale is True."""
+        with self.lock:
+            r = self.conn.execute("SELECT results,expires FROM searches WHERE key=?", (key,)).fetchone()
+            if r is None or (r[1] < time.time() and not stale):
+                return None
+            self.conn.execute("UPDATE searches SET used=? WHERE key=?", (time.time(), key))
+            self.conn.commit()
+        return json.loads(r[0])
+
+    def set_results(self, key, results):
+        text = json.dumps(results, default=str)
+        now  = time.time()
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO searches (key,results,size,used,expires) VALUES (?,?,?,?,?)",
+                              (key, text, len(text), now, now + self.ttl))
+            self.conn.commit()
+        self.evict()
+
+    def nbytes(self):
+        with self.lock:
+            return sum([self.conn.execute(f"SELECT COALESCE(SUM(size),0) FROM {table}").fetchone()[0]
+                        for table in ('objects','searches')])
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is no larger than max_bytes"""
+        if self.max_bytes is None:
+            return
+        excess = self.nbytes() - self.max_bytes
+        if excess <= 0:
+            return
+        with self.lock:
+            entries = self.conn.execute("SELECT 'objects',hexhash,size,used FROM objects UNION ALL "
+                                        "SELECT 'searches',key,size,used FROM searches ORDER BY used").fetchall()
+            for (table, key, size, used) in entries:
+                if excess <= 0:
+                    break
+                column = 'hexhash' if table=='objects' else 'key'
+                self.conn.execute(f"DELETE FROM {table} WHERE {column}=?", (key,))
+                excess -= size
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM objects")
+            self.conn.execute("DELETE FROM searches")
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
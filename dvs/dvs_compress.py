@@ -0,0 +1,54 @@
+"""
+Compression of stored objects.
+
+Observations are small JSON documents that repeat the same keys, paths and metadata, so they compress well.
+Objects are compressed with zlib, or with zstd if the zstandard module is installed. zstd can use a
+dictionary trained on a sample of stored objects, which greatly improves the compression of small documents.
+The format of each compressed object is recorded with it, so that formats can be mixed in one table.
+"""
+
+import zlib
+
+ZFORMAT_ZLIB = 1
+ZFORMAT_ZSTD = 2
+ZFORMATS     = {'zlib':ZFORMAT_ZLIB, 'zstd':ZFORMAT_ZSTD}
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 9
+DEFAULT_DICTIONARY_BYTES = 112*1024
+
+
+def have_zstd():
+    try:
+        import zstandard
+    except ModuleNotFoundError:
+        return False
+    return True
+
+def compress(text, zformat, zdict=None):
+    """Compress text with zformat. Returns bytes.
+    :param zdict: for ZFORMAT_ZSTD, optional dictionary as returned by train_dictionary.
+    """
+    data = text.encode('utf-8')
+    if zformat==ZFORMAT_ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL)
+    if zformat==ZFORMAT_ZSTD:
+        import zstandard
+        dict_data = zstandard.ZstdCompressionDict(zdict) if zdict else None
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dict_data).compress(data)
+    raise ValueError(f"unknown compression format {zformat}")
+
+def decompress(blob, zformat, zdict=None):
+    """Decompress a blob that was compressed with compress(). Returns text."""
+    if zformat==ZFORMAT_ZLIB:
+        return zlib.decompress(blob).decode('utf-8')
+    if zformat==ZFORMAT_ZSTD:
+        import zstandard
+        dict_data = zstandard.ZstdCompressionDict(zdict) if zdict else None
+        return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(blob).decode('utf-8')
+    raise ValueError(f"unknown compression format {zformat}")
+
+def train_dictionary(samples, size=DEFAULT_DICTIONARY_BYTES):
+    """Train a zstd dictionary on a list of sample texts. Returns the dictionary as bytes. Requires zstandard."""
+    import zstandard
+    return zstandard.train_dictionary(size, [sample.encode('utf-8') for sample in samples]).as_bytes()
@@ -5,10 +5,10 @@ The goal here is to avoid having quoted constants in the source code
 """
 
 
-import multiprocessing
+import os
 
 HTTP_OK=200
-DEFAULT_THREADS = multiprocessing.cpu_count()*2
+DEFAULT_THREADS = (os.cpu_count() or 1)*2
 DEFAULT_VERIFY=True             # for https
 
 DVS_S3_PREFIX='s3://'
@@ -26,11 +26,21 @@ AWS_HEADER_SERVER="Server"
 # Object cache: If this variable is defined, just put the objects there, and do not talk to the server
 DVS_OBJECT_CACHE_ENV='DVS_OBJECT_CACHE' # S3 location object cache
 DVS_AWS_S3_ACL_ENV='DVS_AWS_S3_ACL'     # ACL to specify when writing to object cache
+DVS_SHARED_CACHE_ENV='DVS_SHARED_CACHE'             # host:port of a memcached shared by the server processes
+DVS_SERVER_CACHE_ITEMS_ENV='DVS_SERVER_CACHE_ITEMS' # max objects in each server process's object cache
+DVS_SERVER_CACHE_BYTES_ENV='DVS_SERVER_CACHE_BYTES' # max bytes in each server process's object cache
+DVS_SLOW_REQUEST_ENV='DVS_SLOW_REQUEST_SECONDS'     # server logs requests that take longer than this
+DVS_COMPRESS_ENV='DVS_COMPRESS_OBJECTS'            # zlib or zstd to store new objects compressed
+DVS_SPOOL_DIR_ENV='DVS_SPOOL_DIR'                  # where commits are spooled before they are packed into the object cache
+DVS_LOCAL_STORE_ENV='DVS_LOCAL_STORE'              # directory of a local object store; commit there instead of to the server
+DVS_CLIENT_CACHE_ENV='DVS_CLIENT_CACHE'            # SQLite file where the client caches search results
+DVS_PLUGINS_ENV='DVS_PLUGINS'                      # comma-separated metadata plugins to run when files are hashed, or 'all'
 
 # Limits
 MAX_OBJECTS_LIST = 1000         # throw an error if >1000 objects in BEFORE, METHOD, or AFTER
 MAX_FILES = 100000                    # Throw an error if more than 100,000 files
 MAX_S3_FILES = 100000                    # Throw an error if more than 100,000 files
+MAX_SEARCH_OBJECTS = 1000       # most searches, or hexhashes, in one request to the server
 
 
 ID='id'
@@ -38,6 +48,7 @@ ID='id'
 # File objects
 FILE_METADATA='metadata'
 FILE_HASHES='hashes'
+FILE_CONTENT='content'          # file: metadata that plugins extracted from the file's contents
 ETAG='etag'
 ST_MTIME='st_mtime'             # mtime as time_t
 ST_MTIME_NS='st_mtime_ns'       # mtime as time_t * 10E9
@@ -75,7 +86,10 @@ IPADDR='ipaddr'                 # commit: ipaddress of object
 PATH='path'
 HEXHASH='hexhash'
 HEXHASH_ALG='sha1'              # which algorithm we are using
+HEXHASH_LEN=40                  # hexadecimal digits in a hexhash
 SEARCH_ANY='*'
+TEXT='text'                     # search: full-text search of commit messages, authors and datasets
+SCORE='score'                   # search: relevance of a full-text search result
 
 # Attributes
 ATTRIBUTE_EPHEMERAL="ephemeral"
@@ -101,9 +115,48 @@ DURATION='duration'             # commit - how long the commit took (so we don't
 # Commit API
 API_OBJECTS='objects'
 API_COMMIT='commit'
+API_OBJECT_LINES='object_lines'  # objects as "hexhash json" lines; the server verifies the hash of the bytes received
+ERROR='error'
+INVALID_OBJECTS='invalid_objects'  # error response - {hexhash:reason} for each object that failed validation
 API_SEARCH_LIMIT=100            # don't return more than 100 objects
+FORMAT='format'                 # response format of search; the default is a single JSON list
+FORMAT_NDJSON='ndjson'          # newline-delimited JSON, one result per line
 
 # Dump
 DUMP='dump'
 LIMIT='limit'
 OFFSET='offset'
+OBJECTID='objectid'
+CURSOR='cursor'                 # v2 dump: continue after this objectid
+KIND='kind'                     # v2 dump: only return objects of this kind
+KIND_COMMIT='commit'            # objects with a before, method or after
+KIND_FILE='file'                # file observations (objects with hashes)
+KIND_URL='url'                  # proxies for remote objects (git commits)
+KINDS=set([KIND_COMMIT, KIND_FILE, KIND_URL])
+SINCE='since'                   # v2 dump: created at or after (time_t or 'YYYY-MM-DD HH:MM:SS')
+UNTIL='until'                   # v2 dump: created before
+ORDER='order'                   # v2 dump: ORDER_ASC or ORDER_DESC (default)
+ORDER_ASC='asc'
+ORDER_DESC='desc'
+
+# Links
+LINKS='links'                   # links endpoint
+HEXHASHES='hexhashes'           # list of hexhashes
+DIRECTION='direction'           # links: LINKS_WHERE_USED or LINKS_USES
+LINKS_WHERE_USED='where_used'   # links: the commits that have the hexhashes in a before, method or after
+LINKS_USES='uses'               # links: the objects in the before, method and after of the hexhashes
+PARENT='parent'                 # link: the commit
+CHILD='child'                   # link: the object in the commit
+ROLE='role'                     # link: COMMIT_BEFORE, COMMIT_METHOD or COMMIT_AFTER
+
+# Push
+EXISTS='exists'                 # exists endpoint: which of HEXHASHES are stored
+STORE='store'                   # store endpoint: store API_OBJECT_LINES, and the links of the commits among them
+
+# Lineage
+LINEAGE='lineage'               # lineage endpoint
+LINEAGE_ANCESTORS='ancestors'   # lineage: walk back to the inputs and methods that produced an object
+LINEAGE_DESCENDANTS='descendants' # lineage: walk forward to the outputs produced from an object
+DEPTH='depth'                   # lineage: how many links to follow
+NODE='node'                     # lineage: a record describing an object in the graph
+LINK='link'                     # lineage: a record describing a link in the graph
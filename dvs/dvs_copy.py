@@ -0,0 +1,190 @@
+"""
+Copy a file, locally or to, from or within S3, and compute its digests while it is copied.
+
+Each byte of the source is read once. It is hashed with all of the digests as it is written to the
+destination, which is a local file or an S3 multipart upload. The destination is then verified
+without being read again: its size must match the number of bytes copied, and an S3 destination
+must have the ETag that S3 gives the parts that were uploaded, which is computed locally. Objects that
+are encrypted with KMS or with a customer key have ETags that are not digests, and are checked by size. The
+observations of the source and the destination share the digests.
+"""
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .dvs_constants import *
+from .dvs_helpers   import Hasher,get_file_observation,add_content,BLOCK_SIZE
+from .dvs_plugins   import plugin_pipeline
+from .observations  import get_bucket_key,s3_observation
+from .exceptions    import DVSCopyError
+
+DEFAULT_PART_SIZE = 64*1024*1024    # bytes in each part of a multipart upload
+MAX_PARTS         = 10000           # the most parts that S3 allows in one upload
+UPLOAD_THREADS    = 4               # parts uploaded at once, while the next part is read and hashed
+REPORT_BYTES      = 1024*1024*1024  # log progress after each GiB
+
+
+def part_size_for(size, part_size=DEFAULT_PART_SIZE):
+    """Return a part size that uploads size bytes in no more than MAX_PARTS parts, in whole MiB"""
+    if size is None or size <= part_size*MAX_PARTS:
+        return part_size
+    mib = 1024*1024
+    return ((size + MAX_PARTS - 1) // MAX_PARTS + mib - 1) // mib * mib
+
+
+class S3Reader:
+    def __init__(self, client, path):
+        (self.bucket, self.key) = get_bucket_key(path)
+        self.response = client.get_object(Bucket=self.bucket, Key=self.key)
+        self.size     = self.response['ContentLength']
+
+    def read(self, n):
+        return self.response['Body'].read(n)
+
+    def close(self):
+        self.response['Body'].close()
+
+
+class S3Writer:
+    """Write to S3 in parts of part_size, uploading each part on a thread while the next one is read"""
+    def __init__(self, client, path, part_size, acl=None):
+        (self.bucket, self.key) = get_bucket_key(path)
+        self.client    = client
+        self.part_size = part_size
+        self.acl       = acl
+        self.buf       = bytearray()
+        self.futures   = []
+        self.upload_id = None
+        self.pool      = ThreadPoolExecutor(max_workers=UPLOAD_THREADS)
+
+    def upload_part(self, number, data):
+        r = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data)
+        return {'PartNumber':number, 'ETag':r['ETag']}
+
+    def write(self, data):
+        self.buf += data
+        while len(self.buf) >= self.part_size:
+            if self.upload_id is None:
+                args = {'ACL':self.acl} if self.acl else {}
+                self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key, **args)['UploadId']
+            part = bytes(self.buf[0:self.part_size])
+            del self.buf[0:self.part_size]
+            # Wait for a part to finish before starting another, so that memory is bounded
+            if len(self.futures) >= UPLOAD_THREADS:
+                self.futures[-UPLOAD_THREADS].result()
+            self.futures.append(self.pool.submit(self.upload_part, len(self.futures)+1, part))
+
+    def close(self):
+        """Finish the upload. Returns the number of parts, or 0 if the object was small enough to put in one request."""
+        try:
+            if self.upload_id is None:
+                args = {'ACL':self.acl} if self.acl else {}
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buf), **args)
+                return 0
+            if self.buf:
+                self.futures.append(self.pool.submit(self.upload_part, len(self.futures)+1, bytes(self.buf)))
+            parts = [future.result() for future in self.futures]
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts':parts})
+            return len(parts)
+        finally:
+            self.pool.shutdown()
+
+    def abort(self):
+        self.pool.shutdown()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def etag_is_md5(head):
+    """Return True if the ETag of an S3 object is computed from its bytes, given its head_object response.
+    It is not for objects that are encrypted with KMS keys (SSE-KMS or DSSE-KMS) or with a customer key (SSE-C)."""
+    return (not str(head.get('ServerSideEncryption','')).startswith('aws:kms')) and ('SSECustomerAlgorithm' not in head)
+
+
+def observe_s3(client, path, hashes):
+    """Return (observation, head_object response) of an S3 object, using hashes that were computed when it was copied"""
+    (bucket, key) = get_bucket_key(path)
+    head = client.head_object(Bucket=bucket, Key=key)
+    return (s3_observation(bucket=bucket, key=key, size=head['ContentLength'], mtime=head['LastModified'],
+                           etag=head['ETag'], hashes=hashes), head)
+
+
+def observe_local(path, hashes):
+    return {**get_file_observation(path), FILE_HASHES:hashes}
+
+
+
+def copy_with_hashes(src_path, dst_path, *, part_size=DEFAULT_PART_SIZE, acl=None):
+    """Copy src_path to dst_path, either of which may be local or an s3:// URL, reading the source once.
+    Returns (src_observation, dst_observation), which have the same FILE_HASHES, and the same FILE_CONTENT
+    from the enabled plugins.
+    Raises DVSCopyError if the destination does not match what was copied."""
+    client = None
+    if src_path.startswith(DVS_S3_PREFIX) or dst_path.startswith(DVS_S3_PREFIX):
+        import boto3
+        client = boto3.client(AWS_S3)
+
+    if src_path.startswith(DVS_S3_PREFIX):
+        src  = S3Reader(client, src_path)
+        size = src.size
+    else:
+        src  = open(src_path, 'rb')
+        size = os.fstat(src.fileno()).st_size
+    part_size = part_size_for(size, part_size)
+    plugins   = plugin_pipeline()
+    hasher    = Hasher(part_size=part_size, plugins=plugins)
+
+    if dst_path.startswith(DVS_S3_PREFIX):
+        dst = S3Writer(client, dst_path, part_size, acl=acl)
+    else:
+        dst = open(dst_path, 'xb')
+    next_report = REPORT_BYTES
+    try:
+        while True:
+            buf = src.read(BLOCK_SIZE)
+            if not buf:
+                break
+            hasher.update(buf)
+            dst.write(buf)
+            if hasher.count >= next_report:
+                logging.info("copied %s of %s bytes of %s", f"{hasher.count:,}", f"{size:,}", src_path)
+                next_report += REPORT_BYTES
+        parts = dst.close()
+    except BaseException:
+        if isinstance(dst, S3Writer):
+            dst.abort()
+        else:
+            dst.close()
+            os.unlink(dst_path)
+        raise
+    finally:
+        src.close()
+
+    if hasher.count != size:
+        raise DVSCopyError(f"read {hasher.count} bytes from {src_path} but it has {size} bytes")
+    hashes = hasher.hexdigests()
+
+    if src_path.startswith(DVS_S3_PREFIX):
+        (src_obs, head) = observe_s3(client, src_path, hashes)
+        etag    = src_obs[FILE_METADATA][ETAG]
+        # An object that was not uploaded in parts has its MD5 as its ETag, unless it is encrypted with KMS or SSE-C
+        if etag_is_md5(head) and '-' not in etag and etag != hashes[MD5]:
+            raise DVSCopyError(f"{src_path} has ETag {etag} but the MD5 of what was read is {hashes[MD5]}")
+    else:
+        src_obs = observe_local(src_path, hashes)
+
+    if dst_path.startswith(DVS_S3_PREFIX):
+        (dst_obs, head) = observe_s3(client, dst_path, hashes)
+        expected = hasher.multipart_etag() if parts else hashes[MD5]
+        if dst_obs[FILE_METADATA][ST_SIZE] != hasher.count:
+            raise DVSCopyError(f"{dst_path} has {dst_obs[FILE_METADATA][ST_SIZE]} bytes but {hasher.count} were copied")
+        # A destination that is encrypted with KMS or SSE-C is verified by its size only
+        if etag_is_md5(head) and dst_obs[FILE_METADATA][ETAG] != expected:
+            raise DVSCopyError(f"{dst_path} has ETag {dst_obs[FILE_METADATA][ETAG]} but {expected} was expected")
+    else:
+        dst_obs = observe_local(dst_path, hashes)
+        if dst_obs[FILE_METADATA][ST_SIZE] != hasher.count:
+            raise DVSCopyError(f"{dst_path} has {dst_obs[FILE_METADATA][ST_SIZE]} bytes but {hasher.count} were copied")
+    return (add_content(src_obs, plugins), add_content(dst_obs, plugins))
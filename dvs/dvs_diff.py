@@ -0,0 +1,84 @@
+"""
+Compare a directory tree with the files that a commit produced.
+
+diff_tree() loads the COMMIT_AFTER files of a commit, following its child commits, and walks the
+directory with os.scandir. Files that are in only one of them are added or removed. Files that are in
+both are compared with the passes of dvs_verify: by size and mtime first, and by their hashes only when
+the size matches but the mtime does not. An incremental run can then register only the files that
+were added or modified.
+"""
+
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+
+from .dvs_constants import *
+from .dvs_verify    import recorded_for_commit,stat_check,hash_check,VERIFY_OK,VERIFY_MISSING,VERIFY_ERROR
+
+DIFF_ADDED    = 'added'
+DIFF_REMOVED  = 'removed'
+DIFF_MODIFIED = 'modified'
+DIFF_ERROR    = 'error'         # files that could not be read, so are not known to be modified or not
+
+
+def walk_tree(root):
+    """Return {path:os.stat_result} for every file under root, or for root itself if it is a file.
+    Symbolic links under root are not followed. A root that does not exist has no files."""
+    root = os.path.abspath(root)
+    try:
+        st = os.stat(root)
+    except FileNotFoundError:
+        return {}
+    if stat.S_ISREG(st.st_mode):
+        return {root:st}
+    found = {}
+    todo  = [root]
+    while todo:
+        with os.scandir(todo.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    todo.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    found[entry.path] = entry.stat(follow_symlinks=False)
+    return found
+
+
+def in_tree(path, root):
+    return path==root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def diff_tree(dc, hexhash, root, *, threads=DEFAULT_THREADS, roles=(COMMIT_AFTER,)):
+    """Compare the files under root with the files that the commit hexhash recorded under root.
+    Returns {DIFF_ADDED:[paths], DIFF_REMOVED:[paths], DIFF_MODIFIED:[paths], DIFF_ERROR:[paths], 'hashed':count},
+    with sorted paths."""
+    root     = os.path.abspath(root)
+    recorded = {path:obj for (path, obj) in recorded_for_commit(dc, hexhash, roles=list(roles)).items()
+                if in_tree(path, root)}
+    current  = walk_tree(root)
+    diff     = {DIFF_ADDED:   sorted(set(current) - set(recorded)),
+                DIFF_REMOVED: sorted(set(recorded) - set(current)),
+                DIFF_MODIFIED:[],
+                DIFF_ERROR:   []}
+    to_hash  = []
+    for path in sorted(set(current) & set(recorded)):
+        check = stat_check(path, recorded[path], st=current[path])
+        if check is None:
+            to_hash.append(path)
+        elif check[0] == VERIFY_ERROR:
+            diff[DIFF_ERROR].append(path)
+        elif check[0] != VERIFY_OK:
+            diff[DIFF_MODIFIED].append(path)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for (path, (status, reason, nbytes)) in zip(to_hash, pool.map(lambda path: hash_check(path, recorded[path]), to_hash)):
+            if status == VERIFY_MISSING:
+                diff[DIFF_REMOVED].append(path)
+            elif status == VERIFY_ERROR:
+                diff[DIFF_ERROR].append(path)
+            elif status != VERIFY_OK:
+                diff[DIFF_MODIFIED].append(path)
+    diff[DIFF_REMOVED].sort()
+    diff[DIFF_MODIFIED].sort()
+    diff[DIFF_ERROR].sort()
+    diff['hashed'] = len(to_hash)
+    return diff
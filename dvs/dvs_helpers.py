@@ -4,15 +4,13 @@ Misc. functions that are used in the DAS code.
 
 import os
 import os.path
-import requests
-import urllib3
 import logging
 import datetime
-import requests
 import json
 import hashlib
 import socket
 import time
+import calendar
 import string
 import sys
 import pwd
@@ -20,6 +18,7 @@ import grp
 import string
 
 from .dvs_constants import *
+from .dvs_plugins   import plugin_pipeline
 
 BLOCK_SIZE    = 1024*1024
 INCLUDE_GECOS = False
@@ -65,35 +64,68 @@ def json_stat(path: str) -> dict:
 
     return obj
 
-def hash_filehandle(f):
-    """Right now this is done single-threaded. It could be parallelized.
+class Hasher:
+    """Computes all of the digests of a stream in one pass.
+    :param part_size: if provided, also compute the ETag that S3 gives an object uploaded in parts of this size.
+    :param plugins: if provided, a dvs_plugins.PluginPipeline that is given each block, so that metadata is
+                    extracted in the same pass.
     """
-    sha512_hash = hashlib.sha512()
-    sha256_hash = hashlib.sha256()
-    sha1_hash   = hashlib.sha1()
-    md5_hash    = hashlib.md5()
+    def __init__(self, part_size=None, plugins=None):
+        self.hashes    = {SHA512:hashlib.sha512(), SHA256:hashlib.sha256(), SHA1:hashlib.sha1(), MD5:hashlib.md5()}
+        self.plugins   = plugins
+        self.count     = 0
+        self.part_size = part_size
+        self.part_md5s = []
+        self.part      = hashlib.md5()
+        self.part_len  = 0
+
+    def update(self, buf):
+        for h in self.hashes.values():
+            h.update(buf)
+        self.count += len(buf)
+        if self.plugins is not None:
+            self.plugins.update(buf)
+        if self.part_size:
+            while buf:
+                take = buf[0:self.part_size - self.part_len]
+                self.part.update(take)
+                self.part_len += len(take)
+                buf = buf[len(take):]
+                if self.part_len == self.part_size:
+                    self.part_md5s.append(self.part.digest())
+                    self.part     = hashlib.md5()
+                    self.part_len = 0
+
+    def hexdigests(self):
+        return {name:h.hexdigest() for (name, h) in self.hashes.items()}
+
+    def multipart_etag(self):
+        """The ETag of an object uploaded in parts of part_size: the MD5 of the MD5s of the parts, and the number of parts"""
+        md5s = self.part_md5s + ([self.part.digest()] if self.part_len or not self.part_md5s else [])
+        return hashlib.md5(b"".join(md5s)).hexdigest() + f"-{len(md5s)}"
+
+
+def hash_filehandle(f, plugins=None):
+    """Return the digests of everything read from f. Right now this is done single-threaded. It could be parallelized.
+    :param plugins: a dvs_plugins.PluginPipeline that sees every block as it is hashed.
+    """
+    hasher      = Hasher(plugins=plugins)
     fb          = f.read(BLOCK_SIZE)
-    count       = 0
     next_gig    = 100_000_000
     while len(fb) > 0:
-        sha1_hash.update(fb)
-        md5_hash.update(fb)
-        count += len(fb)
-        if count>next_gig:
-            print(f"  ... PID {os.getpid()} hashed {count:,} bytes",file=sys.stderr)
+        hasher.update(fb)
+        if hasher.count>next_gig:
+            print(f"  ... PID {os.getpid()} hashed {hasher.count:,} bytes",file=sys.stderr)
             next_gig += 100_000_000
         fb = f.read(BLOCK_SIZE)
-    logging.debug("End hashing %s. sha1=%s",f,sha1_hash.hexdigest())
-    return {SHA512:sha512_hash.hexdigest(),
-            SHA256:sha256_hash.hexdigest(),
-            SHA1:sha1_hash.hexdigest(),
-            MD5:md5_hash.hexdigest()}
+    logging.debug("End hashing %s. sha1=%s",f,hasher.hashes[SHA1].hexdigest())
+    return hasher.hexdigests()
 
 
-def hash_file(fullpath):
+def hash_file(fullpath, plugins=None):
     logging.debug("Start hashing %s",fullpath)
     with open(fullpath, 'rb') as f:
-        return hash_filehandle(f)
+        return hash_filehandle(f, plugins)
 
 def hexhash_string(s):
     """Just return the hexadecimal SHA1 of a string"""
@@ -113,6 +145,32 @@ def is_hexadecimal(s):
     else:
         return all([is_hexadecimal(ch) for ch in s])
 
+def escape_like(s):
+    """Return a SQL LIKE pattern that matches only s"""
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def is_hexhash(s):
+    """Return true if s is a hexhash: HEXHASH_LEN hexadecimal digits, the SHA1 that objects are stored under"""
+    return isinstance(s,str) and len(s)==HEXHASH_LEN and is_hexadecimal(s)
+
+def hexhash_to_bin(hexhash):
+    """Return the binary form of a hexadecimal hash, as stored in the database"""
+    return bytes.fromhex(hexhash)
+
+def bin_to_hexhash(b):
+    """Return the lowercase hexadecimal form of a binary hash from the database"""
+    return b.hex() if b is not None else None
+
+def hex_prefix_range(prefix, nbytes):
+    """Return (low, high), the smallest and largest binary digests of nbytes bytes whose
+    hexadecimal form starts with prefix, so that a prefix search becomes a range scan.
+    Returns None if prefix cannot be the prefix of such a digest."""
+    if not is_hexadecimal(prefix) or len(prefix) > nbytes*2:
+        return None
+    prefix = prefix.lower()
+    return (bytes.fromhex(prefix.ljust(nbytes*2,'0')),
+            bytes.fromhex(prefix.ljust(nbytes*2,'f')))
+
 def canonical_json(obj):
     """Turns obj into a string in the canonical json format"""
     return json.dumps(obj,sort_keys=True,default=str)
@@ -139,9 +197,44 @@ def get_file_observation(path):
     return obj
 
 
+def add_content(obj, plugins):
+    """Add the metadata of a dvs_plugins.PluginPipeline that has seen a file to the file's observation"""
+    if plugins is not None:
+        content = plugins.result()
+        if content:
+            obj[FILE_CONTENT] = content
+    return obj
+
+
 def get_file_observation_with_hash(path):
-    """Return a file update with the hash"""
-    return {**get_file_observation(path), **{FILE_HASHES:hash_file(path)}}
+    """Return a file update with the hash, and the metadata of the enabled plugins"""
+    plugins = plugin_pipeline()
+    return add_content({**get_file_observation(path), **{FILE_HASHES:hash_file(path, plugins)}}, plugins)
+
+
+MANIFEST_CHUNK_SIZE = 64*1024
+
+def read_manifest(f, chunk_size=MANIFEST_CHUNK_SIZE):
+    """Generator that yields the paths in a manifest read from the binary file f, such as the output of find.
+    Paths are separated by NULs (find -print0) if there is a NUL in the first chunk, and by newlines otherwise.
+    Empty paths are skipped. Paths are decoded with os.fsdecode, so any filename can be given."""
+    sep  = None
+    rest = b""
+    while True:
+        chunk = f.read(chunk_size)
+        if sep is None:
+            sep = b"\0" if b"\0" in chunk else b"\n"
+        if not chunk:
+            break
+        lines = (rest + chunk).split(sep)
+        rest  = lines.pop()
+        for line in lines:
+            if sep==b"\n":
+                line = line.rstrip(b"\r")
+            if line:
+                yield os.fsdecode(line)
+    if rest.rstrip(b"\r\n"):
+        yield os.fsdecode(rest.rstrip(b"\r\n") if sep==b"\n" else rest)
 
 
 def objects_dict(objects):
@@ -149,6 +242,79 @@ def objects_dict(objects):
     return {canonical_json_hexhash(obj):obj for obj in objects}
 
 
+# Blobs in the object cache are named by the UTC date and time they were written and their hexhash,
+# e.g. 2020-09-15/105220-<hexhash>, so that new blobs can be found by listing after a point in time.
+# Blobs written by older clients are named by the hexhash alone.
+OBJECT_CACHE_KEY_FORMAT = "%Y-%m-%d/%H%M%S"
+
+def object_cache_key(hexhash, when=None):
+    """Return the name of a blob in the object cache"""
+    return time.strftime(OBJECT_CACHE_KEY_FORMAT, time.gmtime(when)) + "-" + hexhash
+
+def object_cache_hexhash(key):
+    """Return the hexhash of the blob named key, which may be a path"""
+    return os.path.basename(key).rsplit("-",1)[-1]
+
+def object_cache_key_time(key):
+    """Return the time_t that the blob named key was written, or None if key does not have a time"""
+    parts = key.split("/")
+    if len(parts)<2 or "-" not in parts[-1]:
+        return None
+    try:
+        return calendar.timegm(time.strptime(parts[-2] + "/" + parts[-1].split("-")[0], OBJECT_CACHE_KEY_FORMAT))
+    except ValueError:
+        return None
+
+
+def check_object(key, value, exact=False):
+    """Check that an uploaded object matches its key.
+    If exact is False, value is the decoded object, which is checked in its canonical form.
+    If exact is True, value is the JSON text that was received, and the hash of that text is checked.
+    Objects are dictionaries; a string is the URL of a remote object.
+    :return: (obj, text, error) - the object, the text to store, and None; or None, None and the reason it is invalid.
+    """
+    if not is_hexhash(key):
+        return (None, None, "key is not a hexhash")
+    if exact:
+        text = value
+        try:
+            value = json.loads(text)
+        except json.decoder.JSONDecodeError:
+            return (None, None, "value is not valid JSON")
+    if isinstance(value,dict):
+        if not exact:
+            text = canonical_json(value)
+        hh = hexhash_string(text)
+        if key != hh:
+            return (None, None, f"computed hash is {hh}")
+        return (value, text, None)
+    elif isinstance(value,str):
+        if ":" not in value:
+            return (None, None, "value is not a URL")
+        return (value, value, None)
+    return (None, None, "value is not a dict or a string")
+
+def check_objects(items, exact=False):
+    """Run check_object on a list of (key,value) pairs. Returns a list of (key, obj, text, error)."""
+    return [(key,) + check_object(key, value, exact) for (key,value) in items]
+
+def object_lines(objects):
+    """Encode {hexhash:object} as lines of "hexhash canonical_json", the format of the API_OBJECT_LINES parameter"""
+    return "".join([f"{key} {canonical_json(obj)}\n" for (key,obj) in objects.items()])
+
+def parse_object_lines(text):
+    """Decode the API_OBJECT_LINES format into a list of (hexhash, json_text). Raises ValueError if a line is malformed."""
+    items = []
+    for (lineno, line) in enumerate(text.split("\n"), 1):
+        if not line:
+            continue
+        (key, sep, value) = line.partition(" ")
+        if not sep:
+            raise ValueError(f"line {lineno} is not a hexhash followed by a JSON value")
+        items.append((key, value))
+    return items
+
+
 def check_length_is_unique_prefix(hexhashes:set, length:int) -> bool:
     """Returns True if the length is sufficient to distinguish all of the hex hashes."""
     prefixes = set()
@@ -0,0 +1,252 @@
+"""
+A local object store.
+
+When DVS_LOCAL_STORE is set to a directory, DVS.commit() stores commits in that directory rather than
+sending them to the server, and DVS.search() and DVS.dump_objects() are answered from it. This gives
+air-gapped runs, offline development and tests a fast place to commit. DVS.push() later copies the
+objects to the server, sending only those that the server does not already have.
+
+The store is content-addressed, like the server:
+- objects/XX/HEXHASH holds the canonical JSON of each object, where XX is the first two digits of its hexhash.
+  Objects are written to a temporary file and renamed, so a reader never sees a partial object.
+- objects.log has a line "hexhash time_t" for each object, in the order they were stored. The line
+  number is the object's objectid, and objects are always logged after the objects that their commit refers to.
+- pushed has the number of lines of objects.log that have been pushed to the server.
+- lock is locked with fcntl.flock while objects are stored, so several processes can share a store.
+"""
+
+import os
+import re
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from .dvs_constants import *
+from .dvs_helpers   import canonical_json,hexhash_string,is_hexadecimal
+
+OBJECTS_DIR   = 'objects'
+LOG_FILE      = 'objects.log'
+PUSHED_FILE   = 'pushed'
+LOCK_FILE     = 'lock'
+PUSH_BATCH_SIZE = 1000          # objects per exists and store request; the server's MAX_SEARCH_OBJECTS
+MAX_SEARCH_RESULTS = 100
+LINK_ROLES    = [COMMIT_BEFORE, COMMIT_METHOD, COMMIT_AFTER]
+
+
+def like(pattern, value):
+    """Match value against a SQL LIKE pattern, case-insensitively, as the server's search does.
+    A backslash makes the character after it match only itself."""
+    if not isinstance(value, str):
+        return False
+    regex = []
+    chars = iter(str(pattern))
+    for c in chars:
+        if c=='\\':
+            regex.append(re.escape(next(chars, '\\')))
+        else:
+            regex.append('.*' if c=='%' else '.' if c=='_' else re.escape(c))
+    return re.fullmatch("".join(regex), value, re.IGNORECASE | re.DOTALL) is not None
+
+def to_time(when):
+    """Return when, a time_t or a 'YYYY-MM-DD HH:MM:SS' string in UTC, as a time_t"""
+    if isinstance(when, (int, float)):
+        return when
+    import calendar
+    return calendar.timegm(time.strptime(str(when), "%Y-%m-%d %H:%M:%S"))
+
+def object_kind(obj):
+    if isinstance(obj, dict) and any([role in obj for role in LINK_ROLES]):
+        return KIND_COMMIT
+    if isinstance(obj, dict) and isinstance(obj.get(FILE_HASHES), dict) and SHA1 in obj[FILE_HASHES]:
+        return KIND_FILE
+    return None
+
+def text_matches(text, obj):
+    """Return True if obj is a commit with any of the words of text in its message, author or datasets"""
+    if object_kind(obj) != KIND_COMMIT:
+        return False
+    fields = " ".join([str(obj.get(key,'')) for key in (COMMIT_MESSAGE, COMMIT_AUTHOR, COMMIT_DATASET)]).lower()
+    return any([word in fields for word in str(text).lower().split()])
+
+def search_matches(search, hexhash, obj):
+    """Return True if the object matches the search, with the same rules as the server's do_v2search:
+    a hash prefix, SEARCH_ANY as any name, or all of the FILENAME, DIRNAME and HOSTNAME of the search
+    matches, and if the search has a size, so must the object.
+    A TEXT search matches commits with any of its words, but the results are not ranked."""
+    if TEXT in search:
+        return text_matches(search[TEXT], obj)
+    search_any = search.get(SEARCH_ANY)
+    prefixes   = [s.lower() for s in (search_any, search.get(HEXHASH)) if is_hexadecimal(s)]
+    names      = {field:search.get(field) for field in (FILENAME, DIRNAME, HOSTNAME) if search.get(field)}
+    size       = search.get(FILE_METADATA,{}).get(ST_SIZE) if isinstance(search.get(FILE_METADATA),dict) else None
+    if not (prefixes or search_any or names or size is not None):
+        return False
+    if not isinstance(obj, dict):
+        return False
+    if prefixes or search_any or names:
+        hashes  = obj.get(FILE_HASHES) if isinstance(obj.get(FILE_HASHES), dict) else {}
+        digests = [hexhash] + [str(hashes[alg]).lower() for alg in (MD5, SHA1, SHA256, SHA512) if alg in hashes]
+        if not (any([digest.startswith(prefix) for prefix in prefixes for digest in digests])
+                or (search_any and any([like(search_any, obj.get(field)) for field in (FILENAME, DIRNAME, HOSTNAME)]))
+                or (names and all([like(name, obj.get(field)) for (field, name) in names.items()]))):
+            return False
+    if size is not None:
+        metadata = obj.get(FILE_METADATA) if isinstance(obj.get(FILE_METADATA), dict) else {}
+        if metadata.get(ST_SIZE) != size:
+            return False
+    return True
+
+
+class LocalStore:
+    """A content-addressed object store in a local directory"""
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(self.path, OBJECTS_DIR), exist_ok=True)
+
+    def object_path(self, hexhash):
+        return os.path.join(self.path, OBJECTS_DIR, hexhash[0:2], hexhash)
+
+    def exists(self, hexhash):
+        return os.path.exists(self.object_path(hexhash))
+
+    def get_text(self, hexhash):
+        """Return the canonical JSON of the object, or None if it is not stored"""
+        try:
+            with open(self.object_path(hexhash)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, hexhash):
+        text = self.get_text(hexhash)
+        return json.loads(text) if text is not None else None
+
+    def log(self):
+        """Return [(hexhash, time_t)] for every object, in the order they were stored"""
+        try:
+            with open(os.path.join(self.path, LOG_FILE)) as f:
+                return [(hexhash, float(created)) for (hexhash, created) in
+                        [line.split() for line in f if line.endswith("\n")]]
+        except FileNotFoundError:
+            return []
+
+    @contextmanager
+    def locked(self):
+        """Hold the store's lock, against other threads and against other processes"""
+        import fcntl
+        with self.lock:
+            with open(os.path.join(self.path, LOCK_FILE), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def store_objects(self, objects):
+        """Store {hexhash:object}. Objects that are already stored are skipped. Returns the hexhashes that were new."""
+        new = []
+        with self.locked():
+            for (hexhash, obj) in objects.items():
+                path = self.object_path(hexhash)
+                if os.path.exists(path):
+                    continue
+                text = canonical_json(obj)
+                if hexhash_string(text) != hexhash:
+                    raise ValueError(f"object {hexhash} does not match its hexhash")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path + '.tmp', 'w') as f:
+                    f.write(text)
+                os.replace(path + '.tmp', path)
+                new.append(hexhash)
+            if new:
+                now = time.time()
+                with open(os.path.join(self.path, LOG_FILE), 'a') as f:
+                    f.write("".join([f"{hexhash} {now}\n" for hexhash in new]))
+        return new
+
+    def commit(self, objects, commit):
+        """Store the objects and the commit, as the server's commit does. Returns {hexhash:commit}."""
+        self.store_objects(objects)
+        refs    = set([hexhash for role in LINK_ROLES for hexhash in commit.get(role,[])])
+        missing = [hexhash for hexhash in refs if not self.exists(hexhash)]
+        if missing:
+            raise ValueError(f"{len(missing)} hashes were not stored")
+        commit  = {**commit, TIME:time.time()}
+        hexhash = hexhash_string(canonical_json(commit))
+        self.store_objects({hexhash:commit})
+        return {hexhash:commit}
+
+    def row(self, objectid, hexhash, created, obj=None):
+        """Return an object in the form that the server's search and dump return it"""
+        return {OBJECTID:objectid, CREATED:time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(created)),
+                HEXHASH:hexhash, OBJECT:obj if obj is not None else self.get(hexhash), 'url':None}
+
+    def search(self, search_list, limit=MAX_SEARCH_RESULTS):
+        """Answer a list of searches as the server does, by scanning every object.
+        Returns a list of {SEARCH:search, RESULTS:[rows]}. Results are newest first, as the server's are."""
+        results = [{SEARCH:search, RESULTS:[]} for search in search_list]
+        for (objectid, (hexhash, created)) in reversed(list(enumerate(self.log(), 1))):
+            obj = None
+            for result in results:
+                if len(result[RESULTS]) >= limit:
+                    continue
+                if TEXT in result[SEARCH] and result[SEARCH].get(CURSOR) and objectid >= int(result[SEARCH][CURSOR]):
+                    continue
+                obj = obj if obj is not None else self.get(hexhash)
+                if search_matches(result[SEARCH], hexhash, obj):
+                    row = self.row(objectid, hexhash, created, obj)
+                    if TEXT in result[SEARCH]:
+                        row[CURSOR] = str(objectid)
+                    result[RESULTS].append(row)
+        return results
+
+    def dump_objects(self, *, limit=None, cursor=None, kind=None, since=None, until=None, order=None):
+        """Generator that returns objects, with the same arguments as the server's v2 dump"""
+        order = order or ORDER_DESC
+        if order not in (ORDER_ASC, ORDER_DESC):
+            raise ValueError(f"order must be {ORDER_ASC} or {ORDER_DESC}")
+        if kind is not None and kind not in KINDS:
+            raise ValueError(f"kind must be one of {sorted(KINDS)}")
+        since   = to_time(since) if since is not None else None
+        until   = to_time(until) if until is not None else None
+        entries = list(enumerate(self.log(), 1))
+        if order==ORDER_DESC:
+            entries.reverse()
+        for (objectid, (hexhash, created)) in entries:
+            if limit is not None and limit <= 0:
+                return
+            if cursor is not None and (objectid <= cursor if order==ORDER_ASC else objectid >= cursor):
+                continue
+            if (since is not None and created < since) or (until is not None and created >= until):
+                continue
+            row = self.row(objectid, hexhash, created)
+            if kind is not None and object_kind(row[OBJECT]) != kind:
+                continue
+            if limit is not None:
+                limit -= 1
+            yield row
+
+    def pushed(self):
+        """Return the number of objects in the log that have been pushed"""
+        try:
+            with open(os.path.join(self.path, PUSHED_FILE)) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def set_pushed(self, count):
+        path = os.path.join(self.path, PUSHED_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write(f"{count}\n")
+        os.replace(path + '.tmp', path)
+
+    def unpushed(self, batch_size=PUSH_BATCH_SIZE):
+        """Generator that yields (count, [hexhash]) for batches of the objects that have not been pushed,
+        where count is the number of log entries pushed once the batch is. Pass count to set_pushed()."""
+        pushed = self.pushed()
+        log    = self.log()
+        for offset in range(pushed, len(log), batch_size):
+            batch = log[offset:offset+batch_size]
+            yield (offset + len(batch), [hexhash for (hexhash, created) in batch])
@@ -0,0 +1,189 @@
+"""
+Latency and throughput metrics for the DVS server.
+
+Counters and histograms are kept in a Registry and rendered in the Prometheus text exposition format:
+https://prometheus.io/docs/instrumenting/exposition_formats/
+
+Each metric has a fixed list of label names; values are recorded with the label values as keyword arguments:
+    REQUEST_SECONDS = registry.histogram('dvs_request_seconds', 'Request latency', ['endpoint'])
+    REQUEST_SECONDS.observe(0.25, endpoint='commit')
+
+phase() times a phase of the request that is being handled by the current thread (see request()).
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{name}="{escape_label_value(value)}"' for (name,value) in zip(names,values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value,float) else str(value)
+
+
+class Metric:
+    kind = None
+    def __init__(self, name, help, labelnames=()):
+        self.name       = name
+        self.help       = help
+        self.labelnames = tuple(labelnames)
+        self.values     = {}    # tuple of label values -> value
+        self.lock       = threading.Lock()
+
+    def label_values(self, labels):
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError(f"{self.name} requires labels {self.labelnames}, got {tuple(labels.keys())}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for (values, value) in sorted(self.values.items()):
+                lines.extend(self.render_value(values, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self.label_values(labels), 0)
+
+    def render_value(self, values, value):
+        return [f"{self.name}{format_labels(self.labelnames, values)} {format_value(value)}"]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = {'counts':[0]*len(self.buckets), 'sum':0.0, 'count':0}
+            h = self.values[key]
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    h['counts'][i] += 1
+                    break
+            h['sum']   += value
+            h['count'] += 1
+
+    def get(self, **labels):
+        """Return (count, sum) for the labels"""
+        h = self.values.get(self.label_values(labels))
+        return (h['count'], h['sum']) if h else (0, 0.0)
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time()-t0, **labels)
+
+    def render_value(self, values, h):
+        lines = []
+        cumulative = 0
+        for (bound, count) in zip(self.buckets, h['counts']):
+            cumulative += count
+            le = 'le="' + format_value(bound) + '"'
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, values, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(self.labelnames, values)} {format_value(h['sum'])}")
+        lines.append(f"{self.name}_count{format_labels(self.labelnames, values)} {h['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.add(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        """Return all of the metrics in the Prometheus text format"""
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return "\n".join(lines) + "\n"
+
+
+################################################################
+### Per-request timing
+
+class RequestTiming:
+    """The timing of the request being handled by this thread"""
+    def __init__(self, endpoint, phase_histogram=None):
+        self.endpoint        = endpoint
+        self.phase_histogram = phase_histogram
+        self.t0              = time.time()
+        self.phases          = {}
+
+    def elapsed(self):
+        return time.time() - self.t0
+
+_current = threading.local()
+
+def current_request():
+    return getattr(_current, 'request', None)
+
+@contextmanager
+def request(endpoint, phase_histogram=None):
+    """Time a request. Phases timed with phase() while it is active are attributed to it."""
+    with resume(RequestTiming(endpoint, phase_histogram)) as timing:
+        yield timing
+
+@contextmanager
+def resume(timing):
+    """Make timing the current request again, e.g. while a streamed response of the request is generated
+    after its handler has returned"""
+    previous = current_request()
+    _current.request = timing
+    try:
+        yield timing
+    finally:
+        _current.request = previous
+
+@contextmanager
+def phase(name):
+    """Time a phase of the current request. Does nothing but time if there is no current request."""
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        timing = current_request()
+        if timing is not None:
+            elapsed = time.time() - t0
+            timing.phases[name] = timing.phases.get(name, 0.0) + elapsed
+            if timing.phase_histogram is not None:
+                timing.phase_histogram.observe(elapsed, endpoint=timing.endpoint, phase=name)
@@ -0,0 +1,171 @@
+"""
+Metadata plugins, which see the contents of a file as it is hashed.
+
+A plugin extracts metadata from the contents of a file without reading the file again. Hasher gives
+each block that it hashes to a PluginPipeline, which gives it to every plugin that still wants data,
+so a multi-GB local file or S3 object is read once for its digests and all of its metadata. The
+metadata of every plugin is merged and stored in the observation as FILE_CONTENT.
+
+A plugin is a class, or any callable, that is called with no arguments for each file and returns an
+object with two methods:
+- update(block) is called with each block of the file, in order. It returns False when the plugin
+  has all that it needs, and it is then given no more blocks.
+- result() returns a dictionary of metadata, after the last block or after update() returned False.
+
+Plugins are registered by name, with register() or with an entry point in the 'dvs.plugins' group:
+
+    [project.entry-points."dvs.plugins"]
+    my_plugin = "my_package.my_module:MyPlugin"
+
+No plugins run unless they are enabled, with enable() or with DVS_PLUGINS, which is a comma-separated
+list of names, or 'all'. Plugins change the observations, and so the hexhashes, of the files they see.
+An observation that is reused from the server instead of hashing the file is only used when no plugins
+are enabled, so that the same file gives the same observation whether or not it was hashed.
+"""
+
+import os
+import hashlib
+import logging
+
+from .dvs_constants import *
+
+ENTRY_POINT_GROUP = 'dvs.plugins'
+ALL_PLUGINS       = 'all'
+FINGERPRINT_BYTES = 64*1024
+# The errors that a plugin that fails on a file may raise. The plugin is dropped and the file is still registered.
+PLUGIN_ERRORS     = (ArithmeticError, AttributeError, LookupError, OSError, TypeError, ValueError)
+
+
+class FingerprintPlugin:
+    """The SHA1 of the first FINGERPRINT_BYTES of a file, which identifies a large file cheaply"""
+    def __init__(self):
+        self.hash  = hashlib.sha1()
+        self.count = 0
+
+    def update(self, block):
+        take = block[0:FINGERPRINT_BYTES - self.count]
+        self.hash.update(take)
+        self.count += len(take)
+        return self.count < FINGERPRINT_BYTES
+
+    def result(self):
+        return {'first64k_sha1':self.hash.hexdigest()}
+
+
+class HeaderDigestsPlugin:
+    """Separate SHA1s of the header of a file, which is the lines at its start that begin with '#',
+    and of the data that follows it. Files that differ only in their headers have the same data digest."""
+    def __init__(self):
+        self.header     = hashlib.sha1()
+        self.data       = hashlib.sha1()
+        self.in_header  = True
+        self.line_start = True      # the next byte starts a line
+        self.header_bytes = 0
+
+    def update(self, block):
+        pos = 0
+        while self.in_header and pos < len(block):
+            if self.line_start and block[pos:pos+1] != b'#':
+                self.in_header = False
+                break
+            nl = block.find(b'\n', pos)
+            self.line_start = nl >= 0
+            pos = nl + 1 if nl >= 0 else len(block)
+        self.header.update(block[0:pos])
+        self.header_bytes += pos
+        self.data.update(block[pos:])
+        return True
+
+    def result(self):
+        return {'header_sha1':self.header.hexdigest(), 'header_bytes':self.header_bytes, 'data_sha1':self.data.hexdigest()}
+
+
+_registry = {'fingerprint':FingerprintPlugin, 'header_digests':HeaderDigestsPlugin}
+_loaded   = False
+_enabled  = None
+_unknown  = set()
+
+
+def register(name, factory):
+    """Register a plugin. A plugin with the same name, including a built-in one, is replaced."""
+    _registry[name] = factory
+
+
+def registered():
+    """Return {name:factory} for the built-in plugins, the plugins registered with register(),
+    and the plugins of the installed packages' entry points"""
+    global _loaded
+    if not _loaded:
+        _loaded = True
+        from importlib.metadata import entry_points
+        eps = entry_points()
+        eps = eps.select(group=ENTRY_POINT_GROUP) if hasattr(eps, 'select') else eps.get(ENTRY_POINT_GROUP, [])
+        for ep in eps:
+            if ep.name in _registry:
+                continue
+            try:
+                _registry[ep.name] = ep.load()
+            except (ImportError, AttributeError) as e:     # a broken plugin must never stop files from being registered
+                logging.error("cannot load plugin %s: %s", ep.name, e)
+    return dict(_registry)
+
+
+def enable(names):
+    """Run the plugins in names, a list or comma-separated string of names or 'all', when files are hashed.
+    None or an empty list disables them."""
+    global _enabled
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(',') if name.strip()]
+    _enabled = list(names or [])
+
+
+def enabled():
+    """Return the names of the enabled plugins. Default is the names in DVS_PLUGINS."""
+    if _enabled is None:
+        enable(os.environ.get(DVS_PLUGINS_ENV, ''))
+    if ALL_PLUGINS in _enabled:
+        return sorted(registered())
+    return list(_enabled)
+
+
+class PluginPipeline:
+    """The instances of a set of plugins that are looking at one file"""
+    def __init__(self, factories):
+        self.active   = {name:factory() for (name, factory) in factories.items()}
+        self.finished = {}
+
+    def update(self, block):
+        """Give block to each plugin that still wants data"""
+        for (name, plugin) in list(self.active.items()):
+            try:
+                more = plugin.update(block)
+            except PLUGIN_ERRORS as e:
+                logging.error("plugin %s failed: %s", name, e)
+                del self.active[name]
+                continue
+            if more is False:
+                self.finished[name] = self.active.pop(name)
+
+    def result(self):
+        """Return the merged metadata of every plugin that did not fail"""
+        ret = {}
+        for (name, plugin) in {**self.finished, **self.active}.items():
+            try:
+                ret.update(plugin.result())
+            except PLUGIN_ERRORS as e:
+                logging.error("plugin %s failed: %s", name, e)
+        return ret
+
+
+def plugin_pipeline(names=None):
+    """Return a PluginPipeline for one file, with the plugins in names or the enabled plugins,
+    or None if there are none"""
+    names = enabled() if names is None else names
+    if not names:
+        return None
+    plugins = registered()
+    unknown = [name for name in names if name not in plugins and name not in _unknown]
+    if unknown:
+        logging.warning("unknown plugins: %s", ", ".join(unknown))
+        _unknown.update(unknown)
+    return PluginPipeline({name:plugins[name] for name in names if name in plugins})
@@ -0,0 +1,177 @@
+"""
+Packed writes to the object cache.
+
+When DVS_OBJECT_CACHE is set, DVS.commit() stores each commit in the object cache instead of sending it
+to the server. Storing every commit as its own blob takes one S3 PUT per commit, and a large commit has
+one child commit for every MAX_OBJECTS_LIST objects. PackWriter instead appends each commit to a local
+spool file and uploads the spool as a pack when it is large or old enough, or when the program exits.
+
+A pack is stored as two blobs named with object_cache_key():
+- NAME.pack has one line for each commit, "hexhash canonical_json" (the format of object_lines()), where
+  canonical_json is the JSON of {API_OBJECTS:..., API_COMMIT:...} and hexhash is its SHA1. The same bytes
+  are hashed and stored.
+- NAME.idx is {'source':'dvs', 'pack':NAME.pack, 'blobs':{hexhash:[offset, length]}}, giving where the
+  canonical JSON of each commit is in the pack. It is written after the pack, so a pack is complete
+  once its index exists.
+
+A pack is named by the time that it is uploaded, not the time of its commits, so that a reader that
+follows the object cache by name (daemon/batch.py --follow) sees every pack after the last one it read.
+
+Durability: DVS.commit() returns the hexhash of a commit once it is in the spool, before it is uploaded.
+The spool is kept in DEFAULT_SPOOL_DIR, in the user's home directory, so that it survives a reboot.
+Spool files that were left by a program that exited without uploading them are uploaded by the next
+PackWriter for the same location on the same host. A program that must know that its commits are stored
+should call flush_all() before it reports them.
+"""
+
+import os
+import re
+import json
+import atexit
+import hashlib
+import logging
+import time
+import threading
+
+from .dvs_constants import *
+from .dvs_helpers   import object_cache_key,parse_object_lines,hexhash_string
+from .observations  import get_bucket_key
+
+PACK_SUFFIX  = '.pack'
+INDEX_SUFFIX = '.idx'
+DEFAULT_PACK_BYTES   = 64*1024*1024     # upload the spool when it is this large
+DEFAULT_PACK_SECONDS = 60               # or when its first commit is this old
+DEFAULT_SPOOL_DIR    = '~/.cache/dvs/spool'
+SPOOL_NAME   = re.compile(r"^(\d+)-(\d+)\.spool$")
+
+_writers      = {}
+_writers_lock = threading.Lock()
+
+
+def pack_index(text):
+    """Return the {hexhash:[offset, length]} index of the text of a pack, which is in the object_lines format"""
+    index  = {}
+    offset = 0
+    for (hexhash, value) in parse_object_lines(text):
+        offset += len(hexhash) + 1
+        length  = len(value.encode('utf-8'))
+        index[hexhash] = [offset, length]
+        offset += length + 1
+    return index
+
+
+def pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class PackWriter:
+    """Append commits to a spool and upload them to the object cache as packs.
+    :param location: the object cache, an s3:// prefix or a local directory.
+    :param spool_dir: where to keep the spool. Default is $DVS_SPOOL_DIR or DEFAULT_SPOOL_DIR.
+    :param pack_bytes: upload the spool when it has at least this many bytes.
+    :param pack_seconds: upload the spool when its first commit has been waiting this many seconds.
+    """
+    def __init__(self, location, *, spool_dir=None, acl=None, pack_bytes=DEFAULT_PACK_BYTES, pack_seconds=DEFAULT_PACK_SECONDS):
+        self.location     = location.rstrip('/')
+        self.acl          = acl
+        self.pack_bytes   = pack_bytes
+        self.pack_seconds = pack_seconds
+        spool_dir         = os.path.expanduser(spool_dir or os.getenv(DVS_SPOOL_DIR_ENV) or DEFAULT_SPOOL_DIR)
+        # Each location has its own spool directory, so left-over spools are uploaded to the right place
+        self.spool_dir    = os.path.join(spool_dir, hexhash_string(self.location)[0:16])
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.lock         = threading.RLock()
+        self.seq          = 0
+        self.spool        = None
+        self.timer        = None
+        self.recover()
+
+    def spool_path(self):
+        return os.path.join(self.spool_dir, f"{os.getpid()}-{self.seq}.spool")
+
+    def add(self, data_bytes):
+        """Spool the canonical JSON of a commit's data. Returns its hexhash."""
+        hexhash = hashlib.sha1(data_bytes).hexdigest()
+        with self.lock:
+            if self.spool is None:
+                self.seq  += 1
+                self.spool = open(self.spool_path(), 'wb')
+                self.timer = threading.Timer(self.pack_seconds, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+            self.spool.write(hexhash.encode('ascii') + b' ' + data_bytes + b'\n')
+            if self.spool.tell() >= self.pack_bytes:
+                self.flush()
+        return hexhash
+
+    def flush(self):
+        """Upload the spool, if there is one"""
+        with self.lock:
+            if self.spool is None:
+                return
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            path = self.spool.name
+            self.spool.close()
+            self.spool = None
+            self.upload(path)
+
+    def upload(self, path):
+        """Upload the spool file at path as a pack and its index, then remove it"""
+        with open(path, 'rb') as f:
+            body = f.read()
+        # A program that was killed while writing may have left a partial line
+        body = body[0:body.rfind(b'\n')+1]
+        if body:
+            name  = object_cache_key(hashlib.sha1(body).hexdigest(), time.time())
+            index = {'source':'dvs', 'pack':name + PACK_SUFFIX, 'blobs':pack_index(body.decode('utf-8'))}
+            self.put(name + PACK_SUFFIX, body)
+            self.put(name + INDEX_SUFFIX, json.dumps(index).encode('utf-8'))
+            logging.info("uploaded %d commits in %s%s", len(index['blobs']), name, PACK_SUFFIX)
+        os.unlink(path)
+
+    def put(self, name, body):
+        if self.location.startswith(DVS_S3_PREFIX):
+            import boto3
+            (bucket, prefix) = get_bucket_key(self.location + '/' + name)
+            args = {'ACL':self.acl} if self.acl else {}
+            boto3.client('s3').put_object(Bucket=bucket, Key=prefix, Body=body, **args)
+        else:
+            path = os.path.join(self.location, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(body)
+            os.replace(path + '.tmp', path)
+
+    def recover(self):
+        """Upload the spools left by programs that are no longer running"""
+        for name in os.listdir(self.spool_dir):
+            m = SPOOL_NAME.match(name)
+            if m and int(m.group(1))!=os.getpid() and not pid_running(int(m.group(1))):
+                logging.warning("uploading spool %s left by process %s", name, m.group(1))
+                try:
+                    self.upload(os.path.join(self.spool_dir, name))
+                except (OSError, ValueError) as e:
+                    logging.error("cannot upload spool %s: %s", name, e)
+
+
+def pack_writer(location, acl=None):
+    """Return the PackWriter for location, creating it the first time. Writers are flushed at exit."""
+    with _writers_lock:
+        if location not in _writers:
+            _writers[location] = PackWriter(location, acl=acl)
+        return _writers[location]
+
+
+@atexit.register
+def flush_all():
+    """Upload every spool"""
+    for writer in list(_writers.values()):
+        writer.flush()
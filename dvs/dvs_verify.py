@@ -0,0 +1,162 @@
+"""
+Verify that local files still match the observations that DVS recorded for them.
+
+The recorded observations are fetched from the server in bulk, for a list of paths or for every
+file in a commit and its child commits. Each file is then checked in two passes:
+1. A stat pass. A file that is missing, or whose size differs, is reported without being read.
+   A file whose size and mtime both match is reported OK, unless a full check is requested.
+2. A hash pass, on a thread pool, for the files whose mtime changed (and for every file with full=True).
+   The file is OK if its digests match the recorded ones.
+A file that cannot be stat'ed or read is reported VERIFY_ERROR, with the reason, and the others are still checked.
+"""
+
+import os
+import time
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .dvs_constants import *
+from .dvs_helpers   import hash_file,escape_like
+
+VERIFY_OK      = 'OK'
+VERIFY_CHANGED = 'CHANGED'
+VERIFY_MISSING = 'MISSING'
+VERIFY_UNKNOWN = 'UNKNOWN'      # there is no recorded observation of the path
+VERIFY_ERROR   = 'ERROR'        # the file cannot be read, e.g. for lack of permission
+LINK_ROLES     = [COMMIT_BEFORE, COMMIT_METHOD, COMMIT_AFTER]
+# Observations recorded before hash_filehandle was fixed have the digests of empty input for SHA256 and SHA512.
+# Such a digest of a file that is not empty is ignored.
+EMPTY_DIGESTS  = {SHA256:hashlib.sha256(b'').hexdigest(), SHA512:hashlib.sha512(b'').hexdigest()}
+
+
+def observation_path(obj):
+    """Return the local path of a file observation, or None if it is not a local file"""
+    if not isinstance(obj, dict) or FILE_HASHES not in obj or DIRNAME not in obj or FILENAME not in obj:
+        return None
+    if str(obj.get(HOSTNAME,'')).startswith(DVS_S3_PREFIX):
+        return None
+    return os.path.join(obj[DIRNAME], obj[FILENAME])
+
+
+def get_objects(dc, hexhashes):
+    """Fetch {hexhash:object} from the server, MAX_SEARCH_OBJECTS at a time"""
+    hexhashes = list(hexhashes)
+    objects   = {}
+    for offset in range(0, len(hexhashes), MAX_SEARCH_OBJECTS):
+        group = hexhashes[offset:offset+MAX_SEARCH_OBJECTS]
+        for result in dc.search([{HEXHASH:hexhash} for hexhash in group]):
+            for row in result[RESULTS]:
+                if row[HEXHASH]==result[SEARCH][HEXHASH]:
+                    objects[row[HEXHASH]] = row[OBJECT]
+    return objects
+
+
+def recorded_for_commit(dc, hexhash, roles=LINK_ROLES):
+    """Return {path:observation} for the local files in the commit hexhash and in its child commits.
+    :param roles: follow only these links, e.g. [COMMIT_AFTER] for the files that a commit produced."""
+    recorded = {}
+    seen     = set()
+    todo     = [hexhash]
+    while todo:
+        seen.update(todo)
+        objects = get_objects(dc, todo)
+        missing = set(todo) - set(objects)
+        if missing:
+            logging.warning("%d objects are not on the server, e.g. %s", len(missing), sorted(missing)[0])
+        todo = []
+        for obj in objects.values():
+            if not isinstance(obj, dict):
+                continue
+            path = observation_path(obj)
+            if path is not None:
+                recorded[path] = obj
+            todo.extend([h for role in roles for h in obj.get(role,[]) if h not in seen])
+        todo = sorted(set(todo))
+    return recorded
+
+
+def recorded_for_paths(dc, paths):
+    """Return {path:observation} with the most recent observation of each of the local paths that has one"""
+    paths    = [os.path.abspath(path) for path in paths]
+    recorded = {}
+    for offset in range(0, len(paths), MAX_SEARCH_OBJECTS):
+        group = paths[offset:offset+MAX_SEARCH_OBJECTS]
+        searches = [{DIRNAME:escape_like(os.path.dirname(path)), FILENAME:escape_like(os.path.basename(path))} for path in group]
+        for (path, result) in zip(group, dc.search(searches)):
+            rows = [row for row in result[RESULTS] if observation_path(row[OBJECT])==path]
+            if rows:
+                recorded[path] = max(rows, key=lambda row:(str(row.get(CREATED)), row.get(OBJECTID) or 0))[OBJECT]
+    return recorded
+
+
+def stat_check(path, obj, full=False, st=None):
+    """The stat pass. Returns (status, reason), or None if the file must be hashed.
+    :param st: the os.stat_result of path, if it is already known."""
+    if st is None:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return (VERIFY_MISSING, "")
+        except OSError as e:
+            return (VERIFY_ERROR, e.strerror or str(e))
+    metadata = obj.get(FILE_METADATA,{})
+    if ST_SIZE in metadata and st.st_size != metadata[ST_SIZE]:
+        return (VERIFY_CHANGED, f"size {st.st_size} was {metadata[ST_SIZE]}")
+    if full:
+        return None
+    if ST_MTIME_NS in metadata:
+        if st.st_mtime_ns == metadata[ST_MTIME_NS]:
+            return (VERIFY_OK, "stat")
+    elif ST_MTIME in metadata and int(st.st_mtime) == int(metadata[ST_MTIME]):
+        return (VERIFY_OK, "stat")
+    return None
+
+
+def hash_check(path, obj):
+    """The hash pass. Returns (status, reason, bytes hashed)."""
+    try:
+        hashes = hash_file(path)
+        nbytes = os.path.getsize(path)
+    except FileNotFoundError:
+        return (VERIFY_MISSING, "", 0)
+    except OSError as e:
+        return (VERIFY_ERROR, e.strerror or str(e), 0)
+    recorded = {alg:digest for (alg, digest) in obj.get(FILE_HASHES,{}).items()
+                if not (nbytes > 0 and EMPTY_DIGESTS.get(alg)==digest)}
+    common   = [alg for alg in (SHA1, SHA256, SHA512, MD5) if alg in recorded and alg in hashes]
+    if not common:
+        return (VERIFY_UNKNOWN, "no recorded hashes", nbytes)
+    for alg in common:
+        if hashes[alg] != recorded[alg]:
+            return (VERIFY_CHANGED, f"{alg} {hashes[alg]} was {recorded[alg]}", nbytes)
+    return (VERIFY_OK, "hash", nbytes)
+
+
+def verify(recorded, *, paths=(), threads=DEFAULT_THREADS, full=False):
+    """Check the files in recorded, {path:observation}.
+    :param paths: paths that were asked about; those without a recorded observation are reported VERIFY_UNKNOWN.
+    :param full: hash every file, even when its size and mtime match.
+    Returns (results, stats), where results is a list of (path, status, reason) sorted by path,
+    and stats counts the files with each status, the files and bytes hashed, and the seconds taken.
+    """
+    t0      = time.time()
+    results = [(os.path.abspath(path), VERIFY_UNKNOWN, "not recorded")
+               for path in paths if os.path.abspath(path) not in recorded]
+    to_hash = []
+    for (path, obj) in recorded.items():
+        check = stat_check(path, obj, full)
+        if check is None:
+            to_hash.append(path)
+        else:
+            results.append((path, *check))
+
+    stats = {'hashed':len(to_hash), 'bytes':0}
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for (path, (status, reason, nbytes)) in zip(to_hash, pool.map(lambda path: hash_check(path, recorded[path]), to_hash)):
+            results.append((path, status, reason))
+            stats['bytes'] += nbytes
+    for status in (VERIFY_OK, VERIFY_CHANGED, VERIFY_MISSING, VERIFY_UNKNOWN, VERIFY_ERROR):
+        stats[status] = len([r for r in results if r[1]==status])
+    stats['seconds'] = time.time() - t0
+    return (sorted(results), stats)
@@ -18,6 +18,10 @@ class DVSGitException(DVSClientError):
     """Exceptions generated by running the git command line client"""
     pass
 
+class DVSCopyError(DVSClientError):
+    """The destination of a copy does not match what was copied"""
+    pass
+
 class DVSTooManyObjects(DVSClientError):
     """Too many objects in COMMIT_BEFORE, COMMIT_METHOD or COMMIT_AFTER and OPTION_AUTO_SUB_COMMIT not set"""
     pass
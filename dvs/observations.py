@@ -7,23 +7,19 @@ import datetime
 import requests
 import json
 import sys
-import boto3
-import botocore
 import time
 import shutil
-import subprocess
 import socket
 import copy
-from multiprocessing import Pool
 """
 Routines for getting observations.
 """
 
 from .dvs_constants import *
 from .dvs_helpers  import *
-from .server import MAX_SEARCH_OBJECTS
 from .exceptions import DVSServerError
 from .dvs_helpers import dvs_debug_obj_str
+from .dvs_plugins import plugin_pipeline,enabled as enabled_plugins
 
 
 DEFAULT_THREADS=20
@@ -111,9 +107,23 @@ def clean_etag(etag):
     return etag
 
 
+def s3_error(s3path, e):
+    """Return the OSError for the botocore ClientError e on s3path, so that callers that skip paths that
+    cannot be read, such as DVS.add_manifest, also skip S3 objects that are missing or forbidden"""
+    code = str(e.response.get('Error',{}).get('Code'))
+    if code in ('404', 'NoSuchKey'):
+        return FileNotFoundError(s3path)
+    if code in ('403', 'AccessDenied'):
+        return PermissionError(f"{s3path}: {e}")
+    return OSError(f"{s3path}: {e}")
+
+
 def s3path_to_s3obj(s3path):
     """Given an s3path, return a tuple of (s3path, s3obj). Designed to be parallelized with python multiprocessing library.
-    :param s3path: the s3path, including s3://"""
+    :param s3path: the s3path, including s3://
+    Raises an OSError from s3_error if the object cannot be read."""
+    import boto3
+    import botocore
     (bucket,key) = get_bucket_key(s3path)
     try:
         # Get and return the object, validating that it exists
@@ -121,9 +131,7 @@ def s3path_to_s3obj(s3path):
         assert s3obj.content_length >= 0
         return s3obj
     except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code']=='404':
-            raise FileNotFoundError(s3path)
-        raise(e)
+        raise s3_error(s3path, e) from e
 
 
 def s3obj_to_s3path(s3obj):
@@ -164,26 +172,46 @@ def hash_s3obj(s3obj):
     """hash_s3obj: given an s3object, return an DVS observation including a hash."""
     if debug_hash_every_s3path:
         print(f"PID {os.getpid()} S3 Hashing s3://{bucket}/{key} {s3obj.content_length:,} bytes...",file=sys.stderr)
-    hashes = hash_filehandle(s3obj.get()['Body'])
-    return {HOSTNAME: DVS_S3_PREFIX + s3obj.Bucket().name,
-            DIRNAME:  os.path.dirname( s3obj.key),
-            FILENAME: os.path.basename( s3obj.key),
-            FILE_METADATA: {ST_SIZE  : s3obj.content_length,
-                            ST_MTIME : int(s3obj.last_modified.timestamp()),
-                            ETAG     : clean_etag(s3obj.e_tag)},
+    plugins = plugin_pipeline()
+    hashes  = hash_filehandle(s3obj.get()['Body'], plugins)
+    return add_content(s3_observation(bucket=s3obj.Bucket().name, key=s3obj.key, size=s3obj.content_length,
+                                      mtime=s3obj.last_modified, etag=s3obj.e_tag, hashes=hashes), plugins)
+
+
+def s3_observation(*, bucket, key, size, mtime, etag, hashes):
+    """Return the DVS observation of an S3 object.
+    :param mtime: the LastModified datetime of the object.
+    :param etag: the ETag of the object, with or without its quotes.
+    """
+    return {HOSTNAME: DVS_S3_PREFIX + bucket,
+            DIRNAME:  os.path.dirname( key),
+            FILENAME: os.path.basename( key),
+            FILE_METADATA: {ST_SIZE  : size,
+                            ST_MTIME : int(mtime.timestamp()),
+                            ETAG     : clean_etag(etag)},
             FILE_HASHES: hashes}
 
 
 def hash_s3path(s3path):
+    import botocore
     error = None
     for retry_count in range(MAX_HTTP_RETRIES):
         try:
             return hash_s3obj( s3path_to_s3obj( s3path ))
+        except botocore.exceptions.ClientError as e:
+            raise s3_error(s3path, e) from e
         except urllib3.exceptions.ProtocolError as e:
             error = e
             continue
-    print(f"s3path={s3path} e={str(e)}",file=sys.stderr)
-    raise e
+    print(f"s3path={s3path} e={str(error)}",file=sys.stderr)
+    raise error
+
+
+def get_path_observation(path):
+    """Return the observation, with hashes, of a local path or an s3:// path"""
+    if path.startswith(DVS_S3_PREFIX):
+        return hash_s3path(path)
+    return get_file_observation_with_hash(os.path.abspath(path))
 
 
 def get_s3objs_observations(s3objs:list, *, search_endpoint:str, verify=DEFAULT_VERIFY, threads=DEFAULT_THREADS):
@@ -287,6 +315,7 @@ def get_s3objs_observations(s3objs:list, *, search_endpoint:str, verify=DEFAULT_
     logging.info("Parallel hashing of remaining %s s3 objects",len(s3objs_to_hash))
     if debug_hash_every_s3prefix:
         print("Parallel hashing of %s files with %d threads" % (len(s3objs_to_hash), threads),file=sys.stderr)
+    from multiprocessing import Pool
     with Pool(threads) as p:
         s3file_observations.extend( p.map(hash_s3path,
                                           [s3obj_to_s3path(s3obj) for s3obj in s3objs_to_hash] ))
@@ -320,6 +349,10 @@ def get_file_observations(paths:list, *, search_endpoint:str, verify=DEFAULT_VER
         logging.debug("will not search")
         results_by_path = {}
 
+    elif enabled_plugins():
+        logging.debug("will not search; the metadata plugins must see every file")
+        results_by_path = {}
+
     elif DVS_OBJECT_CACHE_ENV in os.environ:
         logging.debug("Will not search remote cache")
         results_by_path = {}
@@ -360,7 +393,7 @@ def get_file_observations(paths:list, *, search_endpoint:str, verify=DEFAULT_VER
                     objr.get(FILE_METADATA,None) == metadata_for_path[path] and
                     FILE_HASHES in objr):
                     logging.info("using hash from server for %s ",path)
-                    obj = {**objr, **get_file_observation(path)}
+                    obj = {**get_file_observation(path), FILE_HASHES:objr[FILE_HASHES]}
                 logging.debug("does not match %s",dvs_debug_obj_str(objr))
         if obj is None:
             logging.debug("Could not find hash; hashing file")
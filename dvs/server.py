@@ -12,7 +12,7 @@ import json
 import warnings
 import time
 import logging
-import socket
+import functools
 
 ###
 # Get 'ctools' into the path.
@@ -25,7 +25,12 @@ from ctools import tydoc
 
 
 from .dvs_constants import *
-from .dvs_helpers import is_hexadecimal,canonical_json,hexhash_string,comma_args,objects_dict
+from .dvs_helpers import is_hexadecimal,is_hexhash,canonical_json,hexhash_string,comma_args,objects_dict
+from .dvs_helpers import hexhash_to_bin,bin_to_hexhash,hex_prefix_range
+from .dvs_helpers import check_objects,parse_object_lines
+from .dvs_cache   import LRUCache,ObjectCache,ReverseDNSCache,shared_cache_from_env,DEFAULT_CACHE_ITEMS,DEFAULT_CACHE_BYTES
+from .            import dvs_metrics
+from .dvs_compress import compress,decompress,have_zstd,train_dictionary,ZFORMATS,ZFORMAT_ZLIB,ZFORMAT_ZSTD
 
 ###
 ### v2 object-based API
@@ -33,70 +38,503 @@ from .dvs_helpers import is_hexadecimal,canonical_json,hexhash_string,comma_args
 
 
 MAX_DUMP_OBJECTS   = 1000
-MAX_SEARCH_OBJECTS = 1000
 MAX_SEARCH_RESULTS = 100
+DUMP_BATCH_SIZE    = 1000       # rows fetched per keyset query when streaming a v2 dump
+MAX_LINK_RESULTS   = 10000
+LINKS_PER_INSERT   = 500
+LINK_ROLES         = [COMMIT_BEFORE, COMMIT_METHOD, COMMIT_AFTER]
+DEFAULT_LINEAGE_DEPTH = 10
+MAX_LINEAGE_DEPTH  = 100
+LINEAGE_CACHE_ITEMS = 1000
+LINEAGE_CACHE_TTL  = 300        # seconds
+
+SEARCH_CACHE_ITEMS = 10_000
+SEARCH_CACHE_TTL   = 30         # seconds; search results can change as objects are added
+GC_BATCH_SIZE      = 100        # objects deleted by each garbage collector statement
+VALIDATE_PARALLEL_OBJECTS = 500 # commits with at least this many objects are validated in a process pool
+VALIDATE_CHUNK_SIZE = 250       # objects validated by each task in the pool
+
+# Objects never change once they are stored, so they can be cached indefinitely.
+# Search results are cached briefly, and the cache is cleared when this process stores a new object.
+object_cache = ObjectCache(LRUCache(max_items=int(os.environ.get(DVS_SERVER_CACHE_ITEMS_ENV, DEFAULT_CACHE_ITEMS)),
+                                    max_bytes=int(os.environ.get(DVS_SERVER_CACHE_BYTES_ENV, DEFAULT_CACHE_BYTES))),
+                           shared=shared_cache_from_env())
+search_cache = LRUCache(max_items=SEARCH_CACHE_ITEMS, ttl=SEARCH_CACHE_TTL, sizeof=lambda v:1)
+
+# Lineage graphs only change when a new commit links to an object in them,
+# so they are cached until this process stores a link, or for LINEAGE_CACHE_TTL.
+lineage_cache = LRUCache(max_items=LINEAGE_CACHE_ITEMS, ttl=LINEAGE_CACHE_TTL, sizeof=lambda v:1)
+
+# Reverse DNS runs on background threads so that a slow resolver never holds up a commit.
+reverse_dns = ReverseDNSCache()
 
-def do_v2search(auth, *, search, debug=False):
+###
+### Instrumentation. The metrics are served in the Prometheus text format by metrics_api.
+###
+
+registry        = dvs_metrics.Registry()
+REQUESTS        = registry.counter('dvs_requests_total', 'Requests handled', ['endpoint','status'])
+REQUEST_SECONDS = registry.histogram('dvs_request_seconds', 'Time to handle a request, including streaming the response', ['endpoint'])
+PHASE_SECONDS   = registry.histogram('dvs_request_phase_seconds', 'Time spent in each phase of a request', ['endpoint','phase'])
+REQUEST_BYTES   = registry.counter('dvs_request_bytes_total', 'Bytes received in request bodies', ['endpoint'])
+RESPONSE_BYTES  = registry.counter('dvs_response_bytes_total', 'Bytes sent in response bodies', ['endpoint'])
+SQL_SECONDS     = registry.histogram('dvs_sql_seconds', 'Time to execute a SQL statement', ['statement'])
+SQL_ROWS        = registry.counter('dvs_sql_rows_total', 'Rows returned by SQL statements', ['statement'])
+
+def csfr(auth, statement, cmd, vals=None, **kwargs):
+    """Execute cmd with dbfile.DBMySQL.csfr, recording its time and row count under the statement name"""
+    with SQL_SECONDS.time(statement=statement):
+        rows = dbfile.DBMySQL.csfr(auth, cmd, vals, **kwargs)
+    SQL_ROWS.inc(len(rows) if isinstance(rows,(list,tuple)) else 0, statement=statement)
+    return rows
+
+def slow_request_seconds():
+    """Requests that take longer than this are logged, or None if DVS_SLOW_REQUEST_ENV is not set"""
+    try:
+        return float(os.environ[DVS_SLOW_REQUEST_ENV])
+    except (KeyError, ValueError):
+        return None
+
+def finish_request(timing, response_bytes, status):
+    elapsed = timing.elapsed()
+    REQUESTS.inc(endpoint=timing.endpoint, status=status)
+    REQUEST_SECONDS.observe(elapsed, endpoint=timing.endpoint)
+    RESPONSE_BYTES.inc(response_bytes, endpoint=timing.endpoint)
+    slow = slow_request_seconds()
+    if slow is not None and elapsed > slow:
+        logging.warning("slow request: %s %.3fs response_bytes=%d phases=%s", timing.endpoint, elapsed, response_bytes,
+                        " ".join([f"{name}={t:.3f}" for (name,t) in timing.phases.items()]))
+
+def stream_with_timing(timing, chunks, status):
+    """Pass through a streamed response, finishing the request's timing when the last chunk is sent.
+    Each chunk is generated with the request current, so that the phases of the generator, such as the
+    database queries of a lineage, are attributed to it. A response that fails part way is recorded with status 500."""
+    response_bytes = 0
+    t0 = time.time()
+    chunks = iter(chunks)
+    finished = False
+    try:
+        while True:
+            with dvs_metrics.resume(timing):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            response_bytes += len(chunk)
+            try:
+                yield chunk
+            except GeneratorExit:       # the client went away; the response did not fail
+                finished = True
+                raise
+        finished = True
+    finally:
+        elapsed = time.time()-t0
+        timing.phases['stream'] = elapsed
+        PHASE_SECONDS.observe(elapsed, endpoint=timing.endpoint, phase='stream')
+        finish_request(timing, response_bytes, status if finished else 500)
+
+def instrumented(endpoint):
+    """Decorator for the bottle API functions. Records the latency, request and response sizes of each request,
+    and makes the request current so that dvs_metrics.phase() attributes its phases to the endpoint.
+    A request whose function raises is recorded with the status of the bottle.HTTPResponse it raised, or 500."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(auth):
+            import bottle
+            REQUEST_BYTES.inc(max(bottle.request.content_length,0), endpoint=endpoint)
+            with dvs_metrics.request(endpoint, PHASE_SECONDS) as timing:
+                status = 500
+                try:
+                    ret = func(auth)
+                    status = None
+                except bottle.HTTPResponse as e:
+                    status = e.status_code
+                    raise
+                finally:
+                    if status is not None:
+                        finish_request(timing, 0, status)
+            if isinstance(ret,(str,bytes)):
+                finish_request(timing, len(ret), bottle.response.status_code)
+                return ret
+            return stream_with_timing(timing, ret, bottle.response.status_code)
+        return wrapper
+    return decorator
+
+
+def cacheable(text):
+    """Ephemeral objects may be deleted by the garbage collector, which runs in another process and cannot
+    invalidate this process's cache. They are therefore never cached, so that an object in the cache is
+    always stored. Any text that mentions ATTRIBUTE_EPHEMERAL is treated as ephemeral."""
+    return bool(text) and f'"{ATTRIBUTE_EPHEMERAL}"' not in text
+
+def cache_texts(texts):
+    """Add {hexhash:text} to the object cache, leaving out objects that the garbage collector may delete"""
+    object_cache.set_many({hexhash:text for (hexhash, text) in texts.items() if cacheable(text)})
+
+def text_to_object(text):
+    """Objects are cached as their JSON text, and URLs as the URL. Return the object or the URL."""
+    return json.loads(text) if text.startswith('{') else text
+
+def row_text(row):
+    """Return the text to cache for a row from dvs_objects. MySQL does not return the JSON as it was stored,
+    so it is put back in canonical form; store_objects caches the same text."""
+    return canonical_json(json.loads(row[OBJECT])) if row[OBJECT] else row['url']
+
+def decode_object(row):
+    """Return a copy of a result row with its OBJECT decoded from the stored JSON text"""
+    return {**row, **{OBJECT:json.loads(row[OBJECT]) if row[OBJECT] else None}}
+
+def row_json(row):
+    """Return the JSON for a result row whose OBJECT is still the stored JSON text.
+    The object is spliced in as-is, so large objects are never decoded and re-encoded."""
+    rest = json.dumps({k:v for (k,v) in row.items() if k!=OBJECT}, default=str)
+    return rest[:-1] + (", " if len(rest)>2 else "") + f'"{OBJECT}": ' + (row.get(OBJECT) or "null") + "}"
+
+
+# Hashes are stored in binary, which makes the indexes a fraction of the size of hexadecimal text.
+# The hexhash is converted to and from binary here, at the API boundary.
+# The digest columns are (column, bytes, hash) and are filled from an object's hashes when it is stored.
+HASHBIN_BYTES  = 20
+DIGEST_COLUMNS = [('md5bin', 16, MD5),
+                  ('sha1bin', 20, SHA1),
+                  ('sha256bin', 32, SHA256),
+                  ('sha512bin', 64, SHA512)]
+# The text columns are (column, key, max length) and are filled from a commit when it is stored.
+# They have a FULLTEXT index, which is used by text searches.
+TEXT_COLUMNS   = [('commit_message', COMMIT_MESSAGE, None),
+                  ('commit_author', COMMIT_AUTHOR, 256),
+                  ('commit_dataset', COMMIT_DATASET, 256)]
+TEXT_MATCH     = "MATCH(" + ",".join([col for (col,key,maxlen) in TEXT_COLUMNS]) + ") AGAINST (%s IN NATURAL LANGUAGE MODE)"
+# Hostnames, dirnames, filenames, users and groups repeat across millions of observations, so they are
+# interned: each string is stored once in a lookup table and the object row holds its integer id.
+# The interned fields are removed from the stored JSON and put back by OBJECT_EXPR when the object is read,
+# so the API still returns, and hashes, the original object.
+# The interned fields are (column, path in the object, lookup table, name column).
+INTERNED_FIELDS = [('hostid',      (HOSTNAME,),                  'dvs_hostnames',  'hostname'),
+                   ('dirnameid',   (DIRNAME,),                   'dvs_dirnames',   'dirname'),
+                   ('filenameid',  (FILENAME,),                  'dvs_filenames',  'filename'),
+                   ('usernameid',  (FILE_METADATA,'pw_pwname'),  'dvs_usernames',  'username'),
+                   ('groupnameid', (FILE_METADATA,'gr_name'),    'dvs_groupnames', 'groupname')]
+MAX_INTERNED_LENGTH = 256       # longer names stay in the JSON
+UNUSED_PATH    = '$.__dvs_unused'
+
+def json_path(path):
+    return "$." + ".".join(path)
+
+# OBJECT_EXPR is the stored object with its interned fields restored. Each JSON_SET writes a field
+# if the object has an id for it, and writes UNUSED_PATH (which is then removed) if it does not.
+OBJECT_EXPR = "dvs_objects.object"
+for (col, path, table, name) in INTERNED_FIELDS:
+    OBJECT_EXPR = (f"JSON_SET({OBJECT_EXPR}, IF(dvs_objects.{col} IS NULL, '{UNUSED_PATH}', '{json_path(path)}'), "
+                   f"(SELECT {name} FROM {table} WHERE {table}.{col}=dvs_objects.{col}))")
+OBJECT_EXPR = f"JSON_REMOVE({OBJECT_EXPR}, '{UNUSED_PATH}')"
+
+# An object may instead be stored compressed in object_z, with object NULL. The compressed text is the
+# object's complete canonical JSON, and is decompressed by decode_row. Commits are never compressed,
+# so that their JSON can still be queried by KIND_WHERE.
+Z_COLUMNS      = "object_z,zformat,zdictid"
+OBJECT_COLUMNS = f"objectid,created,hashbin,{OBJECT_EXPR} AS object,url,{Z_COLUMNS}"
+INSERT_COLUMNS = (["hashbin","object","url"]
+                  + [col for (col,nbytes,name) in DIGEST_COLUMNS]
+                  + [col for (col,key,maxlen) in TEXT_COLUMNS]
+                  + [col for (col,path,table,name) in INTERNED_FIELDS]
+                  + ["st_size", "ephemeral", "names_in_json", "object_z", "zformat", "zdictid"])
+
+# Compression of newly stored objects is enabled by setting DVS_COMPRESS_ENV to zlib or zstd.
+# zstd uses the newest dictionary in dvs_zdicts, if there is one.
+STORE_ZFORMAT = ZFORMATS.get(os.environ.get(DVS_COMPRESS_ENV, ''))
+if STORE_ZFORMAT==ZFORMAT_ZSTD and not have_zstd():
+    warnings.warn(f"{DVS_COMPRESS_ENV}=zstd but zstandard is not installed; using zlib")
+    STORE_ZFORMAT = ZFORMAT_ZLIB
+ZDICT_TTL   = 3600              # seconds before checking for a newer zstd dictionary
+zdict_cache = LRUCache(max_items=100, sizeof=lambda v:1)
+zdict_current = LRUCache(max_items=1, ttl=ZDICT_TTL, sizeof=lambda v:1)
+
+def get_zdict(auth, zdictid):
+    """Return the zstd dictionary zdictid. Dictionaries never change, so they are cached."""
+    if zdictid is None:
+        return None
+    zdict = zdict_cache.get(zdictid)
+    if zdict is None:
+        rows = csfr(auth, 'zdict', "SELECT zdict FROM dvs_zdicts WHERE zdictid=%s", (zdictid,))
+        if not rows:
+            raise RuntimeError(f"zstd dictionary {zdictid} is not in dvs_zdicts")
+        zdict = bytes(rows[0][0])
+        zdict_cache.set(zdictid, zdict)
+    return zdict
+
+def current_zdictid(auth):
+    """Return the zdictid of the newest zstd dictionary, or None if there are none"""
+    zdictid = zdict_current.get('current')
+    if zdictid is None:
+        rows = csfr(auth, 'zdict', "SELECT MAX(zdictid) FROM dvs_zdicts")
+        zdictid = rows[0][0] if rows and rows[0][0] is not None else 0
+        zdict_current.set('current', zdictid)
+    return zdictid or None
+
+def store_zdict(auth, zdict):
+    """Store a zstd dictionary and make it the one that new objects are compressed with. Returns its zdictid."""
+    csfr(auth, 'zdict', "INSERT INTO dvs_zdicts (zdict) VALUES (%s)", (zdict,))
+    zdict_current.clear()
+    return current_zdictid(auth)
+
+def is_commit(obj):
+    return isinstance(obj,dict) and any(role in obj for role in (COMMIT_BEFORE, COMMIT_METHOD, COMMIT_AFTER))
+
+def compressible(obj):
+    """Commits are not compressed. Neither are objects with a name that cannot be interned, because
+    name searches would have to look in their JSON (see names_in_json)."""
+    if not isinstance(obj,dict) or is_commit(obj):
+        return False
+    values = [path_value(obj, path) for (col, path, table, name) in INTERNED_FIELDS]
+    return all(internable(value) for value in values if value is not None)
+
+def compressed_values(auth, text, zformat):
+    """Return [object_z, zformat, zdictid] for text compressed with zformat"""
+    zdictid = current_zdictid(auth) if zformat==ZFORMAT_ZSTD else None
+    return [compress(text, zformat, get_zdict(auth, zdictid)), zformat, zdictid]
+
+def decode_row(auth, row):
+    """Convert a row from dvs_objects into the form returned by the API, with a hexhash rather than hashbin,
+    and the object decompressed if it is stored compressed"""
+    row = dict(row)
+    if 'hashbin' in row:
+        row[HEXHASH] = bin_to_hexhash(row.pop('hashbin'))
+    if 'object_z' in row:
+        (object_z, zformat, zdictid) = (row.pop('object_z'), row.pop('zformat'), row.pop('zdictid'))
+        if object_z is not None:
+            row[OBJECT] = decompress(object_z, zformat, get_zdict(auth, zdictid))
+    return row
+
+def digest_bins(obj):
+    """Return a list with the binary value of each DIGEST_COLUMN for obj, or None where obj lacks that hash"""
+    hashes = obj.get(FILE_HASHES) if isinstance(obj,dict) else None
+    ret = []
+    for (col, nbytes, name) in DIGEST_COLUMNS:
+        try:
+            digest = hexhash_to_bin(hashes[name])
+        except (TypeError, KeyError, ValueError):
+            digest = None
+        ret.append(digest if digest is not None and len(digest)==nbytes else None)
+    return ret
+
+def text_values(obj):
+    """Return a list with the value of each TEXT_COLUMN for obj, or None where obj lacks that key"""
+    ret = []
+    for (col, key, maxlen) in TEXT_COLUMNS:
+        value = obj.get(key) if isinstance(obj,dict) else None
+        if value is not None and not isinstance(value,str):
+            value = canonical_json(value)
+        ret.append(value[0:maxlen] if (value is not None and maxlen is not None) else value)
+    return ret
+
+def internable(value):
+    """Lookup table names are ASCII with a binary collation, which ignores trailing spaces. Other values stay in the JSON."""
+    return (isinstance(value,str) and 0 < len(value) <= MAX_INTERNED_LENGTH
+            and value.isascii() and not value.endswith(" "))
+
+def path_value(obj, path):
+    """Return the value at path in obj, or None"""
+    for key in path:
+        obj = obj.get(key) if isinstance(obj,dict) else None
+    return obj
+
+def intern_names(obj):
+    """Return {column:name} for the fields of obj that can be interned"""
+    names = {}
+    if not isinstance(obj,dict):
+        return names
+    for (col, path, table, name) in INTERNED_FIELDS:
+        value = path_value(obj, path)
+        if internable(value):
+            names[col] = value
+    return names
+
+def names_in_json(obj, ids):
+    """Return 1 if obj has a name field that is not interned, so that name searches must look in its JSON.
+    Commits are never matched by name."""
+    if not isinstance(obj,dict) or is_commit(obj):
+        return 0
+    return 1 if any(path_value(obj, path) is not None and col not in ids
+                    for (col, path, table, name) in INTERNED_FIELDS) else 0
+
+def strip_interned(obj, ids):
+    """Return a copy of obj without the fields whose column is in ids"""
+    obj = dict(obj)
+    for (col, path, table, name) in INTERNED_FIELDS:
+        if col in ids:
+            if len(path)==1:
+                del obj[path[0]]
+            else:
+                obj[path[0]] = {k:v for (k,v) in obj[path[0]].items() if k!=path[1]}
+    return obj
+
+# Interned ids never change, so they are cached by (column, name)
+interned_cache = LRUCache(max_items=100_000, sizeof=lambda v:1)
+
+def intern_ids(auth, names_by_column):
+    """Return {(column,name):id} for every name, adding names that are not yet in the lookup tables.
+    :param names_by_column: {column:set of names}
+    A name that cannot be matched exactly is left out, so that its field stays in the JSON.
+    """
+    ret = {}
+    for (col, path, table, namecol) in INTERNED_FIELDS:
+        names   = names_by_column.get(col, set())
+        cached  = interned_cache.get_many([(col, name) for name in names])
+        ret.update(cached)
+        missing = [name for name in names if (col, name) not in cached]
+        if not missing:
+            continue
+        csfr(auth, 'intern', f"INSERT IGNORE INTO {table} ({namecol}) VALUES " + comma_args(1, rows=len(missing), parens=True),
+             missing)
+        rows = csfr(auth, 'intern', f"SELECT {col},{namecol} FROM {table} WHERE {namecol} IN " + comma_args(len(missing), parens=True),
+                    missing)
+        missing = set(missing)
+        found = {(col, row[1]):row[0] for row in rows if row[1] in missing}
+        interned_cache.set_many(found)
+        ret.update(found)
+    return ret
+
+def intern_objects(auth, objects):
+    """Intern the fields of the objects.
+    :param objects: {hexhash:object}
+    :return: {hexhash:(stripped object, {column:id})} for the objects that have interned fields
+    """
+    names = {hexhash:intern_names(obj) for (hexhash, obj) in objects.items()}
+    names_by_column = {}
+    for obj_names in names.values():
+        for (col, name) in obj_names.items():
+            names_by_column.setdefault(col, set()).add(name)
+    if not names_by_column:
+        return {}
+    ids = intern_ids(auth, names_by_column)
+    ret = {}
+    for (hexhash, obj_names) in names.items():
+        obj_ids = {col:ids[(col,name)] for (col,name) in obj_names.items() if (col,name) in ids}
+        if obj_ids:
+            ret[hexhash] = (strip_interned(objects[hexhash], obj_ids), obj_ids)
+    return ret
+
+def interned_values(ids):
+    """Return the interned id columns in INSERT_COLUMNS order"""
+    return [ids.get(col) for (col,path,table,name) in INTERNED_FIELDS]
+
+def st_size_value(obj):
+    metadata = obj.get(FILE_METADATA) if isinstance(obj,dict) else None
+    st_size  = metadata.get(ST_SIZE) if isinstance(metadata,dict) else None
+    return st_size if isinstance(st_size,int) else None
+
+def is_ephemeral(obj):
+    """Objects with ATTRIBUTE_EPHEMERAL may be deleted by the garbage collector; see gc_candidates"""
+    return isinstance(obj,dict) and str(obj.get(ATTRIBUTE_EPHEMERAL,'')).lower() in ('true','1','yes')
+
+def index_values(obj, ids=None):
+    """Return the values of the columns that are extracted from obj when it is stored, in INSERT_COLUMNS order,
+    up to the compression columns.
+    :param ids: {column:id} of the fields of obj that are interned."""
+    return (digest_bins(obj) + text_values(obj) + interned_values(ids or {})
+            + [st_size_value(obj), 1 if is_ephemeral(obj) else 0, names_in_json(obj, ids or {})])
+
+
+# SQL conditions for the object kinds that a v2 dump can be filtered by
+KIND_WHERE = {KIND_COMMIT: "(JSON_CONTAINS_PATH(object,'one','$.before','$.method','$.after'))",
+              KIND_FILE  : "(sha1bin IS NOT NULL)",
+              KIND_URL   : "(url IS NOT NULL)"}
+
+def text_cursor(row):
+    """Return the cursor that continues a text search after row"""
+    return f"{row[SCORE]!r}:{row[OBJECTID]}"
+
+
+def do_v2textsearch(auth, *, text, cursor=None, limit=MAX_SEARCH_RESULTS, raw=False, debug=False):
+    """Full-text search of commit messages, authors and datasets.
+    Results are ranked by relevance and include their SCORE and the CURSOR that continues the search after them.
+    Paging uses the (score, objectid) of the last result rather than an OFFSET.
+    If raw is True, each OBJECT is left as the stored JSON text.
+    """
+    cmd  = f"SELECT {OBJECT_COLUMNS}, {TEXT_MATCH} AS score FROM dvs_objects WHERE {TEXT_MATCH}"
+    vals = [text, text]
+    if cursor is not None and not isinstance(cursor, str):
+        raise ValueError(f"invalid cursor: {cursor}")
+    if cursor:
+        try:
+            (score, objectid) = cursor.split(":")
+            vals.extend([float(score), float(score), int(objectid)])
+        except ValueError:
+            raise ValueError(f"invalid cursor: {cursor}")
+        cmd += " HAVING (score < %s) OR (score = %s AND objectid < %s)"
+    cmd += " ORDER BY score DESC, objectid DESC LIMIT %s"
+    vals.append(min(limit, MAX_SEARCH_RESULTS))
+
+    rows = [decode_row(auth, row) for row in csfr(auth, 'text_search', cmd, vals, asDicts=True, debug=debug)]
+    cache_texts({row[HEXHASH]:row_text(row) for row in rows})
+    rows = [{**row, CURSOR:text_cursor(row)} for row in rows]
+    return rows if raw else [decode_object(row) for row in rows]
+
+
+def do_v2search(auth, *, search, raw=False, debug=False):
     """Implements the low-level v2 search. This will change when we move to GraphQL.
     Currently the search is a dictionary that is matched against. The special wildcard SEARCH_ANY
     is matched against all possible fields. the response is a list of dictionaries of all matches.
     Right now there is no indexing on the objects. We may wish to create an index for the properties that we care about.
     Perhaps we should have used MongoDB?
+    If the search has a TEXT key, it is a full-text search; see do_v2textsearch.
+    If raw is True, each OBJECT is left as the stored JSON text, for responses that are encoded with row_json.
     """
+    if TEXT in search:
+        limit = search.get(LIMIT, MAX_SEARCH_RESULTS)
+        if isinstance(limit, bool) or not isinstance(limit, int) or limit < 1:
+            raise ValueError(f"invalid limit: {limit}")
+        key  = canonical_json(search)
+        rows = search_cache.get(key)
+        if rows is None:
+            rows = do_v2textsearch(auth, text=str(search[TEXT]), cursor=search.get(CURSOR),
+                                   limit=limit, raw=True, debug=debug)
+            search_cache.set(key, rows)
+        return rows if raw else [decode_object(row) for row in rows]
+
     search_any = search.get(SEARCH_ANY,None)
     search_hashes = []
     if is_hexadecimal(search_any):
-        search_hashes.append(search_any + "%") # add the wildcard
-    if HEXHASH in search:
-        search_hashes.append(search.get(HEXHASH)+"%") # add the wildcard
-
-    search_filenames = []
-    if search_any:
-        search_filenames.append(search_any)
-    if FILENAME in search:
-        search_filenames.append(search.get(FILENAME))
-
-    search_dirnames = []
-    if search_any:
-        search_dirnames.append(search_any)
-    if DIRNAME in search:
-        search_dirnames.append(search.get(FILENAME))
-
-    search_hostnames = []
-    if search_any:
-        search_hostnames.append(search_any)
-    if HOSTNAME in search:
-        search_hostnames.append(search.get(HOSTNAME))
+        search_hashes.append(search_any)
+    if is_hexadecimal(search.get(HEXHASH)):
+        search_hashes.append(search.get(HEXHASH))
 
     # Now construct the search string
-    cmd = """SELECT objectid,created,hexhash,object,url from dvs_objects where """
+    cmd = f"""SELECT {OBJECT_COLUMNS} from dvs_objects where """
     where_ors = []
     vals   = []
 
-    # For these strings, allow them anywhere
-    if search_hashes:
-        where_ors.extend([" (hexhash LIKE %s) "] * len(search_hashes))
-        vals.extend(search_hashes)
-        where_ors.extend([" (JSON_UNQUOTE(JSON_EXTRACT(object,'$.hashes.md5')) LIKE %s) "] * len(search_hashes))
-        vals.extend(search_hashes)
-        where_ors.extend([" (JSON_UNQUOTE(JSON_EXTRACT(object,'$.hashes.sha1')) LIKE %s) "] * len(search_hashes))
-        vals.extend(search_hashes)
-        where_ors.extend([" (JSON_UNQUOTE(JSON_EXTRACT(object,'$.hashes.sha256')) LIKE %s) "] * len(search_hashes))
-        vals.extend(search_hashes)
-        where_ors.extend([" (JSON_UNQUOTE(JSON_EXTRACT(object,'$.hashes.sha512')) LIKE %s) "] * len(search_hashes))
-        vals.extend(search_hashes)
-
-    if search_filenames:
-        where_ors.extend([" (JSON_UNQUOTE(JSON_EXTRACT(object,'$.filename')) LIKE %s) "] * len(search_filenames))
-        vals.extend(search_filenames)
-
-    if search_dirnames:
-        where_ors.extend([" (JSON_UNQUOTE(JSON_EXTRACT(object,'$.dirname')) LIKE %s) "] * len(search_dirnames))
-        vals.extend(search_dirnames)
-
-    if search_hostnames:
-        where_ors.extend([" (JSON_UNQUOTE(JSON_EXTRACT(object,'$.hostname')) LIKE %s) "] * len(search_dirnames))
-        vals.extend(search_dirnames)
+    # For these strings, allow them anywhere.
+    # A hash prefix is a range scan on the binary hash column: every digest that starts with the prefix
+    # lies between the prefix padded with 0s and the prefix padded with fs.
+    for prefix in search_hashes:
+        for (col, nbytes) in [('hashbin', HASHBIN_BYTES)] + [(col, nbytes) for (col, nbytes, name) in DIGEST_COLUMNS]:
+            prefix_range = hex_prefix_range(prefix, nbytes)
+            if prefix_range:
+                where_ors.append(f" ({col} BETWEEN %s AND %s) ")
+                vals.extend(prefix_range)
+
+    # Names are matched in the lookup tables, and objects are found by the index on their interned id.
+    # Names are matched case-insensitively with the indexed {namecol}_ci column, which has a
+    # case-insensitive collation; the binary collation of {namecol} is for its unique index.
+    # Objects with names that are not interned (too long, not ASCII, or stored before interning) are
+    # flagged with names_in_json, and only those have their JSON searched.
+    def name_match(col, name):
+        (path, table, namecol) = [(p, t, n) for (c,p,t,n) in INTERNED_FIELDS if c==col][0]
+        vals.extend([name, name])
+        return (f" ({col} IN (SELECT {col} FROM {table} WHERE {namecol}_ci LIKE %s)"
+                f" OR (names_in_json=1 AND {col} IS NULL"
+                f" AND LOWER(JSON_UNQUOTE(JSON_EXTRACT(object,'{json_path(path)}'))) LIKE LOWER(%s))) ")
+
+    # SEARCH_ANY matches any of the names. The FILENAME, DIRNAME and HOSTNAME of a search must all match,
+    # so that a search for a path finds only that path.
+    name_fields = (('filenameid', FILENAME), ('dirnameid', DIRNAME), ('hostid', HOSTNAME))
+    if search_any:
+        for (col, field) in name_fields:
+            where_ors.append(name_match(col, search_any))
+    name_ands = [name_match(col, search[field]) for (col, field) in name_fields if search.get(field)]
+    if name_ands:
+        where_ors.append(" (" + " AND ".join(name_ands) + ") ")
 
     if where_ors:
         cmd += "(" + " OR ".join(where_ors)  + ")"
@@ -107,30 +545,44 @@ def do_v2search(auth, *, search, debug=False):
     if (FILE_METADATA in search) and (ST_SIZE in search[FILE_METADATA]):
         if where_ors:
             cmd += " AND "
-        cmd += " (JSON_UNQUOTE(JSON_EXTRACT(object,'$.metadata.st_size')) = %s) "
+        cmd += " (st_size = %s) "
         vals.append(search[FILE_METADATA][ST_SIZE])
 
 
     if len(vals)==0:
         return []
 
-    cmd += " LIMIT %s"
+    # The newest objects are returned first, so that a search with more matches than MAX_SEARCH_RESULTS
+    # returns the most recent ones
+    cmd += " ORDER BY objectid DESC LIMIT %s"
     vals.append(MAX_SEARCH_RESULTS)
 
-    rows = dbfile.DBMySQL.csfr(auth, cmd, vals, asDicts=True, debug=debug)
-    # load the JSON...
-    return [{**row, **{OBJECT:json.loads(row[OBJECT])}} for row in rows]
+    # Repeat searches within SEARCH_CACHE_TTL are answered from memory.
+    # The rows are cached with their objects as text; callers must not modify them.
+    search_key = canonical_json(search)
+    rows = search_cache.get(search_key)
+    if rows is None:
+        rows = [decode_row(auth, row) for row in csfr(auth, 'search', cmd, vals, asDicts=True, debug=debug)]
+        cache_texts({row[HEXHASH]:row_text(row) for row in rows})
+        search_cache.set(search_key, rows)
+    return rows if raw else [decode_object(row) for row in rows]
 
 
+@instrumented('search')
 def search_api(auth):
     """Bottle interface for search. Keep everything that has to do with bottle here so that we can implement unit tests.
-    The search request is a list of searches. Each search is a dict that is matched.
+    The search request is a list of searches. Each search is a dict that is matched; see do_v2search.
+    An object matches FILENAME, DIRNAME and HOSTNAME only if all of those in the search match.
     The response is a list of dicts. Each dict contains the search array and a list of the search responses.
+    If the format parameter is FORMAT_NDJSON, the response is newline-delimited JSON with one line per result,
+    {SEARCH: index of the search in the request, RESULT: result}.
+    Either way the response is streamed, with each object's stored JSON copied into it without being decoded.
     """
     import bottle
     #print(dict(bottle.request.params),file=sys.stderr)
     try:
-        searches = json.loads(bottle.request.params.searches)
+        with dvs_metrics.phase('parse'):
+            searches = json.loads(bottle.request.params.searches)
     except json.decoder.JSONDecodeError:
         bottle.response.status = 404
         if len(bottle.request.params.searches)==0:
@@ -146,12 +598,30 @@ def search_api(auth):
         bottle.response.status = 404
         return f"Searches parameter must be a JSON-encoded list of dictionaries"
 
-    responses = [{SEARCH:search,
-                 RESULTS:do_v2search(auth, search=search, debug=bottle.request.params.debug)}
-                 for search in searches]
+    try:
+        with dvs_metrics.phase('search'):
+            results = [do_v2search(auth, search=search, raw=True, debug=bottle.request.params.debug)
+                       for search in searches]
+    except ValueError as e:
+        bottle.response.status = 400
+        return str(e)
 
+    if bottle.request.params.get(FORMAT)==FORMAT_NDJSON:
+        bottle.response.content_type = 'application/x-ndjson'
+        return (f'{{"{SEARCH}": {n}, "{RESULT}": {row_json(row)}}}\n'
+                for (n, rows) in enumerate(results) for row in rows)
     bottle.response.content_type = 'text/json'
-    return json.dumps(responses,default=str)
+    return stream_json_list(f'{{"{SEARCH}": {json.dumps(search, default=str)}, "{RESULTS}": ['
+                            + ", ".join([row_json(row) for row in rows]) + "]}"
+                            for (search, rows) in zip(searches, results))
+
+
+def stream_json_list(items):
+    """Generator that yields the JSON text of a list, given the JSON text of its items"""
+    yield "["
+    for (n, item) in enumerate(items):
+        yield (", " if n else "") + item
+    yield "]"
 
 
 
@@ -164,43 +634,288 @@ def grouper(n, iterable, fillvalue=None):
     return zip_longest(fillvalue=fillvalue, *args)
 
 
-def store_objects(auth, objects):
-    """Objects is a dictionary of key:values that will be stored. The value might be a URL or a dictionary"""
+def store_objects(auth, objects, texts=None):
+    """Objects is a dictionary of key:values that will be stored. The value might be a URL or a dictionary.
+    :param texts: optional dictionary of key:text with the text to store for each object, as returned by validate_objects.
+                  The text of an object that is not in texts is computed and checked here.
+    """
 
     assert isinstance(objects,dict)
-    if len(objects)==0:
+    # Objects in the object cache are already stored; popular objects are stored only once.
+    # Ephemeral objects are never cached, so they are always inserted, in case the garbage collector deleted them.
+    new_keys = object_cache.missing(objects.keys())
+    if len(new_keys)==0:
         return
+    interned = intern_objects(auth, {key:val for (key,val) in objects.items()
+                                     if key in new_keys and isinstance(val,dict)})
     # Group inserts to maximum of 10 objects
     OBJECTS_PER_INSERT = 10
-    for keys in grouper( OBJECTS_PER_INSERT ,  objects.keys()):
-        vals = []
+    for keys in grouper( OBJECTS_PER_INSERT ,  [key for key in objects.keys() if key in new_keys]):
+        rows  = []
+        cache = {}
         for key in keys:
             if key is None:
                 continue
             val = objects[key]
             if isinstance(val,dict):
                 # we were given an object to store
-                val_json = canonical_json( val )
-                assert key == hexhash_string( val_json )
-                vals.append(key)
-                vals.append(val_json)
-                vals.append(None)
+                if texts is not None and key in texts:
+                    val_json = texts[key]
+                else:
+                    val_json = canonical_json( val )
+                    assert key == hexhash_string( val_json )
+                cache[key] = val_json
+                (stripped, ids) = interned.get(key, (val, {}))
+                if STORE_ZFORMAT is not None and compressible(val) and not names_in_json(val, ids):
+                    rows.append([hexhash_to_bin(key), None, None] + index_values(val, ids)
+                                + compressed_values(auth, val_json, STORE_ZFORMAT))
+                elif key in interned:
+                    rows.append([hexhash_to_bin(key), canonical_json(stripped), None] + index_values(val, ids) + [None]*3)
+                else:
+                    rows.append([hexhash_to_bin(key), val_json, None] + index_values(val) + [None]*3)
             elif isinstance(val,str):
                 # we were given a URL to store
-                vals.append(key)
-                vals.append(None)
-                vals.append(val)
-        dbfile.DBMySQL.csfr(auth,"INSERT  INTO dvs_objects (hexhash,object,url) VALUES "
-                            + comma_args(3,rows=len(vals)//3,parens=True)
-                            + " ON DUPLICATE KEY UPDATE objectid=VALUES(objectid)", vals)
+                rows.append([hexhash_to_bin(key), None, val] + index_values(None) + [None]*3)
+                cache[key] = val
+        csfr(auth, 'store_objects', f"INSERT  INTO dvs_objects ({','.join(INSERT_COLUMNS)}) VALUES "
+                            + comma_args(len(INSERT_COLUMNS),rows=len(rows),parens=True)
+                            + " ON DUPLICATE KEY UPDATE objectid=VALUES(objectid)",
+                            [val for row in rows for val in row])
+        cache_texts(cache)
+    search_cache.clear()
+
+def intern_stored_objects(auth, objects):
+    """Intern the fields of objects that were stored before their fields were interned.
+    :param objects: {hexhash:object} as returned by the API.
+    Returns the number of objects that were updated."""
+    interned = intern_objects(auth, objects)
+    for (hexhash, (stripped, ids)) in interned.items():
+        csfr(auth, 'intern_stored',
+             "UPDATE dvs_objects SET object=IF(object_z IS NULL, %s, NULL), names_in_json=%s, "
+             + ",".join([f"{col}=%s" for (col,path,table,name) in INTERNED_FIELDS])
+             + " WHERE hashbin=%s",
+             [canonical_json(stripped), names_in_json(objects[hexhash], ids)] + interned_values(ids) + [hexhash_to_bin(hexhash)])
+    return len(interned)
+
+
+def compress_stored_objects(auth, objects, zformat):
+    """Compress objects that are stored uncompressed.
+    :param objects: {hexhash:object} as returned by the API.
+    Objects whose canonical JSON does not match their hexhash are left alone, as are objects whose names
+    are not interned; daemon/intern_names.py must intern them first.
+    Returns the number of objects that were compressed."""
+    count = 0
+    for (hexhash, obj) in objects.items():
+        if not compressible(obj):
+            continue
+        text = canonical_json(obj)
+        if hexhash_string(text) != hexhash:
+            logging.warning("%s: canonical JSON does not match the hexhash; not compressed", hexhash)
+            continue
+        csfr(auth, 'compress_stored',
+             "UPDATE dvs_objects SET object=NULL, object_z=%s, zformat=%s, zdictid=%s, ephemeral=%s "
+             "WHERE hashbin=%s AND object_z IS NULL AND names_in_json=0",
+             compressed_values(auth, text, zformat) + [1 if is_ephemeral(obj) else 0, hexhash_to_bin(hexhash)])
+        count += 1
+    return count
+
+
+def gc_candidates(auth, *, older_than, cursor=None, limit=GC_BATCH_SIZE):
+    """Return the objects that the garbage collector may delete, as a list of {OBJECTID:, HEXHASH:, 'bytes':}
+    in objectid order, starting after cursor.
+    An object may be deleted if it is ephemeral, was created before older_than (a time_t or timestamp string),
+    and is not in the before, method or after list of any stored commit. Deleting an ephemeral commit
+    removes its links, so its own ephemeral objects become candidates on the next pass. An object that is
+    used by a commit that is not ephemeral is therefore never deleted.
+    """
+    (created, val) = created_condition("<", older_than)
+    cmd  = ("SELECT objectid, hashbin, IFNULL(LENGTH(object),0)+IFNULL(LENGTH(object_z),0)+IFNULL(LENGTH(url),0) AS bytes "
+            f"FROM dvs_objects WHERE ephemeral=1 AND {created} "
+            "AND NOT EXISTS (SELECT 1 FROM dvs_links WHERE dvs_links.child=dvs_objects.hashbin) ")
+    vals = [val]
+    if cursor is not None:
+        cmd += "AND objectid > %s "
+        vals.append(cursor)
+    cmd += "ORDER BY objectid LIMIT %s"
+    vals.append(limit)
+    return [decode_row(auth, row) for row in csfr(auth, 'gc_candidates', cmd, vals, asDicts=True)]
+
+
+def delete_objects(auth, candidates):
+    """Delete objects returned by gc_candidates, along with their links and remote_fqdns.
+    Each object is checked again as it is deleted, so an object that a commit started using since
+    gc_candidates is kept. Returns the hexhashes of the objects that were deleted."""
+    if not candidates:
+        return []
+    hashbins = [hexhash_to_bin(row[HEXHASH]) for row in candidates]
+    args     = comma_args(len(hashbins), parens=True)
+    csfr(auth, 'gc_delete', f"DELETE FROM dvs_objects WHERE ephemeral=1 AND hashbin IN {args} "
+         f"AND hashbin NOT IN (SELECT child FROM dvs_links WHERE child IN {args})", hashbins + hashbins)
+    remaining = set(row[0] for row in csfr(auth, 'gc_delete', f"SELECT hashbin FROM dvs_objects WHERE hashbin IN {args}", hashbins))
+    deleted   = [hashbin for hashbin in hashbins if hashbin not in remaining]
+    if deleted:
+        args = comma_args(len(deleted), parens=True)
+        csfr(auth, 'gc_delete', f"DELETE FROM dvs_links WHERE parent IN {args}", deleted)
+        csfr(auth, 'gc_delete', f"DELETE FROM dvs_remote_fqdns WHERE hashbin IN {args}", deleted)
+    hexhashes = [bin_to_hexhash(hashbin) for hashbin in deleted]
+    for hexhash in hexhashes:
+        object_cache.discard(hexhash)
+    search_cache.clear()
+    lineage_cache.clear()
+    return hexhashes
+
 
 def get_objects(auth,hexhashes):
     """Returns the objects for the hexhashes. If the hexhash is a url, returns a proxy (which is a string, rather than an object)"""
-    rows = dbfile.DBMySQL.csfr(auth,"SELECT * from dvs_objects where hexhash in" + comma_args(len(hexhashes),parens=True),
-                        hexhashes,
-                        asDicts=True)
-
-    return {row[HEXHASH]:(json.loads(row[OBJECT]) if row[OBJECT] else row['url']) for row in rows}
+    texts   = object_cache.get_many(hexhashes)
+    missing = [hexhash for hexhash in hexhashes if hexhash not in texts]
+    if missing:
+        rows = csfr(auth, 'get_objects', f"SELECT hashbin,{OBJECT_EXPR} AS object,url,{Z_COLUMNS} from dvs_objects where hashbin in" + comma_args(len(missing),parens=True),
+                                   [hexhash_to_bin(hexhash) for hexhash in missing],
+                                   asDicts=True)
+        rows    = [decode_row(auth, row) for row in rows]
+        fetched = {row[HEXHASH]:row_text(row) for row in rows}
+        cache_texts(fetched)
+        texts.update(fetched)
+    return {hexhash:text_to_object(text) for (hexhash,text) in texts.items()}
+
+
+def store_links(auth, commits):
+    """Record the before/method/after membership of commits in dvs_links.
+    :param commits: dictionary of {hexhash:commit}
+    """
+    rows = [(hexhash_to_bin(parent), hexhash_to_bin(child), role)
+            for (parent, commit) in commits.items()
+            for role in LINK_ROLES
+            for child in commit.get(role, [])]
+    for offset in range(0, len(rows), LINKS_PER_INSERT):
+        group = rows[offset:offset+LINKS_PER_INSERT]
+        csfr(auth, 'store_links', "INSERT IGNORE INTO dvs_links (parent,child,role) VALUES "
+                            + comma_args(3, rows=len(group), parens=True),
+                            [val for row in group for val in row])
+    if rows:
+        lineage_cache.clear()
+
+
+# dvs_state records facts about the database as name/value pairs
+STATE_LINKS_BACKFILLED = 'links_backfilled'     # set by daemon/backfill_links.py when dvs_links is complete
+
+def get_state(auth, name):
+    """Return the value recorded for name in dvs_state, or None"""
+    rows = csfr(auth, 'state', "SELECT value FROM dvs_state WHERE name=%s", [name])
+    return rows[0][0] if rows else None
+
+def set_state(auth, name, value):
+    csfr(auth, 'state', "INSERT INTO dvs_state (name,value) VALUES (%s,%s) ON DUPLICATE KEY UPDATE value=VALUES(value)",
+         [name, value])
+
+
+def get_links(auth, hexhashes, *, direction=LINKS_WHERE_USED, role=None, limit=MAX_LINK_RESULTS):
+    """Return the links for hexhashes as a list of {PARENT:, CHILD:, ROLE:} dictionaries.
+    :param direction: LINKS_WHERE_USED returns the commits that include the hexhashes;
+                      LINKS_USES returns the objects that the commits with the hexhashes include.
+    :param role: if provided, only return links where the object is in this part of the commit.
+    """
+    if direction not in (LINKS_WHERE_USED, LINKS_USES):
+        raise ValueError(f"direction must be {LINKS_WHERE_USED} or {LINKS_USES}")
+    if role is not None and role not in LINK_ROLES:
+        raise ValueError(f"role must be one of {LINK_ROLES}")
+    if len(hexhashes)==0:
+        return []
+    column = CHILD if direction==LINKS_WHERE_USED else PARENT
+    cmd  = f"SELECT parent,child,role FROM dvs_links WHERE {column} IN " + comma_args(len(hexhashes), parens=True)
+    vals = [hexhash_to_bin(hexhash) for hexhash in hexhashes]
+    if role is not None:
+        cmd += " AND role=%s"
+        vals.append(role)
+    cmd += " LIMIT %s"
+    vals.append(min(limit, MAX_LINK_RESULTS))
+    rows = csfr(auth, 'get_links', cmd, vals, asDicts=True)
+    return [{PARENT:bin_to_hexhash(row[PARENT]), CHILD:bin_to_hexhash(row[CHILD]), ROLE:row[ROLE]} for row in rows]
+
+
+def where_used(auth, hexhashes, role=None):
+    """Return the links to the commits that have any of hexhashes in their before, method or after"""
+    return get_links(auth, hexhashes, direction=LINKS_WHERE_USED, role=role)
+
+
+def uses(auth, hexhashes, role=None):
+    """Return the links from the commits in hexhashes to the objects in their before, method and after"""
+    return get_links(auth, hexhashes, direction=LINKS_USES, role=role)
+
+
+# Recursive walks over dvs_links. Data flows from a commit's before and method objects into the commit,
+# and from the commit into its after objects. Sub-commits are just objects in a before or after list,
+# so the walk goes through them transparently.
+# Each row of the walk is a node, its depth, and the link that reached it (NULL for the start).
+LINEAGE_SQL = {
+    LINEAGE_ANCESTORS: """
+        WITH RECURSIVE walk (node, depth, parent, child, role) AS (
+            SELECT CAST(%s AS BINARY(20)), 0, CAST(NULL AS BINARY(20)), CAST(NULL AS BINARY(20)), CAST(NULL AS CHAR(6))
+          UNION DISTINCT
+            SELECT l.parent, w.depth+1, l.parent, l.child, l.role
+            FROM walk w JOIN dvs_links l ON l.child=w.node AND l.role='after'
+            WHERE w.depth < %s
+          UNION DISTINCT
+            SELECT l.child, w.depth+1, l.parent, l.child, l.role
+            FROM walk w JOIN dvs_links l ON l.parent=w.node AND l.role IN ('before','method')
+            WHERE w.depth < %s
+        )
+        SELECT node, depth, parent, child, role FROM walk""",
+    LINEAGE_DESCENDANTS: """
+        WITH RECURSIVE walk (node, depth, parent, child, role) AS (
+            SELECT CAST(%s AS BINARY(20)), 0, CAST(NULL AS BINARY(20)), CAST(NULL AS BINARY(20)), CAST(NULL AS CHAR(6))
+          UNION DISTINCT
+            SELECT l.parent, w.depth+1, l.parent, l.child, l.role
+            FROM walk w JOIN dvs_links l ON l.child=w.node AND l.role IN ('before','method')
+            WHERE w.depth < %s
+          UNION DISTINCT
+            SELECT l.child, w.depth+1, l.parent, l.child, l.role
+            FROM walk w JOIN dvs_links l ON l.parent=w.node AND l.role='after'
+            WHERE w.depth < %s
+        )
+        SELECT node, depth, parent, child, role FROM walk"""}
+
+
+def lineage(auth, hexhash, *, direction=LINEAGE_ANCESTORS, depth=DEFAULT_LINEAGE_DEPTH):
+    """Walk the ancestors or descendants of hexhash, following at most depth links.
+    Returns (nodes, links), where nodes is a dictionary of {hexhash:depth} with the smallest depth at which
+    each object was reached, and links is a list of {PARENT:, CHILD:, ROLE:} dictionaries.
+    The results are cached in lineage_cache; callers must not modify them.
+    """
+    if direction not in LINEAGE_SQL:
+        raise ValueError(f"direction must be {LINEAGE_ANCESTORS} or {LINEAGE_DESCENDANTS}")
+    if not (0 <= depth <= MAX_LINEAGE_DEPTH):
+        raise ValueError(f"depth must be between 0 and {MAX_LINEAGE_DEPTH}")
+    key = (hexhash, direction, depth)
+    ret = lineage_cache.get(key)
+    if ret is not None:
+        return ret
+
+    rows  = csfr(auth, 'lineage', LINEAGE_SQL[direction], [hexhash_to_bin(hexhash), depth, depth], asDicts=True)
+    nodes = {}
+    links = {}
+    for row in rows:
+        node = bin_to_hexhash(row['node'])
+        nodes[node] = min(row[DEPTH], nodes.get(node, row[DEPTH]))
+        if row[PARENT] is not None:
+            link = (bin_to_hexhash(row[PARENT]), bin_to_hexhash(row[CHILD]), row[ROLE])
+            links[link] = {PARENT:link[0], CHILD:link[1], ROLE:link[2]}
+    ret = (nodes, list(links.values()))
+    lineage_cache.set(key, ret)
+    return ret
+
+
+def existing_hexhashes(auth, hexhashes):
+    """Return the set of hexhashes that are stored. Objects in the object cache are known to be,
+    because ephemeral objects, which the garbage collector may delete, are never cached."""
+    hexhashes = set(hexhashes)
+    uncached  = object_cache.missing(hexhashes)
+    if not uncached:
+        return hexhashes
+    rows = csfr(auth, 'exists', "SELECT hashbin FROM dvs_objects WHERE hashbin in " + comma_args(len(uncached),parens=True),
+                [hexhash_to_bin(hexhash) for hexhash in uncached])
+    return (hexhashes - uncached) | set([bin_to_hexhash(row[0]) for row in rows])
 
 
 def store_commit(auth, commit):
@@ -220,38 +935,64 @@ other methods return lists of objects
                 raise ValueError(f"{check} is not a list")
             if not all([isinstance(elem,str) for elem in objlist]):
                 raise ValueError(f"{check} is not a list of strings")
-            if not all([is_hexadecimal(elem) for elem in objlist]):
-                raise ValueError(f"{check} contains a value that is not a hexadecimal hash")
+            if not all([is_hexhash(elem) for elem in objlist]):
+                raise ValueError(f"{check} contains a value that is not a hexhash")
             hashes.update(objlist)
 
     if len(hashes)==0:
         raise ValueError("Commit does not include any hexhashes in the before, method or after sections")
-    # Make sure that all of the hashes are in the database
-    where = "WHERE hexhash in " + comma_args(len(hashes),parens=True)
-    rows = dbfile.DBMySQL.csfr(auth, "SELECT hexhash FROM dvs_objects " + where, list(hashes))
-    if len(rows)!=len(hashes):
-        logging.error("Not all objects are in database len(rows)=%s len(hashes)=%s",len(rows),len(hashes))
-        inserted = set([row[0] for row in rows])
-        count = 0
-        for h in hashes:
-            if h not in inserted:
-                logging.error("%s was not inserted",h)
-                count += 1
-        logging.error("Total not inserted: %s",count)
-        raise ValueError(f"{count} hashes were not inserted")
-
     # Add the timestamp
     commit[TIME] = time.time()
+    objects      = objects_dict([commit])
+
+    # Make sure that all of the hashes are in the database, and keep them there; see link_and_check.
+    with dvs_metrics.phase('exists'):
+        missing = link_and_check(auth, objects)
+    if missing:
+        logging.error("Not all objects are in database len(hashes)=%s len(missing)=%s",len(hashes),len(missing))
+        for h in missing:
+            logging.error("%s was not inserted",h)
+        logging.error("Total not inserted: %s",len(missing))
+        raise ValueError(f"{len(missing)} hashes were not inserted")
 
     # store it and return the object
-    objects      = objects_dict([commit])
     store_objects(auth,objects)
     return objects
 
 
-def dump_objects(auth, limit, offset):
-    """Returns objects from offset..limit, in reverse order. If offset is NULL, start at the last"""
-    cmd = "SELECT hexhash,created,JSON_UNQUOTE(object) as object,url from dvs_objects order by objectid desc "
+def link_and_check(auth, commits, pending=()):
+    """Link commits to the objects in their before, method and after, and return the set of those objects
+    that are not stored. If any are not, the links are removed again.
+    The links are stored before the objects are checked: the garbage collector never deletes an object
+    that is linked, so an object that is found is kept, even if a garbage collection is running.
+    :param commits: dictionary of {hexhash:commit}
+    :param pending: hexhashes that the caller is about to store, which are not checked.
+    """
+    refs = set([hexhash for commit in commits.values() for role in LINK_ROLES for hexhash in commit.get(role,[])])
+    refs = refs - set(pending)
+    store_links(auth, commits)
+    missing = refs - existing_hexhashes(auth, refs) if refs else set()
+    if missing:
+        parents = [hexhash_to_bin(hexhash) for hexhash in commits]
+        csfr(auth, 'store_links', "DELETE FROM dvs_links WHERE parent IN " + comma_args(len(parents), parens=True), parents)
+        lineage_cache.clear()
+    return missing
+
+
+def store_remote_fqdn(auth, hexhash, remote_addr, remote_fqdn):
+    """Record the hostname of the client that made a commit that was stored before its address was resolved,
+    or that pushed a commit with store_api. The hostname cannot be added to the commit itself, because that
+    would change its hexhash.
+    An address without a hostname is recorded with a NULL remote_fqdn."""
+    csfr(auth, 'store_remote_fqdn',
+         "INSERT IGNORE INTO dvs_remote_fqdns (hashbin, remote_addr, remote_fqdn) VALUES (%s,%s,%s)",
+         (hexhash_to_bin(hexhash), remote_addr, remote_fqdn if remote_fqdn!=remote_addr else None))
+
+
+def dump_objects(auth, limit, offset, raw=False):
+    """Returns objects from offset..limit, in reverse order. If offset is NULL, start at the last.
+    If raw is True, each OBJECT is left as the stored JSON text."""
+    cmd = f"SELECT hashbin,created,JSON_UNQUOTE({OBJECT_EXPR}) as object,url,{Z_COLUMNS} from dvs_objects order by objectid desc "
     vals = []
     if (limit is None) or (limit>MAX_DUMP_OBJECTS):
         limit = MAX_DUMP_OBJECTS
@@ -260,80 +1001,281 @@ def dump_objects(auth, limit, offset):
     if offset:
         cmd += " OFFSET %s "
         vals.append(offset)
-    rows = dbfile.DBMySQL.csfr(auth,cmd,vals,asDicts=True)
-    # load the JSON...
-    return [{**row, **{OBJECT:json.loads(row[OBJECT])}} for row in rows]
-
-
-def validate_commit(commit, objects):
-    """Validate objects in a commit.
-    :param objects: dictionary of objects to be committed, key is hexhash and value is object.
-    raises commit error if a problem
+    rows = [decode_row(auth, row) for row in csfr(auth, 'dump', cmd,vals,asDicts=True)]
+    return rows if raw else [decode_object(row) for row in rows]
+
+
+def created_condition(op, when):
+    """Return a SQL condition and value comparing the created column with when,
+    which is either a time_t or a 'YYYY-MM-DD HH:MM:SS' string."""
+    if isinstance(when,(int,float)):
+        return (f"(created {op} FROM_UNIXTIME(%s))", when)
+    return (f"(created {op} %s)", str(when))
+
+
+def iter_dump_objects(auth, *, cursor=None, kind=None, since=None, until=None, order=ORDER_DESC, limit=None,
+                      batch_size=DUMP_BATCH_SIZE, raw=False, debug=False):
+    """Generator for the v2 dump. Yields objects starting after the objectid cursor, in objectid order.
+    Each batch is fetched with keyset pagination (WHERE objectid < cursor) rather than OFFSET,
+    so every query is a range scan on the primary key no matter how deep into the table we are.
+    :param cursor: objectid of the last object already seen, or None to start at the beginning (or end).
+    :param kind: optional KIND_COMMIT, KIND_FILE or KIND_URL
+    :param since: optional time_t or timestamp string; only return objects created at or after it.
+    :param until: optional time_t or timestamp string; only return objects created before it.
+    :param order: ORDER_DESC (newest first) or ORDER_ASC (oldest first).
+    :param limit: maximum number of objects to return, or None for all.
+    :param raw: if True, each OBJECT is left as the stored JSON text.
     """
-    # First validate the objects
-    if not isinstance(objects,dict):
-        return f"objects parameter is not a JSON-encoded dictionary"
-    for (key,value) in objects.items():
-        if not is_hexadecimal(key):
-            return f"object key {key} is not a hexadecimal value"
-        if isinstance(value,dict):
-            cj = canonical_json(value)
-            hh = hexhash_string(cj)
-            if key != hh:
-                return f"object key {key} has a computed hash of {hh}"
-        elif instance(value,str):
-            if ":" not in value:
-                return f"object key {key} value is not a URL"
+    if order not in (ORDER_ASC, ORDER_DESC):
+        raise ValueError(f"order must be {ORDER_ASC} or {ORDER_DESC}")
+    if kind is not None and kind not in KIND_WHERE:
+        raise ValueError(f"kind must be one of {sorted(KIND_WHERE)}")
+
+    where = []
+    vals  = []
+    if kind is not None:
+        where.append(KIND_WHERE[kind])
+    if since is not None:
+        (cond, val) = created_condition(">=", since)
+        where.append(cond)
+        vals.append(val)
+    if until is not None:
+        (cond, val) = created_condition("<", until)
+        where.append(cond)
+        vals.append(val)
+
+    while limit is None or limit > 0:
+        count     = batch_size if limit is None else min(batch_size, limit)
+        cmd       = f"SELECT objectid,hashbin,created,JSON_UNQUOTE({OBJECT_EXPR}) as object,url,{Z_COLUMNS} from dvs_objects "
+        cmd_where = list(where)
+        cmd_vals  = list(vals)
+        if cursor is not None:
+            cmd_where.append("(objectid < %s)" if order==ORDER_DESC else "(objectid > %s)")
+            cmd_vals.append(cursor)
+        if cmd_where:
+            cmd += " WHERE " + " AND ".join(cmd_where)
+        cmd += f" ORDER BY objectid {order} LIMIT %s"
+        cmd_vals.append(count)
+
+        rows = [decode_row(auth, row) for row in csfr(auth, 'dump_v2', cmd, cmd_vals, asDicts=True, debug=debug)]
+        for row in rows:
+            yield row if raw else decode_object(row)
+        if len(rows) < count:
+            return
+        cursor = rows[-1][OBJECTID]
+        if limit is not None:
+            limit -= len(rows)
+
+
+_validate_pool = None
+
+def validate_pool():
+    """Return the process pool used to validate large commits, creating it on first use.
+    The workers are started with forkserver so that they do not inherit the server's threads."""
+    global _validate_pool
+    if _validate_pool is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        _validate_pool = ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                             mp_context=multiprocessing.get_context('forkserver'))
+    return _validate_pool
+
+def validate_objects(items, exact=False):
+    """Validate the objects in a commit.
+    :param items: list of (hexhash, value) pairs. See dvs_helpers.check_object for exact.
+    :return: (objects, texts, errors) - {hexhash:object} and {hexhash:text} for the valid objects, and
+             {hexhash:reason} for every object that is invalid.
+    Large commits are checked in parallel, in chunks of VALIDATE_CHUNK_SIZE.
+    """
+    global _validate_pool
+    results = None
+    if len(items) >= VALIDATE_PARALLEL_OBJECTS:
+        from concurrent.futures.process import BrokenProcessPool
+        chunks = [items[i:i+VALIDATE_CHUNK_SIZE] for i in range(0, len(items), VALIDATE_CHUNK_SIZE)]
+        try:
+            results = [result
+                       for chunk_results in validate_pool().map(check_objects, chunks, [exact]*len(chunks))
+                       for result in chunk_results]
+        except (OSError, BrokenProcessPool) as e:
+            # A broken pool is discarded and recreated by the next large commit
+            logging.warning("parallel validation failed; validating serially: %s", e)
+            _validate_pool = None
+    if results is None:
+        results = check_objects(items, exact)
+
+    objects = {}
+    texts   = {}
+    errors  = {}
+    for (key, obj, text, error) in results:
+        if error is None:
+            objects[key] = obj
+            texts[key]   = text
         else:
-            return f"object key {key} is not a dict or a string"
+            errors[str(key)] = error
+    return (objects, texts, errors)
 
-    # Now validate the commit
+def invalid_objects_message(errors):
+    """The body of the 400 response for a commit with invalid objects"""
+    return json.dumps({ERROR:f"{len(errors)} invalid object{'s' if len(errors)!=1 else ''}",
+                       INVALID_OBJECTS:errors})
+
+def validate_commit(commit):
+    """Validate the commit itself. Returns an error message, or None if the commit is valid."""
     if not isinstance(commit, dict):
         return f"commit parameter is not a JSON-encoded dictionary"
-    for (key,value) in objects.items():
+    for key in commit.keys():
         if not isinstance(key,str):
             return f"commit key {key} is not a string"
-
     return None
 
 
+@instrumented('commit')
 def commit_api(auth):
     """Bottle interface for commits."""
     import bottle
+    # Start resolving the client's hostname while the request is processed
+    remote_addr = bottle.request.remote_addr
+    reverse_dns.resolve(remote_addr)
+
     # Decode and validate the arguments
     # First validate the objects
+    # The objects are either a JSON dictionary, which is checked in canonical form,
+    # or API_OBJECT_LINES, where the hash of the exact text received is checked.
     try:
-        objects = json.loads(bottle.request.params.objects)
+        with dvs_metrics.phase('parse'):
+            if bottle.request.params.get(API_OBJECT_LINES):
+                items = parse_object_lines(bottle.request.params.getunicode(API_OBJECT_LINES))
+                exact = True
+            else:
+                objects = json.loads(bottle.request.params.objects)
+                if not isinstance(objects,dict):
+                    bottle.response.status = 400
+                    return f"objects parameter is not a JSON-encoded dictionary"
+                items = list(objects.items())
+                exact = False
     except json.decoder.JSONDecodeError:
         bottle.response.status = 400
         return f"objects parameter is not a valid JSON value"
+    except ValueError as e:
+        bottle.response.status = 400
+        return f"{API_OBJECT_LINES} parameter is malformed: {e}"
 
     try:
-        commit = json.loads(bottle.request.params.commit)
+        with dvs_metrics.phase('parse'):
+            commit = json.loads(bottle.request.params.commit)
     except json.decoder.JSONDecodeError:
         bottle.response.status = 400
         return f"commit parameter is not a valid JSON value"
 
-    error_message = validate_commit(commit, objects)
+    with dvs_metrics.phase('validate'):
+        (objects, texts, errors) = validate_objects(items, exact)
+    if errors:
+        bottle.response.status = 400
+        bottle.response.content_type = 'text/json'
+        return invalid_objects_message(errors)
+    error_message = validate_commit(commit)
     if error_message:
         bottle.response.status = 400
         return error_message
 
     # Paramters look good. Store the objects.
-    store_objects(auth, objects)
+    with dvs_metrics.phase('store_objects'):
+        store_objects(auth, objects, texts)
 
-    commit[REMOTE_ADDR] = bottle.request.remote_addr
-    commit[REMOTE_FQDN] = socket.getfqdn(bottle.request.remote_addr)
+    # If the hostname is not known yet, the commit is stored without it and the hostname
+    # is recorded in dvs_remote_fqdns when the lookup finishes.
+    commit[REMOTE_ADDR] = remote_addr
+    with dvs_metrics.phase('reverse_dns'):
+        remote_fqdn = reverse_dns.get(remote_addr)
+    if remote_fqdn is not None:
+        commit[REMOTE_FQDN] = remote_fqdn
 
     # Now store the commit as another object
     try:
-        commit_obj = store_commit(auth, commit)
+        with dvs_metrics.phase('store_commit'):
+            commit_obj = store_commit(auth, commit)
     except ValueError as e:
         bottle.response.status = 400
         return str(e)
-    return json.dumps( commit_obj,default=str)
+    if remote_fqdn is None:
+        for hexhash in commit_obj:
+            reverse_dns.resolve(remote_addr, functools.partial(store_remote_fqdn, auth, hexhash))
+    with dvs_metrics.phase('encode'):
+        return json.dumps( commit_obj,default=str)
 
 
+@instrumented('exists')
+def exists_api(auth):
+    """API for finding which objects are stored. The hexhashes parameter is a JSON list of hexhashes.
+    Returns the JSON list of those that are stored. Used by clients to push only the objects that are missing."""
+    import bottle
+
+    try:
+        hexhashes = json.loads(bottle.request.params.hexhashes)
+    except json.decoder.JSONDecodeError:
+        bottle.response.status = 400
+        return f"{HEXHASHES} parameter is not a valid JSON value"
+    if (not isinstance(hexhashes, list)) or (not all([is_hexadecimal(h) and len(h)==HASHBIN_BYTES*2 for h in hexhashes])):
+        bottle.response.status = 400
+        return f"{HEXHASHES} must be a list of hexhashes"
+    if len(hexhashes)>MAX_SEARCH_OBJECTS:
+        bottle.response.status = 400
+        return f"Requested {len(hexhashes)} objects; max is {MAX_SEARCH_OBJECTS}"
+    with dvs_metrics.phase('exists'):
+        existing = existing_hexhashes(auth, [h.lower() for h in hexhashes])
+    bottle.response.content_type = 'text/json'
+    return json.dumps(sorted(existing))
+
+
+@instrumented('store')
+def store_api(auth):
+    """API for storing objects in bulk, such as commits that were made to a local store and are being pushed.
+    The API_OBJECT_LINES parameter has the objects, and the hash of the exact text of each is checked.
+    Unlike commit_api, commits are stored as they are: they are not given a new time or remote address.
+    Any REMOTE_ADDR in a pushed commit was written by the client, so the address of the client that pushed it
+    is recorded in dvs_remote_fqdns, with the time it was pushed.
+    Every object in the before, method or after of a commit must be in the request or already stored.
+    Returns the JSON list of the hexhashes that were stored."""
+    import bottle
+    remote_addr = bottle.request.remote_addr
+
+    try:
+        with dvs_metrics.phase('parse'):
+            items = parse_object_lines(bottle.request.params.getunicode(API_OBJECT_LINES) or '')
+    except ValueError as e:
+        bottle.response.status = 400
+        return f"{API_OBJECT_LINES} parameter is malformed: {e}"
+
+    with dvs_metrics.phase('validate'):
+        (objects, texts, errors) = validate_objects(items, True)
+    if errors:
+        bottle.response.status = 400
+        bottle.response.content_type = 'text/json'
+        return invalid_objects_message(errors)
+    commits = {hexhash:obj for (hexhash, obj) in objects.items()
+               if isinstance(obj, dict) and any([role in obj for role in LINK_ROLES])}
+    for commit in commits.values():
+        if not all([isinstance(commit[role], list) and all([is_hexhash(h) for h in commit[role]])
+                    for role in LINK_ROLES if role in commit]):
+            bottle.response.status = 400
+            return f"commit has a before, method or after that is not a list of hexhashes"
+    # The objects are stored before the commits are linked and checked, and the commits after
+    with dvs_metrics.phase('store_objects'):
+        store_objects(auth, {hexhash:obj for (hexhash, obj) in objects.items() if hexhash not in commits}, texts)
+    with dvs_metrics.phase('exists'):
+        missing = link_and_check(auth, commits, pending=commits) if commits else set()
+    if missing:
+        bottle.response.status = 400
+        return f"{len(missing)} objects in commits are neither in the request nor stored, e.g. {sorted(missing)[0]}"
+    with dvs_metrics.phase('store_objects'):
+        store_objects(auth, commits, texts)
+    for hexhash in commits:
+        reverse_dns.resolve(remote_addr, functools.partial(store_remote_fqdn, auth, hexhash))
+    bottle.response.content_type = 'text/json'
+    return json.dumps(sorted(objects))
+
+
+@instrumented('dump')
 def dump_api(auth):
     """API for dumping"""
     import bottle
@@ -343,11 +1285,19 @@ def dump_api(auth):
     except json.decoder.JSONDecodeError:
         bottle.response.status = 400
         return f"dump parameter is not a valid JSON value"
+    if not isinstance(dump, dict):
+        bottle.response.status = 400
+        return f"dump parameter must be a JSON-encoded dictionary"
+    # The v1 dump pages by OFFSET only; the filters of the v2 dump are rejected rather than ignored
+    unsupported = sorted([key for key in (CURSOR, KIND, SINCE, UNTIL, ORDER) if dump.get(key) is not None])
+    if unsupported:
+        bottle.response.status = 400
+        return f"{', '.join(unsupported)} require the v2 dump."
 
     if LIMIT in dump:
         try:
             limit = int(dump[LIMIT])
-        except ValueError:
+        except (ValueError, TypeError):
             bottle.response.status = 400
             return "limit must be an integer."
     else:
@@ -356,13 +1306,136 @@ def dump_api(auth):
     if OFFSET in dump:
         try:
             offset = int(dump[OFFSET])
-        except ValueError:
+        except (ValueError, TypeError):
             bottle.response.status = 400
             return "offset must be an integer."
     else:
         offset = None
 
-    return json.dumps( dump_objects(auth,limit,offset), default=str)
+    with dvs_metrics.phase('dump'):
+        rows = dump_objects(auth,limit,offset,raw=True)
+    bottle.response.content_type = 'text/json'
+    return stream_json_list(row_json(row) for row in rows)
+
+
+@instrumented('dump_v2')
+def dump_v2_api(auth):
+    """API for the v2 dump. The dump parameter is a JSON dictionary with optional
+    CURSOR, KIND, SINCE, UNTIL, ORDER and LIMIT. The response is streamed as
+    newline-delimited JSON, one object per line; each object includes its objectid,
+    which the client passes back as the CURSOR to continue."""
+    import bottle
+
+    try:
+        dump  = json.loads(bottle.request.params.dump or '{}')
+    except json.decoder.JSONDecodeError:
+        bottle.response.status = 400
+        return f"dump parameter is not a valid JSON value"
+    if not isinstance(dump, dict):
+        bottle.response.status = 400
+        return f"dump parameter must be a JSON-encoded dictionary"
+
+    args = {}
+    for (key, name) in ((CURSOR,'cursor'), (LIMIT,'limit')):
+        if dump.get(key) is not None:
+            try:
+                args[name] = int(dump[key])
+            except (ValueError, TypeError):
+                bottle.response.status = 400
+                return f"{key} must be an integer."
+    for (key, name) in ((KIND,'kind'), (SINCE,'since'), (UNTIL,'until'), (ORDER,'order')):
+        if dump.get(key) is not None:
+            args[name] = dump[key]
+    if args.get('kind') is not None and args['kind'] not in KINDS:
+        bottle.response.status = 400
+        return f"kind must be one of {sorted(KINDS)}"
+    if args.get('order') is not None and args['order'] not in (ORDER_ASC, ORDER_DESC):
+        bottle.response.status = 400
+        return f"order must be {ORDER_ASC} or {ORDER_DESC}"
+
+    # Returning a generator makes bottle send the response with chunked transfer encoding.
+    bottle.response.content_type = 'application/x-ndjson'
+    return (row_json(row) + "\n" for row in iter_dump_objects(auth, raw=True, **args))
+
+
+@instrumented('links')
+def links_api(auth):
+    """API for where-used and uses queries. The links parameter is a JSON dictionary with
+    HEXHASHES (a list), DIRECTION (LINKS_WHERE_USED or LINKS_USES) and an optional ROLE.
+    Returns a JSON list of {PARENT:, CHILD:, ROLE:} links."""
+    import bottle
+
+    try:
+        links = json.loads(bottle.request.params.links)
+    except json.decoder.JSONDecodeError:
+        bottle.response.status = 400
+        return f"links parameter is not a valid JSON value"
+    if not isinstance(links, dict):
+        bottle.response.status = 400
+        return f"links parameter must be a JSON-encoded dictionary"
+    hexhashes = links.get(HEXHASHES)
+    if (not isinstance(hexhashes, list)) or (not all([is_hexadecimal(h) and len(h)==HASHBIN_BYTES*2 for h in hexhashes])):
+        bottle.response.status = 400
+        return f"{HEXHASHES} must be a list of hexhashes"
+    if len(hexhashes)>MAX_SEARCH_OBJECTS:
+        bottle.response.status = 400
+        return f"Links requested for {len(hexhashes)} objects; max is {MAX_SEARCH_OBJECTS}"
+    try:
+        ret = get_links(auth, hexhashes, direction=links.get(DIRECTION, LINKS_WHERE_USED), role=links.get(ROLE))
+    except ValueError as e:
+        bottle.response.status = 400
+        return str(e)
+    bottle.response.content_type = 'text/json'
+    return json.dumps(ret, default=str)
+
+
+@instrumented('lineage')
+def lineage_api(auth):
+    """API for lineage. The lineage parameter is a JSON dictionary with HEXHASH, and optional
+    DIRECTION (LINEAGE_ANCESTORS or LINEAGE_DESCENDANTS) and DEPTH.
+    The response is streamed as newline-delimited JSON: first a {NODE:{HEXHASH:, DEPTH:, OBJECT:}}
+    record for every object in the graph, in order of depth, then a {LINK:{PARENT:, CHILD:, ROLE:}} record for every link."""
+    import bottle
+
+    try:
+        request = json.loads(bottle.request.params.lineage)
+    except json.decoder.JSONDecodeError:
+        bottle.response.status = 400
+        return f"lineage parameter is not a valid JSON value"
+    if not isinstance(request, dict):
+        bottle.response.status = 400
+        return f"lineage parameter must be a JSON-encoded dictionary"
+    hexhash = request.get(HEXHASH)
+    if not (is_hexadecimal(hexhash) and len(hexhash)==HASHBIN_BYTES*2):
+        bottle.response.status = 400
+        return f"{HEXHASH} must be a hexhash"
+    try:
+        (nodes, links) = lineage(auth, hexhash.lower(),
+                                 direction=request.get(DIRECTION, LINEAGE_ANCESTORS),
+                                 depth=int(request.get(DEPTH, DEFAULT_LINEAGE_DEPTH)))
+    except ValueError as e:
+        bottle.response.status = 400
+        return str(e)
+
+    def records():
+        ordered = sorted(nodes, key=lambda node:nodes[node])
+        for offset in range(0, len(ordered), MAX_SEARCH_OBJECTS):
+            group   = ordered[offset:offset+MAX_SEARCH_OBJECTS]
+            objects = get_objects(auth, group)
+            for node in group:
+                yield json.dumps({NODE:{HEXHASH:node, DEPTH:nodes[node], OBJECT:objects.get(node)}}, default=str) + "\n"
+        for link in links:
+            yield json.dumps({LINK:link}, default=str) + "\n"
+
+    bottle.response.content_type = 'application/x-ndjson'
+    return records()
+
+
+def metrics_api(auth):
+    """Return the server metrics in the Prometheus text format"""
+    import bottle
+    bottle.response.content_type = 'text/plain; version=0.0.4'
+    return registry.render()
 
 
 def search_html(auth):
@@ -377,6 +1450,23 @@ def search_html(auth):
                                     tydoc.TyTag('input',attrib={'type':'submit','class':'searchButton'})],
                            attrib={'action':bottle.request.url})
 
-
+    # Full-text search of commits, a page at a time
+    if bottle.request.params.q:
+        from urllib.parse import urlencode
+        try:
+            results = do_v2search(auth, search={TEXT:bottle.request.params.q, CURSOR:bottle.request.params.cursor or None})
+        except ValueError as e:
+            bottle.response.status = 400
+            grid.add_tag_text('p', str(e))
+            return doc.asString()
+        table = tydoc.TyTable()
+        table.add_head(['Created','Hexhash','Author','Dataset','Message'])
+        for row in results:
+            obj = row[OBJECT] if isinstance(row[OBJECT],dict) else {}
+            table.add_data([row[CREATED], row[HEXHASH], obj.get(COMMIT_AUTHOR,''), obj.get(COMMIT_DATASET,''), obj.get(COMMIT_MESSAGE,'')])
+        grid.append(table)
+        if len(results)==MAX_SEARCH_RESULTS:
+            query = urlencode({'q':bottle.request.params.q, 'cursor':results[-1][CURSOR]})
+            grid.add_tag_text('a', 'Next page', attrib={'href':bottle.request.path + '?' + query})
 
     return doc.asString()
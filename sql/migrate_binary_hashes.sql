@@ -0,0 +1,34 @@
+-- Migrate dvs_objects from hexadecimal text hashes to binary hashes.
+--
+-- hexhash varchar(256) in a utf8 table makes the unique index roughly 10x larger than the
+-- 20 bytes that a SHA-1 needs. After this migration:
+--   * hashbin BINARY(20) is the hash column, with a unique index. The server converts to and
+--     from hexadecimal at the API boundary.
+--   * md5bin, sha1bin, sha256bin and sha512bin hold the file hashes of observations, so that
+--     a hash-prefix search is a range scan on an index rather than a JSON scan.
+--
+-- The UPDATE runs over the whole table; on a large table run it in objectid ranges.
+
+ALTER TABLE dvs_objects
+  ADD COLUMN hashbin   BINARY(20) AFTER hexhash,
+  ADD COLUMN md5bin    BINARY(16),
+  ADD COLUMN sha1bin   BINARY(20),
+  ADD COLUMN sha256bin BINARY(32),
+  ADD COLUMN sha512bin BINARY(64);
+
+UPDATE dvs_objects SET
+  hashbin   = UNHEX(hexhash),
+  md5bin    = UNHEX(JSON_UNQUOTE(JSON_EXTRACT(object,'$.hashes.md5'))),
+  sha1bin   = UNHEX(JSON_UNQUOTE(JSON_EXTRACT(object,'$.hashes.sha1'))),
+  sha256bin = UNHEX(JSON_UNQUOTE(JSON_EXTRACT(object,'$.hashes.sha256'))),
+  sha512bin = UNHEX(JSON_UNQUOTE(JSON_EXTRACT(object,'$.hashes.sha512')));
+
+ALTER TABLE dvs_objects
+  DROP INDEX hexhash,
+  DROP COLUMN hexhash,
+  MODIFY hashbin BINARY(20) NOT NULL,
+  ADD UNIQUE INDEX hashbin (hashbin),
+  ADD INDEX md5bin (md5bin),
+  ADD INDEX sha1bin (sha1bin),
+  ADD INDEX sha256bin (sha256bin),
+  ADD INDEX sha512bin (sha512bin);
@@ -0,0 +1,24 @@
+-- Optional compressed storage of objects.
+-- When the server runs with DVS_COMPRESS_OBJECTS=zlib or zstd, new objects other than commits are
+-- stored compressed in object_z and their object column is NULL. zformat is 1 for zlib and 2 for zstd;
+-- zdictid is the zstd dictionary in dvs_zdicts that the object was compressed with, if any.
+-- st_size is filled from the object's metadata by store_objects, so that size searches do not need the JSON.
+-- Existing objects are compressed with daemon/compress_objects.py.
+
+CREATE TABLE dvs_zdicts (
+  zdictid  INT NOT NULL AUTO_INCREMENT,
+  created  TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  zdict    MEDIUMBLOB NOT NULL,
+  PRIMARY KEY (zdictid)
+) ENGINE=InnoDB;
+
+ALTER TABLE dvs_objects
+  ADD COLUMN st_size  BIGINT,
+  ADD COLUMN object_z MEDIUMBLOB,
+  ADD COLUMN zformat  TINYINT,
+  ADD COLUMN zdictid  INT,
+  ADD INDEX st_size (st_size),
+  ADD FOREIGN KEY (zdictid) REFERENCES dvs_zdicts(zdictid);
+
+UPDATE dvs_objects SET st_size = JSON_EXTRACT(object,'$.metadata.st_size')
+WHERE JSON_TYPE(JSON_EXTRACT(object,'$.metadata.st_size'))='INTEGER';
@@ -0,0 +1,13 @@
+-- Garbage collection of ephemeral objects.
+-- ephemeral is 1 for objects stored with ATTRIBUTE_EPHEMERAL; it is filled by store_objects.
+-- daemon/gc_ephemeral.py deletes ephemeral objects that are older than the retention period and
+-- are not used by any commit, using the (ephemeral, created) index to find them.
+-- Objects that are already compressed are not updated here; daemon/compress_objects.py sets the flag
+-- when it compresses an object, so run it after this migration.
+
+ALTER TABLE dvs_objects
+  ADD COLUMN ephemeral TINYINT NOT NULL DEFAULT 0,
+  ADD INDEX ephemeral (ephemeral, created);
+
+UPDATE dvs_objects SET ephemeral=1
+WHERE LOWER(JSON_UNQUOTE(JSON_EXTRACT(object,'$.ephemeral'))) IN ('true','1','yes');
@@ -0,0 +1,18 @@
+-- Full-text search over commit messages, authors and datasets.
+-- commit_message, commit_author and commit_dataset are filled from the object by store_objects
+-- (like the digest columns in migrate_binary_hashes.sql), and share one FULLTEXT index that is
+-- queried by text searches.
+
+ALTER TABLE dvs_objects
+  ADD COLUMN commit_message TEXT,
+  ADD COLUMN commit_author  VARCHAR(256),
+  ADD COLUMN commit_dataset VARCHAR(256);
+
+UPDATE dvs_objects SET
+  commit_message = JSON_UNQUOTE(JSON_EXTRACT(object,'$.message')),
+  commit_author  = LEFT(JSON_UNQUOTE(JSON_EXTRACT(object,'$.author')),256),
+  commit_dataset = LEFT(JSON_UNQUOTE(JSON_EXTRACT(object,'$.datasets')),256)
+WHERE JSON_CONTAINS_PATH(object,'one','$.message','$.author','$.datasets');
+
+ALTER TABLE dvs_objects
+  ADD FULLTEXT INDEX commit_text (commit_message, commit_author, commit_dataset);
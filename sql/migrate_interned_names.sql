@@ -0,0 +1,39 @@
+-- Intern the hostnames, dirnames, filenames, users and groups of stored observations.
+-- Each name is stored once in a lookup table and dvs_objects holds its id; the name is removed
+-- from the object's JSON and put back when the object is read (see INTERNED_FIELDS in dvs/server.py).
+-- The lookup tables use a binary collation so that names that differ only in case are distinct.
+-- Searches match names case-insensitively with the _ci columns added by migrate_name_search.sql.
+-- After running this, intern the objects that are already stored with daemon/intern_names.py.
+
+ALTER TABLE dvs_hostnames MODIFY hostname VARCHAR(256) CHARACTER SET ascii COLLATE ascii_bin NOT NULL;
+ALTER TABLE dvs_dirnames  MODIFY dirname  VARCHAR(256) CHARACTER SET ascii COLLATE ascii_bin NOT NULL;
+ALTER TABLE dvs_filenames MODIFY filename VARCHAR(256) CHARACTER SET ascii COLLATE ascii_bin NOT NULL;
+
+CREATE TABLE dvs_usernames (
+  usernameid INT NOT NULL AUTO_INCREMENT,
+  username   VARCHAR(256) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  PRIMARY KEY (usernameid),
+  UNIQUE INDEX (username)
+) ENGINE=InnoDB;
+
+CREATE TABLE dvs_groupnames (
+  groupnameid INT NOT NULL AUTO_INCREMENT,
+  groupname   VARCHAR(256) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  PRIMARY KEY (groupnameid),
+  UNIQUE INDEX (groupname)
+) ENGINE=InnoDB;
+
+ALTER TABLE dvs_objects
+  ADD COLUMN hostid      INT,
+  ADD COLUMN dirnameid   INT,
+  ADD COLUMN filenameid  INT,
+  ADD COLUMN usernameid  INT,
+  ADD COLUMN groupnameid INT,
+  ADD INDEX hostid (hostid),
+  ADD INDEX dirnameid (dirnameid),
+  ADD INDEX filenameid (filenameid),
+  ADD FOREIGN KEY (hostid)      REFERENCES dvs_hostnames(hostid),
+  ADD FOREIGN KEY (dirnameid)   REFERENCES dvs_dirnames(dirnameid),
+  ADD FOREIGN KEY (filenameid)  REFERENCES dvs_filenames(filenameid),
+  ADD FOREIGN KEY (usernameid)  REFERENCES dvs_usernames(usernameid),
+  ADD FOREIGN KEY (groupnameid) REFERENCES dvs_groupnames(groupnameid);
@@ -0,0 +1,15 @@
+-- dvs_links records the before/method/after membership of every commit as indexed edges,
+-- so that "which commits used this object?" is an index lookup rather than a scan of every
+-- commit's JSON. Rows are written by store_commit; existing commits are loaded with
+-- daemon/backfill_links.py.
+--   parent - hashbin of the commit
+--   child  - hashbin of an object in the commit's before, method or after list
+--   role   - which list the child is in
+
+CREATE TABLE dvs_links (
+  parent BINARY(20) NOT NULL,
+  child  BINARY(20) NOT NULL,
+  role   ENUM('before','method','after') NOT NULL,
+  PRIMARY KEY (parent, role, child),
+  INDEX child (child, role)
+) ENGINE=InnoDB;
@@ -0,0 +1,21 @@
+-- Index name searches.
+-- Searches match names case-insensitively. LOWER() on the lookup tables' binary-collated names cannot
+-- use an index, so each lookup table gets a generated copy of the name with a case-insensitive collation.
+-- Objects with a name that is not interned (too long, not ASCII, or stored before interning) have
+-- names_in_json=1, and only those have their JSON searched. Commits are never flagged.
+-- daemon/intern_names.py clears the flag of the objects that it interns.
+
+ALTER TABLE dvs_hostnames  ADD COLUMN hostname_ci  VARCHAR(256) CHARACTER SET ascii COLLATE ascii_general_ci AS (hostname)  STORED, ADD INDEX hostname_ci (hostname_ci);
+ALTER TABLE dvs_dirnames   ADD COLUMN dirname_ci   VARCHAR(256) CHARACTER SET ascii COLLATE ascii_general_ci AS (dirname)   STORED, ADD INDEX dirname_ci (dirname_ci);
+ALTER TABLE dvs_filenames  ADD COLUMN filename_ci  VARCHAR(256) CHARACTER SET ascii COLLATE ascii_general_ci AS (filename)  STORED, ADD INDEX filename_ci (filename_ci);
+ALTER TABLE dvs_usernames  ADD COLUMN username_ci  VARCHAR(256) CHARACTER SET ascii COLLATE ascii_general_ci AS (username)  STORED, ADD INDEX username_ci (username_ci);
+ALTER TABLE dvs_groupnames ADD COLUMN groupname_ci VARCHAR(256) CHARACTER SET ascii COLLATE ascii_general_ci AS (groupname) STORED, ADD INDEX groupname_ci (groupname_ci);
+
+ALTER TABLE dvs_objects
+  ADD COLUMN names_in_json TINYINT NOT NULL DEFAULT 0,
+  ADD INDEX names_in_json (names_in_json);
+
+UPDATE dvs_objects SET names_in_json=1
+WHERE object IS NOT NULL
+  AND JSON_CONTAINS_PATH(object,'one','$.hostname','$.dirname','$.filename','$.metadata.pw_pwname','$.metadata.gr_name')
+  AND NOT JSON_CONTAINS_PATH(object,'one','$.before','$.method','$.after');
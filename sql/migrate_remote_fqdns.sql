@@ -0,0 +1,16 @@
+-- dvs_remote_fqdns records the hostname of the client that made a commit when the server
+-- had not yet resolved the client's address at the time the commit was stored.
+-- The reverse DNS lookup runs in the background; the hostname cannot be added to the
+-- commit afterwards because that would change its hexhash.
+--   hashbin     - hashbin of the commit
+--   remote_addr - the client's address, which is also the commit's remote_addr
+--   remote_fqdn - the client's hostname, or NULL if the address has no hostname
+
+CREATE TABLE dvs_remote_fqdns (
+  hashbin     BINARY(20) NOT NULL,
+  remote_addr VARCHAR(64) NOT NULL,
+  remote_fqdn VARCHAR(255),
+  resolved    TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (hashbin),
+  INDEX remote_addr (remote_addr)
+) ENGINE=InnoDB;
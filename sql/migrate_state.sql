@@ -0,0 +1,10 @@
+-- dvs_state records facts about the database as name/value pairs.
+-- daemon/backfill_links.py sets links_backfilled when every stored commit has its dvs_links rows;
+-- daemon/gc_ephemeral.py does not delete objects until it is set.
+
+CREATE TABLE dvs_state (
+  name     VARCHAR(64) NOT NULL,
+  value    VARCHAR(255),
+  modified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (name)
+) ENGINE=InnoDB;
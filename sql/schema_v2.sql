@@ -24,9 +24,11 @@ DROP TABLE IF EXISTS `dvs_dirnames`;
 /*!40101 SET character_set_client = utf8 */;
 CREATE TABLE `dvs_dirnames` (
   `dirnameid` int(11) NOT NULL AUTO_INCREMENT,
-  `dirname` varchar(256) NOT NULL,
+  `dirname` varchar(256) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  `dirname_ci` varchar(256) CHARACTER SET ascii COLLATE ascii_general_ci GENERATED ALWAYS AS (`dirname`) STORED,
   PRIMARY KEY (`dirnameid`),
-  UNIQUE KEY `dirname` (`dirname`)
+  UNIQUE KEY `dirname` (`dirname`),
+  KEY `dirname_ci` (`dirname_ci`)
 ) ENGINE=InnoDB AUTO_INCREMENT=175 DEFAULT CHARSET=ascii;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
@@ -39,12 +41,31 @@ DROP TABLE IF EXISTS `dvs_filenames`;
 /*!40101 SET character_set_client = utf8 */;
 CREATE TABLE `dvs_filenames` (
   `filenameid` int(11) NOT NULL AUTO_INCREMENT,
-  `filename` varchar(256) NOT NULL,
+  `filename` varchar(256) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  `filename_ci` varchar(256) CHARACTER SET ascii COLLATE ascii_general_ci GENERATED ALWAYS AS (`filename`) STORED,
   PRIMARY KEY (`filenameid`),
-  UNIQUE KEY `filename` (`filename`)
+  UNIQUE KEY `filename` (`filename`),
+  KEY `filename_ci` (`filename_ci`)
 ) ENGINE=InnoDB AUTO_INCREMENT=175 DEFAULT CHARSET=ascii;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `dvs_groupnames`
+--
+
+DROP TABLE IF EXISTS `dvs_groupnames`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `dvs_groupnames` (
+  `groupnameid` int(11) NOT NULL AUTO_INCREMENT,
+  `groupname` varchar(256) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  `groupname_ci` varchar(256) CHARACTER SET ascii COLLATE ascii_general_ci GENERATED ALWAYS AS (`groupname`) STORED,
+  PRIMARY KEY (`groupnameid`),
+  UNIQUE KEY `groupname` (`groupname`),
+  KEY `groupname_ci` (`groupname_ci`)
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `dvs_hashes`
 --
@@ -89,12 +110,47 @@ DROP TABLE IF EXISTS `dvs_hostnames`;
 /*!40101 SET character_set_client = utf8 */;
 CREATE TABLE `dvs_hostnames` (
   `hostid` int(11) NOT NULL AUTO_INCREMENT,
-  `hostname` varchar(256) NOT NULL,
+  `hostname` varchar(256) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  `hostname_ci` varchar(256) CHARACTER SET ascii COLLATE ascii_general_ci GENERATED ALWAYS AS (`hostname`) STORED,
   PRIMARY KEY (`hostid`),
-  UNIQUE KEY `hostname` (`hostname`)
+  UNIQUE KEY `hostname` (`hostname`),
+  KEY `hostname_ci` (`hostname_ci`)
 ) ENGINE=InnoDB AUTO_INCREMENT=178 DEFAULT CHARSET=ascii;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `dvs_links`
+--
+
+DROP TABLE IF EXISTS `dvs_links`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `dvs_links` (
+  `parent` binary(20) NOT NULL,
+  `child` binary(20) NOT NULL,
+  `role` enum('before','method','after') NOT NULL,
+  PRIMARY KEY (`parent`,`role`,`child`),
+  KEY `child` (`child`,`role`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `dvs_remote_fqdns`
+--
+
+DROP TABLE IF EXISTS `dvs_remote_fqdns`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `dvs_remote_fqdns` (
+  `hashbin` binary(20) NOT NULL,
+  `remote_addr` varchar(64) NOT NULL,
+  `remote_fqdn` varchar(255) DEFAULT NULL,
+  `resolved` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`hashbin`),
+  KEY `remote_addr` (`remote_addr`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `dvs_notes`
 --
@@ -128,16 +184,69 @@ DROP TABLE IF EXISTS `dvs_objects`;
 CREATE TABLE `dvs_objects` (
   `objectid` int(11) NOT NULL AUTO_INCREMENT,
   `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
-  `hexhash` varchar(256) NOT NULL,
+  `hashbin` binary(20) NOT NULL,
   `object` json DEFAULT NULL,
   `url` varchar(1024) DEFAULT NULL,
+  `md5bin` binary(16) DEFAULT NULL,
+  `sha1bin` binary(20) DEFAULT NULL,
+  `sha256bin` binary(32) DEFAULT NULL,
+  `sha512bin` binary(64) DEFAULT NULL,
+  `commit_message` text,
+  `commit_author` varchar(256) DEFAULT NULL,
+  `commit_dataset` varchar(256) DEFAULT NULL,
+  `hostid` int(11) DEFAULT NULL,
+  `dirnameid` int(11) DEFAULT NULL,
+  `filenameid` int(11) DEFAULT NULL,
+  `usernameid` int(11) DEFAULT NULL,
+  `groupnameid` int(11) DEFAULT NULL,
+  `st_size` bigint(20) DEFAULT NULL,
+  `ephemeral` tinyint(4) NOT NULL DEFAULT '0',
+  `names_in_json` tinyint(4) NOT NULL DEFAULT '0',
+  `object_z` mediumblob,
+  `zformat` tinyint(4) DEFAULT NULL,
+  `zdictid` int(11) DEFAULT NULL,
   PRIMARY KEY (`objectid`),
-  UNIQUE KEY `hexhash` (`hexhash`),
+  UNIQUE KEY `hashbin` (`hashbin`),
   KEY `created` (`created`),
-  KEY `url` (`url`)
+  KEY `url` (`url`),
+  KEY `md5bin` (`md5bin`),
+  KEY `sha1bin` (`sha1bin`),
+  KEY `sha256bin` (`sha256bin`),
+  KEY `sha512bin` (`sha512bin`),
+  KEY `hostid` (`hostid`),
+  KEY `dirnameid` (`dirnameid`),
+  KEY `filenameid` (`filenameid`),
+  KEY `usernameid` (`usernameid`),
+  KEY `groupnameid` (`groupnameid`),
+  KEY `st_size` (`st_size`),
+  KEY `ephemeral` (`ephemeral`,`created`),
+  KEY `names_in_json` (`names_in_json`),
+  KEY `zdictid` (`zdictid`),
+  FULLTEXT KEY `commit_text` (`commit_message`,`commit_author`,`commit_dataset`),
+  CONSTRAINT `dvs_objects_ibfk_1` FOREIGN KEY (`hostid`) REFERENCES `dvs_hostnames` (`hostid`),
+  CONSTRAINT `dvs_objects_ibfk_2` FOREIGN KEY (`dirnameid`) REFERENCES `dvs_dirnames` (`dirnameid`),
+  CONSTRAINT `dvs_objects_ibfk_3` FOREIGN KEY (`filenameid`) REFERENCES `dvs_filenames` (`filenameid`),
+  CONSTRAINT `dvs_objects_ibfk_4` FOREIGN KEY (`usernameid`) REFERENCES `dvs_usernames` (`usernameid`),
+  CONSTRAINT `dvs_objects_ibfk_5` FOREIGN KEY (`groupnameid`) REFERENCES `dvs_groupnames` (`groupnameid`),
+  CONSTRAINT `dvs_objects_ibfk_6` FOREIGN KEY (`zdictid`) REFERENCES `dvs_zdicts` (`zdictid`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `dvs_state`
+--
+
+DROP TABLE IF EXISTS `dvs_state`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `dvs_state` (
+  `name` varchar(64) NOT NULL,
+  `value` varchar(255) DEFAULT NULL,
+  `modified` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `dvs_updates`
 --
@@ -169,6 +278,38 @@ CREATE TABLE `dvs_updates` (
   CONSTRAINT `dvs_updates_ibfk_4` FOREIGN KEY (`filenameid`) REFERENCES `dvs_filenames` (`filenameid`)
 ) ENGINE=InnoDB AUTO_INCREMENT=9 DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `dvs_usernames`
+--
+
+DROP TABLE IF EXISTS `dvs_usernames`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `dvs_usernames` (
+  `usernameid` int(11) NOT NULL AUTO_INCREMENT,
+  `username` varchar(256) CHARACTER SET ascii COLLATE ascii_bin NOT NULL,
+  `username_ci` varchar(256) CHARACTER SET ascii COLLATE ascii_general_ci GENERATED ALWAYS AS (`username`) STORED,
+  PRIMARY KEY (`usernameid`),
+  UNIQUE KEY `username` (`username`),
+  KEY `username_ci` (`username_ci`)
+) ENGINE=InnoDB DEFAULT CHARSET=ascii;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `dvs_zdicts`
+--
+
+DROP TABLE IF EXISTS `dvs_zdicts`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `dvs_zdicts` (
+  `zdictid` int(11) NOT NULL AUTO_INCREMENT,
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `zdict` mediumblob NOT NULL,
+  PRIMARY KEY (`zdictid`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
 
 /*!40101 SET SQL_MODE=@OLD_SQL_MODE */;
@@ -1,5 +1,7 @@
+import os
 import sys
 import warnings
+import pytest
 
 sys.path.append("/mnt2/gits/dasexperimental-www/python/")
 
@@ -8,3 +10,39 @@ try:
     import pymysql
 except ModuleNotFoundError as e:
     warnings.warn("Some DVS tests require pymysql")
+
+
+class RecordedTree:
+    """Files under root that were committed, as COMMIT_AFTER, to a local store"""
+    NAMES = ['a', 'b', 'c', os.path.join('sub', 'd')]
+
+    def __init__(self, tmp_path):
+        import dvs
+        from dvs.dvs_constants import COMMIT_AFTER
+        self.root  = tmp_path / 'out'
+        (self.root / 'sub').mkdir(parents=True)
+        self.paths = [str(self.root / name) for name in self.NAMES]
+        for path in self.paths:
+            with open(path, 'w') as f:
+                f.write(f"contents of {os.path.basename(path)}\n")
+        self.dc      = dvs.DVS(local_store=str(tmp_path / 'store'))
+        self.dc.add_local_paths(COMMIT_AFTER, self.paths)
+        self.hexhash = list(self.dc.commit().keys())[0]
+
+    def touch(self, path):
+        """Change the mtime of path but not its contents"""
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 5*10**9))
+
+    def rewrite(self, path, text):
+        """Change the contents and the mtime of path"""
+        st = os.stat(path)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 5*10**9))
+
+
+@pytest.fixture
+def recorded_tree(tmp_path):
+    """The files a, b, c and sub/d, which are recorded in a commit"""
+    return RecordedTree(tmp_path)
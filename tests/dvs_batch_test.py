@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import pytest
+"""
+Test loading the object cache with daemon/batch.py. The database is replaced by a dictionary.
+"""
+
+from os.path import dirname,abspath
+sys.path.append( dirname(dirname(abspath(__file__))))
+
+pytest.importorskip("pymysql")
+pytest.importorskip("boto3")
+pytest.importorskip("ctools")
+
+import dvs.server
+from dvs.dvs_constants import API_OBJECTS,API_COMMIT,COMMIT_MESSAGE
+from dvs.dvs_helpers import canonical_json,hexhash_string,object_cache_key
+
+sys.path.append( os.path.join(dirname(dirname(abspath(__file__))), 'daemon'))
+import batch
+
+DAY = 86400
+T0  = 1600000000                # 2020-09-13
+
+
+def blob_data(commit, objects=None):
+    return {API_OBJECTS:canonical_json(objects or {}), API_COMMIT:canonical_json(commit)}
+
+def write_blob(cache, commit, objects=None, when=None):
+    """Write a blob to the cache directory, named by date if when is given. Returns its hexhash."""
+    data    = blob_data(commit, objects)
+    hexhash = hexhash_string(canonical_json(data))
+    path    = os.path.join(cache, object_cache_key(hexhash, when) if when is not None else hexhash)
+    os.makedirs(dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'source':'dvs', 'data':data}, f)
+    return hexhash
+
+@pytest.fixture
+def stored(monkeypatch):
+    """Store objects in a dictionary rather than the database"""
+    db = {}
+    monkeypatch.setattr(dvs.server, 'store_objects', lambda auth, objects, texts=None: db.update(objects))
+    monkeypatch.setattr(dvs.server, 'store_links', lambda auth, links: None)
+    monkeypatch.setattr(dvs.server, 'existing_hexhashes', lambda auth, hexhashes: set(hexhashes) & set(db))
+    return db
+
+
+def test_mixed_cache(tmp_path, stored):
+    """Undated blobs and each date directory are listed as separate partitions, each with its own position"""
+    cache      = str(tmp_path / 'cache')
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    undated    = [write_blob(cache, {COMMIT_MESSAGE:f'undated {i}'}) for i in range(3)]
+    dated      = [write_blob(cache, {COMMIT_MESSAGE:f'dated {i}'}, when=T0 + i*DAY) for i in range(3)]
+    source     = batch.LocalSource(cache)
+    assert source.partitions()==['', '2020-09-13', '2020-09-14', '2020-09-15']
+    assert [key for (key, size) in source.list('', None, 10)]==sorted(undated)
+
+    stats = batch.ingest(None, source, checkpoint_path=checkpoint, keys_per_round=2)
+    assert stats['stored']==6
+    assert set(undated + dated) <= set(stored)
+    with open(checkpoint) as f:
+        after = json.load(f)[source.name]['after']
+    assert after['']==max(undated)
+    assert set(after)=={'', '2020-09-13', '2020-09-14', '2020-09-15'}
+
+    # A blob in a new date directory is found by the next run
+    later = write_blob(cache, {COMMIT_MESSAGE:'later'}, when=T0 + 5*DAY)
+    assert batch.ingest(None, batch.LocalSource(cache), checkpoint_path=checkpoint)['stored']==1
+    assert later in stored
+
+def test_old_checkpoint(tmp_path, stored):
+    """A position from a checkpoint that listed dated and undated blobs together is not used for undated blobs"""
+    cache      = str(tmp_path / 'cache')
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    # An undated blob whose name sorts before the dated names
+    i = 0
+    while not write_blob(cache, {COMMIT_MESSAGE:f'undated {i}'}).startswith(('0','1')):
+        os.unlink(os.path.join(cache, os.listdir(cache)[0]))
+        i += 1
+    dated  = write_blob(cache, {COMMIT_MESSAGE:'dated'}, when=T0)
+    source = batch.LocalSource(cache)
+    batch.save_checkpoint(checkpoint, {source.name:{'after':{'':object_cache_key(dated, T0)}, 'retry':[]}})
+    assert batch.ingest(None, source, checkpoint_path=checkpoint)['stored']==2
+
+def blob_body(commit, objects=None):
+    return json.dumps({'source':'dvs', 'data':blob_data(commit, objects)}).encode('utf-8')
+
+def make_blob(commit, objects=None):
+    data = blob_data(commit, objects)
+    return batch.Blob(object_cache_key(hexhash_string(canonical_json(data)), T0), blob_body(commit, objects))
+
+def test_blob():
+    """A blob is accepted only if it is an object cache envelope whose data matches its name"""
+    commit = {COMMIT_MESSAGE:'blob'}
+    data   = blob_data(commit)
+    key    = object_cache_key(hexhash_string(canonical_json(data)), T0)
+    blob   = batch.Blob(key, blob_body(commit))
+    assert blob.commit==commit
+    assert blob.hexhash==hexhash_string(canonical_json(data))
+    for (key, body, reason) in [(object_cache_key('0'*40, T0), blob_body(commit), "do not match"),
+                                (key, b'{"source":', "not valid JSON"),
+                                (key, json.dumps({'source':'dvs'}).encode('utf-8'), "not a DVS object cache blob"),
+                                (key, json.dumps({'source':'dvs', 'data':{API_OBJECTS:'[]'}}).encode('utf-8'),
+                                 "not a DVS object cache blob")]:
+        with pytest.raises(ValueError, match=reason):
+            batch.Blob(key, body)
+    data = {API_OBJECTS:canonical_json([1]), API_COMMIT:canonical_json(commit)}
+    with pytest.raises(ValueError, match="objects is not a dictionary"):
+        batch.Blob(object_cache_key(hexhash_string(canonical_json(data)), T0),
+                   json.dumps({'source':'dvs', 'data':data}).encode('utf-8'))
+
+def test_invalid_object(tmp_path, stored):
+    """A blob with an object that does not match its hexhash is rejected"""
+    cache = str(tmp_path / 'cache')
+    write_blob(cache, {COMMIT_MESSAGE:'bad object'}, objects={'0'*40:{'a':1}}, when=T0)
+    good  = write_blob(cache, {COMMIT_MESSAGE:'good'}, when=T0)
+    stats = batch.ingest(None, batch.LocalSource(cache), checkpoint_path=str(tmp_path / 'checkpoint.json'))
+    assert (stats['stored'], stats['rejected'])==(1, 1)
+    assert good in stored
+
+def test_dependency_levels():
+    """Children come before the commits that refer to them"""
+    child  = make_blob({COMMIT_MESSAGE:'child'})
+    middle = make_blob({COMMIT_MESSAGE:'middle', 'before':[child.hexhash]})
+    parent = make_blob({COMMIT_MESSAGE:'parent', 'before':[middle.hexhash], 'after':[child.hexhash, '1'*40]})
+    other  = make_blob({COMMIT_MESSAGE:'other'})
+    blobs  = {blob.hexhash:blob for blob in (parent, middle, child, other)}
+    assert batch.dependency_levels(blobs)==[sorted([child.hexhash, other.hexhash]), [middle.hexhash], [parent.hexhash]]
+
+def test_retry(tmp_path, stored):
+    """A commit whose child is neither stored nor listed waits, and is stored once the child appears"""
+    cache      = str(tmp_path / 'cache')
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    child_data = blob_data({COMMIT_MESSAGE:'late child'})
+    child      = hexhash_string(canonical_json(child_data))
+    parent     = write_blob(cache, {COMMIT_MESSAGE:'parent', 'before':[child]}, when=T0)
+    stats = batch.ingest(None, batch.LocalSource(cache), checkpoint_path=checkpoint)
+    assert (stats['stored'], stats['deferred'])==(0, 1)
+    with open(checkpoint) as f:
+        assert json.load(f)[batch.LocalSource(cache).name]['retry']==[object_cache_key(parent, T0)]
+
+    assert write_blob(cache, {COMMIT_MESSAGE:'late child'}, when=T0+DAY)==child
+    stats = batch.ingest(None, batch.LocalSource(cache), checkpoint_path=checkpoint)
+    assert stats['stored']==2
+    assert {parent, child} <= set(stored)
+    with open(checkpoint) as f:
+        assert json.load(f)[batch.LocalSource(cache).name]['retry']==[]
+
+def test_resume(tmp_path, stored, monkeypatch):
+    """A run that fails continues from its checkpoint, and blobs already stored are not listed again"""
+    cache      = str(tmp_path / 'cache')
+    checkpoint = str(tmp_path / 'checkpoint.json')
+    hexhashes  = [write_blob(cache, {COMMIT_MESSAGE:f'resume {i}'}, when=T0+i) for i in range(4)]
+    store      = dvs.server.store_objects
+    calls      = []
+    def failing_store(auth, objects, texts=None):
+        calls.append(objects)
+        if len(calls)==3:
+            raise OSError("database went away")
+        store(auth, objects, texts)
+    monkeypatch.setattr(dvs.server, 'store_objects', failing_store)
+    with pytest.raises(OSError):
+        batch.ingest(None, batch.LocalSource(cache), checkpoint_path=checkpoint, keys_per_round=1)
+    assert set(hexhashes[0:2]) <= set(stored)
+    assert not set(hexhashes[2:]) & set(stored)
+
+    calls.clear()
+    stats = batch.ingest(None, batch.LocalSource(cache), checkpoint_path=checkpoint, keys_per_round=1)
+    assert stats['stored']==2
+    assert set(hexhashes) <= set(stored)
+    assert batch.ingest(None, batch.LocalSource(cache), checkpoint_path=checkpoint)['stored']==0
+
+def test_fetch_pack(tmp_path):
+    """Each blob in a pack is checked against its hexhash"""
+    from dvs.dvs_spool import PackWriter,INDEX_SUFFIX,PACK_SUFFIX
+    cache  = str(tmp_path / 'cache')
+    writer = PackWriter(cache, spool_dir=str(tmp_path / 'spool'))
+    hexhashes = [writer.add(canonical_json(blob_data({COMMIT_MESSAGE:f'packed {i}'})).encode('utf-8')) for i in range(3)]
+    writer.flush()
+    source = batch.LocalSource(cache)
+    [(key, size)] = [(key, size) for p in source.partitions() for (key, size) in source.list(p, None, 10)
+                     if key.endswith(INDEX_SUFFIX)]
+    results = batch.fetch_pack(source, key)
+    assert sorted([blob.hexhash for (k, blob, reason) in results])==sorted(hexhashes)
+    assert all(blob.packed and blob.url(source).endswith('#'+blob.hexhash) for (k, blob, reason) in results)
+
+    # Damage the second blob
+    pack = os.path.join(cache, key[0:-len(INDEX_SUFFIX)] + PACK_SUFFIX)
+    with open(pack, 'rb') as f:
+        body = f.read()
+    with open(os.path.join(cache, key)) as f:
+        (offset, length) = json.load(f)['blobs'][hexhashes[1]]
+    with open(pack, 'wb') as f:
+        f.write(body[0:offset] + body[offset:offset+length].replace(b'packed', b'PACKED') + body[offset+length:])
+    results = {blob.hexhash if blob else reason.split(':')[0]:reason for (k, blob, reason) in batch.fetch_pack(source, key)}
+    assert results[hexhashes[0]] is None
+    assert "do not match" in results[hexhashes[1]]
+
+    with open(os.path.join(cache, key), 'w') as f:
+        f.write('{')
+    assert batch.fetch_pack(source, key)==[(key, None, "index is not valid JSON")]
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import pytest
+"""
+Test the DVS caches.
+"""
+
+from os.path import dirname,abspath
+sys.path.append( dirname(dirname(abspath(__file__))))
+from dvs.dvs_cache import LRUCache,ObjectCache,ReverseDNSCache
+
+
+def test_lru_max_items():
+    c = LRUCache(max_items=2)
+    c.set('a','1')
+    c.set('b','2')
+    assert c.get('a')=='1'      # a is now most recently used
+    c.set('c','3')
+    assert c.get('b') is None
+    assert c.get('a')=='1'
+    assert c.get('c')=='3'
+    assert len(c)==2
+
+def test_lru_max_bytes():
+    c = LRUCache(max_items=None, max_bytes=10)
+    c.set('a','12345')
+    c.set('b','12345')
+    assert c.nbytes==10
+    c.set('c','123')
+    assert 'a' not in c
+    assert c.nbytes==8
+    c.set('d','X'*11)           # bigger than the whole cache
+    assert 'd' not in c
+
+def test_lru_ttl():
+    c = LRUCache(ttl=0.01)
+    c.set('a','1')
+    c.set('b','2', ttl=60)
+    time.sleep(0.02)
+    assert c.get('a') is None
+    assert c.get('b')=='2'
+
+class FakeShared:
+    def __init__(self):
+        self.d = {}
+    def get_many(self, keys):
+        return {k:self.d[k] for k in keys if k in self.d}
+    def set_many(self, mapping):
+        self.d.update({k:v.encode('utf-8') for (k,v) in mapping.items()})
+    def delete(self, key):
+        self.d.pop(key,None)
+
+def test_object_cache_shared():
+    shared = FakeShared()
+    c1 = ObjectCache(LRUCache(), shared)
+    c2 = ObjectCache(LRUCache(), shared)
+    c1.set_many({'aaaa':'{"a": 1}'})
+    assert c2.get_many(['aaaa','bbbb'])=={'aaaa':'{"a": 1}'}
+    assert c2.missing(['aaaa','bbbb'])=={'bbbb'}
+    c1.discard('aaaa')
+    assert c1.missing(['aaaa'])=={'aaaa'}
+
+class DownShared:
+    def get_many(self, keys):
+        raise ConnectionRefusedError()
+    def set_many(self, mapping):
+        raise TimeoutError()
+    def delete(self, key):
+        raise ConnectionResetError()
+
+def test_object_cache_shared_down():
+    """A shared cache that is down is ignored, and the in-process cache still works"""
+    c = ObjectCache(LRUCache(), DownShared())
+    c.set_many({'aaaa':'{"a": 1}'})
+    assert c.get_many(['aaaa','bbbb'])=={'aaaa':'{"a": 1}'}
+    c.discard('aaaa')
+    assert c.missing(['aaaa'])=={'aaaa'}
+
+def test_reverse_dns_cache():
+    import threading
+    lookups = []
+    def resolver(addr):
+        lookups.append(addr)
+        return 'host.example.com' if addr=='10.0.0.1' else addr
+    rdns = ReverseDNSCache(resolver=resolver)
+    assert rdns.get('10.0.0.1') is None
+    done = threading.Event()
+    results = []
+    def callback(addr, hostname):
+        results.append((addr,hostname))
+        done.set()
+    rdns.resolve('10.0.0.1', callback)
+    assert done.wait(5)
+    assert results==[('10.0.0.1','host.example.com')]
+    assert rdns.get('10.0.0.1')=='host.example.com'
+
+    # A cached address calls back immediately, without another lookup
+    rdns.resolve('10.0.0.1', lambda addr,hostname: results.append((addr,hostname)))
+    assert len(results)==2 and lookups==['10.0.0.1']
+
+    # An address without a hostname resolves to itself and is cached for negative_ttl
+    done.clear()
+    rdns.resolve('10.0.0.2', callback)
+    assert done.wait(5)
+    assert rdns.get('10.0.0.2')=='10.0.0.2'
+    rdns.shutdown()
+
+def test_reverse_dns_failure():
+    """A failed lookup is cached as the address, and a failing callback does not stop the others"""
+    import socket
+    import threading
+    def resolver(addr):
+        raise socket.herror(1, "Unknown host")
+    def broken(addr, hostname):
+        raise ValueError("broken")
+    done = threading.Event()
+    rdns = ReverseDNSCache(resolver=resolver)
+    rdns.resolve('10.0.0.3', broken)
+    rdns.resolve('10.0.0.3', lambda addr,hostname: done.set())
+    assert done.wait(5)
+    assert rdns.get('10.0.0.3')=='10.0.0.3'
+    rdns.shutdown()
+
+def test_client_cache(tmp_path):
+    from dvs.dvs_cache import ClientCache
+    from dvs.dvs_constants import HEXHASH,OBJECT
+    c = ClientCache(str(tmp_path / 'cache.sqlite3'), ttl=0.5, max_bytes=None)
+    c.set_rows([{HEXHASH:'a'*40, OBJECT:{'x':1}}])
+    assert c.get_rows(['a'*40, 'b'*40])=={'a'*40:{HEXHASH:'a'*40, OBJECT:{'x':1}}}
+    c.set_results('k', [1,2,3])
+    assert c.get_results('k')==[1,2,3]
+    time.sleep(0.6)
+    assert c.get_results('k') is None
+    assert c.get_results('k', stale=True)==[1,2,3]
+    c.close()
+
+    # Rows persist, and the least recently used entries are evicted first
+    c = ClientCache(str(tmp_path / 'cache.sqlite3'), max_bytes=200)
+    assert 'a'*40 in c.get_rows(['a'*40])
+    c.set_rows([{HEXHASH:'b'*40, OBJECT:{'y':'z'*100}}])
+    assert c.get_rows(['a'*40])=={}
+    assert 'b'*40 in c.get_rows(['b'*40])
+
+def test_dvs_search_cache(tmp_path, monkeypatch):
+    import requests
+    import dvs
+    from dvs.dvs_constants import HEXHASH,OBJECT,SEARCH,RESULTS,FILENAME,TEXT,SCORE
+    sent = []
+    def server_search(search_list, limit):
+        sent.append(search_list)
+        return [{SEARCH:search, RESULTS:[{HEXHASH:'c'*40, OBJECT:{FILENAME:'f'}, **({SCORE:1.5} if TEXT in search else {})}]}
+                for search in search_list]
+    dc = dvs.DVS(client_cache=str(tmp_path / 'cache.sqlite3'))
+    monkeypatch.setattr(dc, 'server_search', server_search)
+
+    assert dc.search([{TEXT:'f'}])[0][RESULTS][0][SCORE]==1.5
+    assert dc.search([{TEXT:'f'}, {HEXHASH:'c'*40}])[1][RESULTS]==[{HEXHASH:'c'*40, OBJECT:{FILENAME:'f'}}]
+    assert dc.search([{HEXHASH:'c'*40}])[0][RESULTS]==[{HEXHASH:'c'*40, OBJECT:{FILENAME:'f'}}]
+    # The text search was cached, and the object was cached by the exact search, not by the text search's row
+    assert sent==[[{TEXT:'f'}], [{HEXHASH:'c'*40}]]
+
+    # Offline, a previously seen object can still be found
+    def unreachable(search_list, limit):
+        raise requests.exceptions.ConnectionError()
+    monkeypatch.setattr(dc, 'server_search', unreachable)
+    assert dc.search([{HEXHASH:'c'*40}])[0][RESULTS][0][OBJECT]=={FILENAME:'f'}
+    with pytest.raises(requests.exceptions.ConnectionError):
+        dc.search([{FILENAME:'g'}])
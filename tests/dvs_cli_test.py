@@ -58,3 +58,35 @@ def test_do_search(s3loc):
                   % (do_commit,json.dumps(searches,indent=4,default=str)))
 
     raise FileNotFoundError()
+
+
+def test_print_graph(capsys):
+    """Links go from inputs and methods to a commit, and from the commit to its outputs"""
+    dvs_cli.print_graph([{HEXHASH:'c', OBJECT:{COMMIT_BEFORE:['a'], COMMIT_METHOD:['m'], COMMIT_AFTER:['b']}},
+                         {HEXHASH:'a', OBJECT:{FILENAME:'a'}}])
+    graph = json.loads(capsys.readouterr().out)
+    assert sorted(node['id'] for node in graph['nodes'])==['a', 'b', 'c', 'm']
+    assert sorted((link['source'], link['target'], link['strength']) for link in graph['links'])==\
+        [('a', 'c', 0.1), ('c', 'b', 0.1), ('m', 'c', 1.0)]
+
+
+class LineageDVS:
+    """Returns the lineage records of a -> c -> b, with m as the method"""
+    def lineage(self, hexhash, *, direction, depth):
+        yield {NODE:{HEXHASH:'b', DEPTH:0, OBJECT:'s3://bucket/b'}}
+        yield {NODE:{HEXHASH:'c', DEPTH:1, OBJECT:'s3://bucket/c'}}
+        yield {NODE:{HEXHASH:'a', DEPTH:2, OBJECT:'s3://bucket/a'}}
+        yield {NODE:{HEXHASH:'m', DEPTH:2, OBJECT:'s3://bucket/m'}}
+        yield {LINK:{PARENT:'c', CHILD:'b', ROLE:COMMIT_AFTER}}
+        yield {LINK:{PARENT:'c', CHILD:'a', ROLE:COMMIT_BEFORE}}
+        yield {LINK:{PARENT:'c', CHILD:'m', ROLE:COMMIT_METHOD}}
+
+def test_do_lineage(capsys):
+    dvs_cli.do_lineage(LineageDVS(), 'b', direction=LINEAGE_ANCESTORS, depth=2)
+    assert capsys.readouterr().out.splitlines()==['b  s3://bucket/b', '  c  s3://bucket/c',
+                                                  '    a  s3://bucket/a', '    m  s3://bucket/m']
+    dvs_cli.do_lineage(LineageDVS(), 'b', direction=LINEAGE_ANCESTORS, depth=2, graph=True)
+    graph = json.loads(capsys.readouterr().out)
+    assert [node['id'] for node in graph['nodes']]==['b', 'c', 'a', 'm']
+    assert sorted((link['source'], link['target'], link['strength']) for link in graph['links'])==\
+        [('a', 'c', 0.1), ('c', 'b', 0.1), ('m', 'c', 1.0)]
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import os
+import sys
+import pytest
+"""
+Test the compression of stored objects.
+"""
+
+from os.path import dirname,abspath
+sys.path.append( dirname(dirname(abspath(__file__))))
+from dvs.dvs_compress import compress,decompress,have_zstd,train_dictionary,ZFORMAT_ZLIB,ZFORMAT_ZSTD
+from dvs.dvs_helpers import canonical_json
+
+OBJ = {'dirname':'/mnt/data/part-files', 'filename':'part-00001', 'hostname':'ip-10-0-0-1.ec2.internal',
+       'metadata':{'st_size':12345, 'st_mode':33188, 'st_mtime':1600000000, 'pw_pwname':'hadoop'}}
+
+
+def test_zlib():
+    text = canonical_json(OBJ)
+    blob = compress(text, ZFORMAT_ZLIB)
+    assert isinstance(blob,bytes)
+    assert decompress(blob, ZFORMAT_ZLIB)==text
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        compress("{}", 99)
+
+@pytest.mark.skipif(not have_zstd(), reason="zstandard is not installed")
+def test_zstd_dictionary():
+    samples = [canonical_json({**OBJ, 'filename':f'part-{i:05}', 'metadata':{**OBJ['metadata'], 'st_size':i*7919}})
+               for i in range(2000)]
+    zdict = train_dictionary(samples, size=4096)
+    text  = samples[1234]
+    blob  = compress(text, ZFORMAT_ZSTD, zdict)
+    assert len(blob) < len(compress(text, ZFORMAT_ZSTD))
+    assert decompress(blob, ZFORMAT_ZSTD, zdict)==text
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import os
+import sys
+import hashlib
+import pytest
+"""
+Test copying with hashing in the same pass.
+"""
+
+from os.path import dirname,abspath
+sys.path.append( dirname(dirname(abspath(__file__))))
+from dvs.dvs_constants import *
+from dvs.dvs_helpers import Hasher,hash_file
+from dvs.dvs_copy import copy_with_hashes,part_size_for,S3Writer,MAX_PARTS,etag_is_md5
+
+
+def test_hasher():
+    data   = bytes(range(256))*100
+    hasher = Hasher(part_size=1000)
+    for offset in range(0, len(data), 777):
+        hasher.update(data[offset:offset+777])
+    hashes = hasher.hexdigests()
+    assert hashes[SHA256]==hashlib.sha256(data).hexdigest()
+    assert hashes[SHA512]==hashlib.sha512(data).hexdigest()
+    parts  = [hashlib.md5(data[i:i+1000]).digest() for i in range(0, len(data), 1000)]
+    assert hasher.multipart_etag()==hashlib.md5(b"".join(parts)).hexdigest() + f"-{len(parts)}"
+
+def test_part_size_for():
+    assert part_size_for(1000)==64*1024*1024
+    size = 200*1024*1024*1024
+    assert part_size_for(size)*MAX_PARTS >= size
+
+def test_copy_local(tmp_path):
+    src = tmp_path / 'src'
+    src.write_bytes(os.urandom(3*1024*1024+17))
+    (src_obs, dst_obs) = copy_with_hashes(str(src), str(tmp_path / 'dst'))
+    assert (tmp_path / 'dst').read_bytes()==src.read_bytes()
+    assert src_obs[FILE_HASHES]==dst_obs[FILE_HASHES]==hash_file(str(src))
+    assert dst_obs[FILENAME]=='dst'
+    with pytest.raises(FileExistsError):
+        copy_with_hashes(str(src), str(tmp_path / 'dst'))
+
+
+class FakeS3:
+    """Records a multipart upload and returns the ETags that S3 would"""
+    def __init__(self):
+        self.parts = {}
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId':'u1'}
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts[PartNumber] = Body
+        return {'ETag':'"' + hashlib.md5(Body).hexdigest() + '"'}
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = [p['PartNumber'] for p in MultipartUpload['Parts']]
+
+def test_s3_writer():
+    client = FakeS3()
+    writer = S3Writer(client, 's3://bucket/key', part_size=1000)
+    hasher = Hasher(part_size=1000)
+    data   = os.urandom(4500)
+    for offset in range(0, len(data), 300):
+        writer.write(data[offset:offset+300])
+        hasher.update(data[offset:offset+300])
+    assert writer.close()==5
+    assert client.completed==[1, 2, 3, 4, 5]
+    assert b"".join([client.parts[n] for n in client.completed])==data
+    etag = hashlib.md5(b"".join([hashlib.md5(client.parts[n]).digest() for n in client.completed])).hexdigest() + "-5"
+    assert hasher.multipart_etag()==etag
+
+def test_etag_is_md5():
+    assert etag_is_md5({'ETag':'"abc"'})
+    assert etag_is_md5({'ServerSideEncryption':'AES256'})
+    assert not etag_is_md5({'ServerSideEncryption':'aws:kms'})
+    assert not etag_is_md5({'ServerSideEncryption':'aws:kms:dsse'})
+    assert not etag_is_md5({'SSECustomerAlgorithm':'AES256'})
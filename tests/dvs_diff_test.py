@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import os
+import sys
+import pytest
+"""
+Test comparing a directory tree with a commit.
+"""
+
+from os.path import dirname,abspath
+sys.path.append( dirname(dirname(abspath(__file__))))
+import dvs
+from dvs.dvs_constants import *
+from dvs.dvs_diff import *
+
+
+def test_diff_tree(recorded_tree):
+    (dc, hexhash, out, paths) = (recorded_tree.dc, recorded_tree.hexhash, recorded_tree.root, recorded_tree.paths)
+    assert diff_tree(dc, hexhash, str(out))=={DIFF_ADDED:[], DIFF_REMOVED:[], DIFF_MODIFIED:[], DIFF_ERROR:[], 'hashed':0}
+
+    # b is touched but not changed, c is changed without changing its size, sub/d is removed, e is added
+    recorded_tree.touch(paths[1])
+    recorded_tree.rewrite(paths[2], "CONTENTS of c\n")
+    os.unlink(paths[3])
+    with open(out / 'e', 'w') as f:
+        f.write("new\n")
+
+    diff = diff_tree(dc, hexhash, str(out), threads=2)
+    assert diff[DIFF_ADDED]==[str(out / 'e')]
+    assert diff[DIFF_REMOVED]==[paths[3]]
+    assert diff[DIFF_MODIFIED]==[paths[2]]
+    assert diff['hashed']==2
+
+    # Only the files under the root are compared
+    assert diff_tree(dc, hexhash, str(out / 'sub'))[DIFF_REMOVED]==[paths[3]]
+
+def test_symlinks(recorded_tree, tmp_path):
+    """Symbolic links to files and to directories are not files of the tree"""
+    out = recorded_tree.root
+    (tmp_path / 'elsewhere').mkdir()
+    (tmp_path / 'elsewhere' / 'f').write_text("not in the tree\n")
+    os.symlink(recorded_tree.paths[0], out / 'link')
+    os.symlink(tmp_path / 'elsewhere', out / 'dirlink')
+    assert sorted(walk_tree(str(out)))==sorted(recorded_tree.paths)
+    diff = diff_tree(recorded_tree.dc, recorded_tree.hexhash, str(out))
+    assert diff[DIFF_ADDED]==[] and diff[DIFF_REMOVED]==[] and diff[DIFF_MODIFIED]==[]
+
+def test_root_is_file(recorded_tree):
+    """The root may be one recorded file"""
+    (dc, hexhash, path) = (recorded_tree.dc, recorded_tree.hexhash, recorded_tree.paths[0])
+    assert diff_tree(dc, hexhash, path)=={DIFF_ADDED:[], DIFF_REMOVED:[], DIFF_MODIFIED:[], DIFF_ERROR:[], 'hashed':0}
+    recorded_tree.rewrite(path, "different contents of a\n")
+    assert diff_tree(dc, hexhash, path)[DIFF_MODIFIED]==[path]
+    os.unlink(path)
+    assert diff_tree(dc, hexhash, path)[DIFF_REMOVED]==[path]
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import os
+import io
+import sys
+import pytest
+"""
+Test the local object store.
+"""
+
+from os.path import dirname,abspath
+sys.path.append( dirname(dirname(abspath(__file__))))
+import dvs
+from dvs.dvs_constants import *
+from dvs.dvs_local import LocalStore,like
+from dvs.dvs_helpers import canonical_json,hexhash_string
+
+
+def file_obj(i):
+    return {FILENAME:f'part-{i:05}', DIRNAME:'/mnt/data', HOSTNAME:'ip-10-0-0-1',
+            FILE_HASHES:{SHA1:hexhash_string(str(i))}, FILE_METADATA:{ST_SIZE:i}}
+
+def test_like():
+    assert like('part-%', 'PART-00001')
+    assert like('part-0000_', 'part-00001')
+    assert not like('part-0000_', 'part-000011')
+    assert not like('a.c', 'abc')
+    assert like('a\\_c', 'a_c')
+    assert not like('a\\_c', 'abc')
+    assert like('100\\%', '100%')
+    assert not like('100\\%', '1000')
+    assert like('a\\\\b', 'a\\b')
+
+def test_commit_search_dump(tmp_path):
+    dc = dvs.DVS(local_store=str(tmp_path))
+    dc.set_message('local test')
+    for i in range(5):
+        dc.add(COMMIT_AFTER, obj=file_obj(i))
+    commit = dc.commit()
+    (hexhash, obj) = list(commit.items())[0]
+    assert obj[COMMIT_MESSAGE]=='local test'
+    assert len(obj[COMMIT_AFTER])==5
+
+    store = LocalStore(str(tmp_path))
+    assert store.get(hexhash)==obj
+    assert hexhash_string(store.get_text(hexhash))==hexhash
+
+    results = dc.search([{FILENAME:'part-00003'}, {SEARCH_ANY:hexhash[0:8]}, {FILE_METADATA:{ST_SIZE:4}}])
+    assert [row[OBJECT][FILENAME] for row in results[0][RESULTS]]==['part-00003']
+    assert [row[HEXHASH] for row in results[1][RESULTS]]==[hexhash]
+    assert [row[OBJECT][FILENAME] for row in results[2][RESULTS]]==['part-00004']
+
+    rows = list(dc.dump_objects())
+    assert len(rows)==6
+    assert rows[0][HEXHASH]==hexhash
+    assert [row[HEXHASH] for row in dc.dump_objects(kind=KIND_COMMIT)]==[hexhash]
+    assert [row[OBJECTID] for row in dc.dump_objects(order=ORDER_ASC, cursor=4)]==[5, 6]
+    with pytest.raises(ValueError):
+        list(dc.dump_objects(offset=2, kind=KIND_COMMIT))
+
+    assert [row[HEXHASH] for row in dc.text_search('local')]==[hexhash]
+
+def test_search_names(tmp_path):
+    """The FILENAME, DIRNAME and HOSTNAME of a search must all match; SEARCH_ANY matches any of them"""
+    dc = dvs.DVS(local_store=str(tmp_path))
+    dc.add(COMMIT_AFTER, obj=file_obj(1))
+    dc.add(COMMIT_AFTER, obj={**file_obj(1), DIRNAME:'/mnt/other'})
+    dc.add(COMMIT_AFTER, obj={**file_obj(2), DIRNAME:'/mnt/other', HOSTNAME:'part-00001'})
+    dc.commit()
+    def found(search):
+        return sorted((row[OBJECT][DIRNAME], row[OBJECT][FILENAME]) for row in dc.search([search])[0][RESULTS])
+    assert found({FILENAME:'part-00001'})==[('/mnt/data', 'part-00001'), ('/mnt/other', 'part-00001')]
+    assert found({FILENAME:'part-00001', DIRNAME:'/mnt/other'})==[('/mnt/other', 'part-00001')]
+    assert found({FILENAME:'part-00001', DIRNAME:'/mnt/%', HOSTNAME:'ip-10-0-0-1'})==[('/mnt/data', 'part-00001'),
+                                                                                     ('/mnt/other', 'part-00001')]
+    assert found({FILENAME:'part-00001', DIRNAME:'/mnt/nowhere'})==[]
+    assert found({SEARCH_ANY:'part-00001'})==[('/mnt/data', 'part-00001'), ('/mnt/other', 'part-00001'),
+                                              ('/mnt/other', 'part-00002')]
+
+def test_children(tmp_path):
+    dc = dvs.DVS(local_store=str(tmp_path))
+    for i in range(MAX_OBJECTS_LIST+10):
+        dc.add(COMMIT_AFTER, obj=file_obj(i))
+    commit = list(dc.commit().values())[0]
+    assert len(commit[COMMIT_AFTER])==2
+    assert len(list(dc.dump_objects(kind=KIND_COMMIT)))==3
+
+def test_push(tmp_path):
+    dc = dvs.DVS(local_store=str(tmp_path))
+    dc.add(COMMIT_AFTER, obj=file_obj(1))
+    dc.add(COMMIT_AFTER, obj=file_obj(2))
+    dc.commit()
+
+    # The server already has one of the objects
+    server = {hexhash_string(canonical_json(file_obj(1)))}
+    sent   = []
+    dc.exists = lambda hexhashes: set(hexhashes) & server
+    def store_object_lines(text):
+        for line in text.splitlines():
+            (hexhash, value) = line.split(" ", 1)
+            assert hexhash_string(value)==hexhash
+            sent.append(hexhash)
+            server.add(hexhash)
+    dc.store_object_lines = store_object_lines
+    assert dc.push(batch_size=2)==2
+    assert len(server)==3
+    # The commit is sent after its objects
+    assert sent[-1]==list(dc.dump_objects(kind=KIND_COMMIT))[0][HEXHASH]
+    assert dc.push()==0
+
+def test_add_manifest(tmp_path, monkeypatch):
+    monkeypatch.setattr(dvs, 'MAX_OBJECTS_LIST', 10)
+    paths = []
+    for i in range(250):
+        path = tmp_path / f'file{i}'
+        path.write_text(str(i))
+        paths.append(str(path))
+    dc    = dvs.DVS(local_store=str(tmp_path / 'store'))
+    stats = dc.add_manifest(COMMIT_BEFORE, iter(paths + [str(tmp_path / 'missing')]), threads=4, progress=None)
+    assert stats['files']==250 and stats['skipped']==1
+    commit = list(dc.commit().values())[0]
+    assert 0 < len(commit[COMMIT_BEFORE]) <= 10
+
+    # Every file is reachable from the commit, and no commit has more than MAX_OBJECTS_LIST objects
+    store = LocalStore(str(tmp_path / 'store'))
+    found = set()
+    todo  = list(commit[COMMIT_BEFORE])
+    while todo:
+        obj = store.get(todo.pop())
+        if COMMIT_BEFORE in obj:
+            assert len(obj[COMMIT_BEFORE]) <= 10
+            todo.extend(obj[COMMIT_BEFORE])
+        else:
+            found.add(os.path.join(obj[DIRNAME], obj[FILENAME]))
+    assert found==set(paths)
+
+def test_add_manifest_find(tmp_path):
+    """The output of find -print0, which includes directories, is registered without skipping anything"""
+    import subprocess
+    from dvs.dvs_helpers import read_manifest
+    root = tmp_path / 'root'
+    (root / 'sub').mkdir(parents=True)
+    for path in (root / 'a', root / 'sub' / 'b'):
+        path.write_text(path.name)
+    listing = subprocess.run(['find', str(root), '-print0'], stdout=subprocess.PIPE, check=True).stdout
+    dc    = dvs.DVS(local_store=str(tmp_path / 'store'))
+    stats = dc.add_manifest(COMMIT_BEFORE, read_manifest(io.BytesIO(listing)), threads=2, progress=None)
+    assert stats['files']==2 and stats['skipped']==0
+
+def test_add_manifest_s3_forbidden(tmp_path, monkeypatch):
+    """An S3 object that cannot be read is skipped like a local file that cannot be read"""
+    import boto3
+    from botocore.exceptions import ClientError
+    class Forbidden:
+        @property
+        def content_length(self):
+            raise ClientError({'Error':{'Code':'403', 'Message':'Forbidden'}}, 'HeadObject')
+    class Resource:
+        def Object(self, bucket, key):
+            return Forbidden()
+    monkeypatch.setattr(boto3, 'resource', lambda *args, **kwargs: Resource())
+    path = tmp_path / 'file'
+    path.write_text('file')
+    dc    = dvs.DVS(local_store=str(tmp_path / 'store'))
+    stats = dc.add_manifest(COMMIT_BEFORE, iter([str(path), 's3://bucket/forbidden']), threads=2, progress=None)
+    assert stats['files']==1 and stats['skipped']==1
+
+def test_concurrent_processes(tmp_path):
+    """Processes that store the same objects in one store log each object once"""
+    import multiprocessing
+    objects = {hexhash_string(canonical_json(file_obj(i))):file_obj(i) for i in range(200)}
+    ctx     = multiprocessing.get_context('fork')
+    procs   = [ctx.Process(target=LocalStore(str(tmp_path)).store_objects, args=(objects,)) for i in range(4)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    assert sorted([hexhash for (hexhash, created) in LocalStore(str(tmp_path)).log()])==sorted(objects)
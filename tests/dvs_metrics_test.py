@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import os
+import sys
+"""
+Test the DVS server metrics.
+"""
+
+from os.path import dirname,abspath
+sys.path.append( dirname(dirname(abspath(__file__))))
+from dvs import dvs_metrics
+
+
+def test_counter():
+    r = dvs_metrics.Registry()
+    c = r.counter('dvs_test_total', 'test counter', ['endpoint'])
+    c.inc(endpoint='commit')
+    c.inc(2, endpoint='commit')
+    assert c.get(endpoint='commit')==3
+    assert c.get(endpoint='search')==0
+    assert 'dvs_test_total{endpoint="commit"} 3' in r.render()
+
+def test_histogram():
+    r = dvs_metrics.Registry()
+    h = r.histogram('dvs_test_seconds', 'test histogram', ['endpoint'], buckets=[0.1, 1.0])
+    h.observe(0.05, endpoint='dump')
+    h.observe(0.5,  endpoint='dump')
+    h.observe(5.0,  endpoint='dump')
+    assert h.get(endpoint='dump')==(3, 5.55)
+    text = r.render()
+    assert '# TYPE dvs_test_seconds histogram' in text
+    assert 'dvs_test_seconds_bucket{endpoint="dump",le="0.1"} 1' in text
+    assert 'dvs_test_seconds_bucket{endpoint="dump",le="1.0"} 2' in text
+    assert 'dvs_test_seconds_bucket{endpoint="dump",le="+Inf"} 3' in text
+    assert 'dvs_test_seconds_count{endpoint="dump"} 3' in text
+
+def test_labels_required():
+    r = dvs_metrics.Registry()
+    c = r.counter('dvs_test_total', 'test counter', ['endpoint'])
+    try:
+        c.inc(status=200)
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+def test_phases():
+    r = dvs_metrics.Registry()
+    h = r.histogram('dvs_test_phase_seconds', 'test phases', ['endpoint','phase'])
+    with dvs_metrics.phase('outside'):
+        pass
+    with dvs_metrics.request('commit', h) as timing:
+        with dvs_metrics.phase('parse'):
+            pass
+        with dvs_metrics.phase('parse'):
+            pass
+        assert dvs_metrics.current_request() is timing
+    assert dvs_metrics.current_request() is None
+    assert set(timing.phases.keys())=={'parse'}
+    assert h.get(endpoint='commit', phase='parse')[0]==2
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import os
+import sys
+import hashlib
+import pytest
+"""
+Test the metadata plugins that run while files are hashed.
+"""
+
+from os.path import dirname,abspath
+sys.path.append( dirname(dirname(abspath(__file__))))
+from dvs import dvs_plugins
+from dvs.dvs_constants import *
+from dvs.dvs_plugins import *
+from dvs.dvs_helpers import Hasher,hash_filehandle,get_file_observation_with_hash
+
+HEADER = b"# line one\n#\n# line three\n"
+DATA   = b"1|2|3\n#not header\n" * 10000
+
+def feed(plugin, data, block_size):
+    for i in range(0, len(data), block_size):
+        if plugin.update(data[i:i+block_size]) is False:
+            break
+    return plugin.result()
+
+@pytest.mark.parametrize("block_size", [1, 3, 7, 1024, 1024*1024])
+def test_header_digests(block_size):
+    data = HEADER + DATA
+    if block_size==1:
+        data = HEADER + DATA[0:100]
+    result = feed(HeaderDigestsPlugin(), data, block_size)
+    assert result['header_bytes']==len(HEADER)
+    assert result['header_sha1']==hashlib.sha1(HEADER).hexdigest()
+    assert result['data_sha1']==hashlib.sha1(data[len(HEADER):]).hexdigest()
+
+def test_fingerprint():
+    data   = HEADER + DATA
+    plugin = FingerprintPlugin()
+    assert feed(plugin, data, 10000)=={'first64k_sha1':hashlib.sha1(data[0:FINGERPRINT_BYTES]).hexdigest()}
+    # It stops as soon as it has FINGERPRINT_BYTES
+    assert plugin.count==FINGERPRINT_BYTES
+    assert feed(FingerprintPlugin(), b'short', 2)=={'first64k_sha1':hashlib.sha1(b'short').hexdigest()}
+
+class Counter:
+    blocks = 0
+    def update(self, block):
+        Counter.blocks += 1
+        return Counter.blocks < 2
+    def result(self):
+        return {'blocks':Counter.blocks}
+
+class Broken:
+    def update(self, block):
+        raise ValueError("broken")
+    def result(self):
+        return {'broken':True}
+
+def test_pipeline(tmp_path, monkeypatch):
+    import io
+    monkeypatch.setattr(dvs_plugins, '_registry', dict(dvs_plugins._registry))
+    register('counter', Counter)
+    register('broken', Broken)
+    data     = HEADER + DATA
+    pipeline = plugin_pipeline(['counter', 'broken', 'header_digests', 'missing'])
+    hashes   = hash_filehandle(io.BytesIO(data * 10), pipeline)
+    assert hashes[SHA1]==hashlib.sha1(data * 10).hexdigest()
+    result   = pipeline.result()
+    # counter stopped after two blocks, and broken was dropped without stopping the others
+    assert result['blocks']==2 and 'broken' not in result
+    assert result['header_bytes']==len(HEADER)
+
+    path = tmp_path / 'data.txt'
+    path.write_bytes(data)
+    monkeypatch.setattr(dvs_plugins, '_enabled', None)
+    monkeypatch.setenv(DVS_PLUGINS_ENV, '')
+    assert FILE_CONTENT not in get_file_observation_with_hash(str(path))
+    enable('fingerprint,header_digests')
+    obj = get_file_observation_with_hash(str(path))
+    assert obj[FILE_CONTENT]['first64k_sha1']==hashlib.sha1(data[0:FINGERPRINT_BYTES]).hexdigest()
+    assert obj[FILE_CONTENT]['data_sha1']==hashlib.sha1(DATA).hexdigest()
+    assert obj[FILE_HASHES][SHA1]==hashlib.sha1(data).hexdigest()
+
+def test_no_reuse_with_plugins(tmp_path, monkeypatch):
+    """With plugins enabled, every file is hashed, so it gets the same observation as get_file_observation_with_hash"""
+    from dvs.observations import get_file_observations
+    path = tmp_path / 'data.txt'
+    path.write_bytes(HEADER + DATA)
+    monkeypatch.setattr(dvs_plugins, '_enabled', None)
+    enable('fingerprint')
+    # The server is not searched, so the endpoint is never contacted
+    (obj,) = get_file_observations([str(path)], search_endpoint='http://unreachable.invalid/search')
+    assert obj==get_file_observation_with_hash(str(path))
+    assert FILE_CONTENT in obj
@@ -58,6 +58,27 @@ def test_store_objects(dbwriter_auth):
     assert url3 in vals
 
 
+def exact_items(n):
+    """Objects whose text is not canonical JSON, as (hexhash, text) pairs"""
+    texts = [f'{{"test": "exact", "n": {i}, "time": {time.time()}}}' for i in range(n)]
+    return [(dvs.dvs_helpers.hexhash_string(text), text) for text in texts]
+
+def test_store_exact_texts(monkeypatch):
+    """Every group of objects is stored with the text it was received as, not just the first"""
+    inserted = []
+    monkeypatch.setattr(dvs.server, 'csfr', lambda auth, name, cmd, vals, **kwargs: inserted.extend(vals))
+    (objects, texts, errors) = dvs.server.validate_objects(exact_items(25), True)
+    assert not errors
+    dvs.server.store_objects(None, objects, texts)
+    assert all(text in inserted for text in texts.values())
+
+def test_store_exact_texts_db(dbwriter_auth):
+    if not dbwriter_auth:
+        return
+    (objects, texts, errors) = dvs.server.validate_objects(exact_items(25), True)
+    dvs.server.store_objects(dbwriter_auth, objects, texts)
+    assert dvs.server.existing_hexhashes(dbwriter_auth, objects)==set(objects)
+
 def test_store_commit(dbwriter_auth):
     """Store a file update for a single file in the database"""
     if not dbwriter_auth:
@@ -79,3 +100,281 @@ def test_store_commit(dbwriter_auth):
     commit = {dvs_constants.COMMIT_BEFORE:list(objects.keys()),
               dvs_constants.ATTRIBUTE_EPHEMERAL:"true" }
     dvs.server.store_commit(dbwriter_auth, commit)
+
+def test_gc_ephemeral(dbwriter_auth):
+    """An ephemeral object is collectable unless a commit uses it."""
+    if not dbwriter_auth:
+        return
+    unused  = {'test':'gc unused', 'time':time.time(), dvs_constants.ATTRIBUTE_EPHEMERAL:'true'}
+    used    = {'test':'gc used',   'time':time.time(), dvs_constants.ATTRIBUTE_EPHEMERAL:'true'}
+    objects = dvs.dvs_helpers.objects_dict([unused, used])
+    dvs.server.store_objects(dbwriter_auth, objects)
+    (unused_hash, used_hash) = list(objects.keys())
+    dvs.server.store_commit(dbwriter_auth, {dvs_constants.COMMIT_BEFORE:[used_hash]})
+
+    candidates = dvs.server.gc_candidates(dbwriter_auth, older_than=time.time()+60, limit=1000000)
+    hexhashes  = [row[dvs_constants.HEXHASH] for row in candidates]
+    assert unused_hash in hexhashes
+    assert used_hash not in hexhashes
+
+    deleted = dvs.server.delete_objects(dbwriter_auth, [row for row in candidates if row[dvs_constants.HEXHASH]==unused_hash])
+    assert deleted==[unused_hash]
+    assert unused_hash not in dvs.server.get_objects(dbwriter_auth, [unused_hash])
+    assert used_hash in dvs.server.get_objects(dbwriter_auth, [used_hash])
+
+def test_gc_then_reuse(dbwriter_auth):
+    """A commit cannot use an ephemeral object after the garbage collector deleted it,
+    and storing the object again puts it back, even though this process has seen it before."""
+    if not dbwriter_auth:
+        return
+    obj     = {'test':'gc reuse', 'time':time.time(), dvs_constants.ATTRIBUTE_EPHEMERAL:'true'}
+    objects = dvs.dvs_helpers.objects_dict([obj])
+    hexhash = list(objects.keys())[0]
+    dvs.server.store_objects(dbwriter_auth, objects)
+    assert hexhash in dvs.server.get_objects(dbwriter_auth, [hexhash])
+
+    candidates = dvs.server.gc_candidates(dbwriter_auth, older_than=time.time()+60, limit=1000000)
+    assert dvs.server.delete_objects(dbwriter_auth, [row for row in candidates if row[dvs_constants.HEXHASH]==hexhash])==[hexhash]
+    assert hexhash not in dvs.server.existing_hexhashes(dbwriter_auth, [hexhash])
+    with pytest.raises(ValueError):
+        dvs.server.store_commit(dbwriter_auth, {dvs_constants.COMMIT_BEFORE:[hexhash]})
+    assert dvs.server.where_used(dbwriter_auth, [hexhash])==[]
+
+    dvs.server.store_objects(dbwriter_auth, objects)
+    commit = dvs.server.store_commit(dbwriter_auth, {dvs_constants.COMMIT_BEFORE:[hexhash]})
+    assert [link[dvs_constants.PARENT] for link in dvs.server.where_used(dbwriter_auth, [hexhash])]==list(commit.keys())
+
+def test_gc_requires_backfill(monkeypatch):
+    """The garbage collector does not delete anything until dvs_links is known to be complete"""
+    pytest.importorskip("ctools")
+    sys.path.append(os.path.join(dirname(dirname(abspath(__file__))), 'daemon'))
+    import gc_ephemeral
+    monkeypatch.setattr(dvs.server, 'get_state', lambda auth, name: None)
+    monkeypatch.setattr(dvs.server, 'gc_candidates', lambda auth, **kwargs: [])
+    with pytest.raises(RuntimeError):
+        gc_ephemeral.gc_pass(None, dry_run=False)
+    assert gc_ephemeral.gc_pass(None, dry_run=True)==(0, 0)
+
+def test_links(dbwriter_auth):
+    """store_links records each role of a commit, and where_used and uses find them in either direction"""
+    if not dbwriter_auth:
+        return
+    objects = dvs.dvs_helpers.objects_dict([{'test':f'links {name}', 'time':time.time()} for name in ('a', 'm', 'b')])
+    (a, m, b) = list(objects.keys())
+    commit  = {dvs_constants.COMMIT_BEFORE:[a], dvs_constants.COMMIT_METHOD:[m], dvs_constants.COMMIT_AFTER:[b, a]}
+    c       = dvs.dvs_helpers.canonical_json_hexhash(commit)
+    dvs.server.store_links(dbwriter_auth, {c:commit})
+    dvs.server.store_links(dbwriter_auth, {c:commit})      # storing links again does nothing
+
+    def triples(links):
+        return sorted((link[dvs_constants.PARENT], link[dvs_constants.CHILD], link[dvs_constants.ROLE]) for link in links)
+    assert triples(dvs.server.uses(dbwriter_auth, [c]))==sorted([(c, a, 'before'), (c, m, 'method'), (c, b, 'after'), (c, a, 'after')])
+    assert triples(dvs.server.uses(dbwriter_auth, [c], role=dvs_constants.COMMIT_AFTER))==sorted([(c, b, 'after'), (c, a, 'after')])
+    assert triples(dvs.server.where_used(dbwriter_auth, [a]))==sorted([(c, a, 'before'), (c, a, 'after')])
+    assert triples(dvs.server.where_used(dbwriter_auth, [a, m], role=dvs_constants.COMMIT_METHOD))==[(c, m, 'method')]
+    assert dvs.server.where_used(dbwriter_auth, [c])==[]
+
+def test_links_bad_request():
+    with pytest.raises(ValueError):
+        dvs.server.get_links(None, ['0'*40], direction='sideways')
+    with pytest.raises(ValueError):
+        dvs.server.where_used(None, ['0'*40], role='input')
+
+def test_backfill_links(monkeypatch):
+    """Entries of legacy commits that are not hexhashes are skipped"""
+    pytest.importorskip("ctools")
+    sys.path.append(os.path.join(dirname(dirname(abspath(__file__))), 'daemon'))
+    import backfill_links
+    (a, b) = ('a'*40, 'b'*40)
+    rows   = [{dvs_constants.OBJECTID:1, dvs_constants.HEXHASH:'1'*40,
+               dvs_constants.OBJECT:{dvs_constants.COMMIT_BEFORE:[a, 's3://bucket/key'], dvs_constants.COMMIT_AFTER:[b]}},
+              {dvs_constants.OBJECTID:2, dvs_constants.HEXHASH:'2'*40,
+               dvs_constants.OBJECT:{dvs_constants.COMMIT_METHOD:'not a list', dvs_constants.COMMIT_AFTER:[a]}}]
+    stored = {}
+    state  = {}
+    monkeypatch.setattr(dvs.server, 'iter_dump_objects', lambda auth, **kwargs: iter(rows))
+    monkeypatch.setattr(dvs.server, 'store_links', lambda auth, commits: stored.update(commits))
+    monkeypatch.setattr(dvs.server, 'set_state', lambda auth, name, value: state.update({name:value}))
+    assert backfill_links.backfill_links(None)==2
+    assert stored['1'*40]=={dvs_constants.COMMIT_BEFORE:[a], dvs_constants.COMMIT_METHOD:[], dvs_constants.COMMIT_AFTER:[b]}
+    assert stored['2'*40]=={dvs_constants.COMMIT_BEFORE:[], dvs_constants.COMMIT_METHOD:[], dvs_constants.COMMIT_AFTER:[a]}
+    assert dvs.server.STATE_LINKS_BACKFILLED in state
+
+def test_lineage(dbwriter_auth):
+    """Lineage follows data from inputs and methods through commits to outputs, up to the depth limit"""
+    if not dbwriter_auth:
+        return
+    stamp   = time.time()
+    objects = dvs.dvs_helpers.objects_dict([{'test':f'lineage {name}', 'time':stamp} for name in ('a', 'm', 'b', 'd')])
+    (a, m, b, d) = list(objects.keys())
+    dvs.server.store_objects(dbwriter_auth, objects)
+    c1 = list(dvs.server.store_commit(dbwriter_auth, {dvs_constants.COMMIT_BEFORE:[a], dvs_constants.COMMIT_METHOD:[m],
+                                                       dvs_constants.COMMIT_AFTER:[b]}).keys())[0]
+    c2 = list(dvs.server.store_commit(dbwriter_auth, {dvs_constants.COMMIT_BEFORE:[b], dvs_constants.COMMIT_AFTER:[d]}).keys())[0]
+
+    (nodes, links) = dvs.server.lineage(dbwriter_auth, d)
+    assert nodes=={d:0, c2:1, b:2, c1:3, a:4, m:4}
+    assert {(link[dvs_constants.PARENT], link[dvs_constants.CHILD], link[dvs_constants.ROLE]) for link in links}==\
+        {(c2, d, 'after'), (c2, b, 'before'), (c1, b, 'after'), (c1, a, 'before'), (c1, m, 'method')}
+    assert dvs.server.lineage(dbwriter_auth, d)[0] is nodes
+    assert dvs.server.lineage(dbwriter_auth, d, depth=2)[0]=={d:0, c2:1, b:2}
+
+    (nodes, links) = dvs.server.lineage(dbwriter_auth, m, direction=dvs_constants.LINEAGE_DESCENDANTS)
+    assert nodes=={m:0, c1:1, b:2, c2:3, d:4}
+
+    # A new commit clears the cached lineage
+    c3 = list(dvs.server.store_commit(dbwriter_auth, {dvs_constants.COMMIT_BEFORE:[d]}).keys())[0]
+    assert c3 in dvs.server.lineage(dbwriter_auth, m, direction=dvs_constants.LINEAGE_DESCENDANTS)[0]
+
+def test_lineage_bad_request():
+    with pytest.raises(ValueError):
+        dvs.server.lineage(None, '0'*40, direction='sideways')
+    with pytest.raises(ValueError):
+        dvs.server.lineage(None, '0'*40, depth=dvs.server.MAX_LINEAGE_DEPTH+1)
+
+def test_search_names(dbwriter_auth):
+    """Names are found whatever their case, including names that are not interned"""
+    if not dbwriter_auth:
+        return
+    stamp   = str(time.time())
+    objects = dvs.dvs_helpers.objects_dict([{dvs_constants.FILENAME:'Case'+stamp+'.TXT', dvs_constants.DIRNAME:'/tmp'},
+                                            {dvs_constants.FILENAME:'café'+stamp, dvs_constants.DIRNAME:'/tmp'}])
+    dvs.server.store_objects(dbwriter_auth, objects)
+    for name in ('case'+stamp+'.txt', 'CAFÉ'+stamp):
+        rows = dvs.server.do_v2search(dbwriter_auth, search={dvs_constants.FILENAME:name})
+        assert len([row for row in rows if row[dvs_constants.HEXHASH] in objects])==1
+
+def test_search_names_and(dbwriter_auth):
+    """The FILENAME, DIRNAME and HOSTNAME of a search must all match; SEARCH_ANY matches any of them"""
+    if not dbwriter_auth:
+        return
+    name    = 'and' + str(time.time())
+    objects = dvs.dvs_helpers.objects_dict([{dvs_constants.FILENAME:name, dvs_constants.DIRNAME:'/a'},
+                                            {dvs_constants.FILENAME:name, dvs_constants.DIRNAME:'/b'},
+                                            {dvs_constants.FILENAME:'other', dvs_constants.DIRNAME:'/b', dvs_constants.HOSTNAME:name}])
+    dvs.server.store_objects(dbwriter_auth, objects)
+    def found(search):
+        return len([row for row in dvs.server.do_v2search(dbwriter_auth, search=search) if row[dvs_constants.HEXHASH] in objects])
+    assert found({dvs_constants.FILENAME:name})==2
+    assert found({dvs_constants.FILENAME:name, dvs_constants.DIRNAME:'/b'})==1
+    assert found({dvs_constants.FILENAME:name, dvs_constants.DIRNAME:'/c'})==0
+    assert found({dvs_constants.SEARCH_ANY:name})==3
+
+def test_names_in_json():
+    """Only objects with names that are not interned have their JSON searched for names"""
+    obs = {dvs_constants.FILENAME:'a.txt', dvs_constants.DIRNAME:'/tmp'}
+    assert dvs.server.names_in_json(obs, {'filenameid':1, 'dirnameid':2})==0
+    assert dvs.server.names_in_json(obs, {'dirnameid':2})==1
+    assert dvs.server.names_in_json({dvs_constants.FILENAME:'x'*1000}, {})==1
+    assert dvs.server.names_in_json({dvs_constants.COMMIT_BEFORE:[], dvs_constants.FILENAME:'a.txt'}, {})==0
+
+def test_compressible():
+    """Objects are compressed only if all of their names can be interned"""
+    assert dvs.server.compressible({dvs_constants.FILENAME:'a.txt', dvs_constants.DIRNAME:'/tmp'})
+    assert not dvs.server.compressible({dvs_constants.FILENAME:'café.txt', dvs_constants.DIRNAME:'/tmp'})
+    assert not dvs.server.compressible({dvs_constants.FILE_METADATA:{'pw_pwname':'x'*1000}})
+    assert not dvs.server.compressible({dvs_constants.COMMIT_AFTER:[]})
+
+def test_row_text():
+    """Rows are cached as the canonical JSON that store_objects caches, not as MySQL returns it"""
+    obj = {'b':1, 'a':[1, 2]}
+    assert dvs.server.row_text({dvs_constants.OBJECT:'{"a": [1, 2], "b": 1}', 'url':None})==dvs.dvs_helpers.canonical_json(obj)
+    assert dvs.server.row_text({dvs_constants.OBJECT:None, 'url':'s3://bucket/key'})=='s3://bucket/key'
+
+def test_instrumented():
+    """Requests that fail are counted, and phases of streamed responses are attributed to their endpoint"""
+    import bottle
+    from dvs import dvs_metrics
+    bottle.request.bind({})
+    bottle.response.bind()
+
+    @dvs.server.instrumented('test_fail')
+    def fail(auth):
+        raise ValueError("fail")
+    with pytest.raises(ValueError):
+        fail(None)
+    assert dvs.server.REQUESTS.get(endpoint='test_fail', status=500)==1
+
+    @dvs.server.instrumented('test_stream')
+    def stream(auth):
+        def chunks():
+            with dvs_metrics.phase('query'):
+                pass
+            yield 'a'
+            yield 'b'
+        return chunks()
+    assert list(stream(None))==['a', 'b']
+    assert dvs.server.PHASE_SECONDS.get(endpoint='test_stream', phase='query')[0]==1
+    assert dvs.server.REQUESTS.get(endpoint='test_stream', status=200)==1
+    assert dvs_metrics.current_request() is None
+
+def test_store_api_provenance(monkeypatch):
+    """The address of the client that pushes a commit is recorded, whatever the commit says"""
+    import bottle
+    obj     = {'test':'pushed'}
+    commit  = {dvs_constants.COMMIT_BEFORE:[dvs.dvs_helpers.canonical_json_hexhash(obj)], dvs_constants.REMOTE_ADDR:'10.0.0.1'}
+    objects = dvs.dvs_helpers.objects_dict([obj, commit])
+    chash   = dvs.dvs_helpers.canonical_json_hexhash(commit)
+    recorded = []
+    monkeypatch.setattr(dvs.server, 'store_objects', lambda auth, objects, texts=None: None)
+    monkeypatch.setattr(dvs.server, 'link_and_check', lambda auth, commits, pending=(): set())
+    monkeypatch.setattr(dvs.server, 'store_remote_fqdn',
+                        lambda auth, hexhash, remote_addr, remote_fqdn: recorded.append((hexhash, remote_addr)))
+    monkeypatch.setattr(dvs.server.reverse_dns, 'resolve', lambda addr, callback=None: callback(addr, addr))
+    bottle.request.bind({'REQUEST_METHOD':'GET', 'REMOTE_ADDR':'192.0.2.7',
+                         'QUERY_STRING':urllib.parse.urlencode({dvs_constants.API_OBJECT_LINES:dvs.dvs_helpers.object_lines(objects)})})
+    bottle.response.bind()
+    dvs.server.store_api(None)
+    assert bottle.response.status_code==200
+    assert recorded==[(chash, '192.0.2.7')]
+
+def test_text_search_paging(dbwriter_auth):
+    """Text searches return the best matches first, and the cursor of the last result continues after it"""
+    if not dbwriter_auth:
+        return
+    word    = 'paging' + str(int(time.time()*1000))
+    objects = dvs.dvs_helpers.objects_dict([{dvs_constants.COMMIT_MESSAGE:' '.join([word]*n) + f' commit {n}'} for n in (1, 2, 3)])
+    dvs.server.store_objects(dbwriter_auth, objects)
+    rows   = []
+    cursor = None
+    while True:
+        search = {dvs_constants.TEXT:word, dvs_constants.LIMIT:1}
+        if cursor:
+            search[dvs_constants.CURSOR] = cursor
+        page = dvs.server.do_v2search(dbwriter_auth, search=search)
+        if not page:
+            break
+        assert len(page)==1
+        rows.extend(page)
+        cursor = page[-1][dvs_constants.CURSOR]
+    assert sorted(row[dvs_constants.HEXHASH] for row in rows)==sorted(objects)
+    scores = [row[dvs_constants.SCORE] for row in rows]
+    assert scores==sorted(scores, reverse=True)
+    assert rows[0][dvs_constants.OBJECT][dvs_constants.COMMIT_MESSAGE].endswith('commit 3')
+
+@pytest.mark.parametrize("search", [{dvs_constants.TEXT:'x', dvs_constants.LIMIT:None},
+                                    {dvs_constants.TEXT:'x', dvs_constants.LIMIT:[1]},
+                                    {dvs_constants.TEXT:'x', dvs_constants.LIMIT:0},
+                                    {dvs_constants.TEXT:'x', dvs_constants.CURSOR:{}},
+                                    {dvs_constants.TEXT:'x', dvs_constants.CURSOR:'not a cursor'}])
+def test_search_bad_request(search):
+    """Text searches with a bad limit or cursor are rejected before the database is used"""
+    import json
+    import bottle
+    bottle.request.bind({'REQUEST_METHOD':'GET', 'QUERY_STRING':urllib.parse.urlencode({'searches':json.dumps([search])})})
+    bottle.response.bind()
+    dvs.server.search_api(None)
+    assert bottle.response.status_code==400
+
+@pytest.mark.parametrize("api,dump", [('dump_api', {dvs_constants.OFFSET:10, dvs_constants.KIND:'commit'}),
+                                      ('dump_api', {dvs_constants.LIMIT:[1]}),
+                                      ('dump_api', {dvs_constants.OFFSET:None}),
+                                      ('dump_v2_api', {dvs_constants.CURSOR:{}})])
+def test_dump_bad_request(api, dump):
+    """Dumps that the server cannot do are rejected before the database is used"""
+    import json
+    import bottle
+    bottle.request.bind({'REQUEST_METHOD':'GET', 'QUERY_STRING':urllib.parse.urlencode({'dump':json.dumps(dump)})})
+    bottle.response.bind()
+    getattr(dvs.server, api)(None)
+    assert bottle.response.status_code==400
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import hashlib
+"""
+Test packed writes to the object cache.
+"""
+
+from os.path import dirname,abspath
+sys.path.append( dirname(dirname(abspath(__file__))))
+from dvs.dvs_spool import PackWriter,pack_index,PACK_SUFFIX,INDEX_SUFFIX
+from dvs.dvs_helpers import canonical_json,object_cache_key_time
+
+
+def commit_bytes(i):
+    return canonical_json({'objects':canonical_json({}), 'commit':canonical_json({'message':f'commit {i}'})}).encode('utf-8')
+
+def read_packs(location):
+    """Return {hexhash:bytes} for every blob in the packs in location"""
+    blobs = {}
+    for (dirpath, dirnames, filenames) in os.walk(location):
+        for name in filenames:
+            if name.endswith(INDEX_SUFFIX):
+                with open(os.path.join(dirpath, name)) as f:
+                    index = json.load(f)
+                with open(os.path.join(dirpath, name[0:-len(INDEX_SUFFIX)] + PACK_SUFFIX), 'rb') as f:
+                    pack = f.read()
+                for (hexhash, (offset, length)) in index['blobs'].items():
+                    blobs[hexhash] = pack[offset:offset+length]
+    return blobs
+
+def test_pack_index():
+    text  = "ab {\"x\":\"é\"}\ncd [1]\n"
+    index = pack_index(text)
+    data  = text.encode('utf-8')
+    assert data[index['ab'][0]:index['ab'][0]+index['ab'][1]] == '{"x":"é"}'.encode('utf-8')
+    assert data[index['cd'][0]:index['cd'][0]+index['cd'][1]] == b'[1]'
+
+def test_pack_writer(tmp_path):
+    location = str(tmp_path / 'cache')
+    writer   = PackWriter(location, spool_dir=str(tmp_path / 'spool'), pack_bytes=1000)
+    hexhashes = [writer.add(commit_bytes(i)) for i in range(20)]
+    writer.flush()
+    blobs = read_packs(location)
+    assert sorted(blobs) == sorted(hexhashes)
+    for (hexhash, body) in blobs.items():
+        assert hashlib.sha1(body).hexdigest() == hexhash
+    # The spool was uploaded in more than one pack
+    assert len([name for (d, ds, names) in os.walk(location) for name in names if name.endswith(PACK_SUFFIX)]) > 1
+    assert os.listdir(writer.spool_dir) == []
+
+def test_recover(tmp_path):
+    location = str(tmp_path / 'cache')
+    spool    = tmp_path / 'spool'
+    writer   = PackWriter(location, spool_dir=str(spool))
+    # A spool left by a process that is not running, killed while writing its second commit
+    body     = commit_bytes(1)
+    hexhash  = hashlib.sha1(body).hexdigest()
+    with open(os.path.join(writer.spool_dir, '999999999-1.spool'), 'wb') as f:
+        f.write(hexhash.encode('ascii') + b' ' + body + b'\n' + b'0123 {"obj')
+    PackWriter(location, spool_dir=str(spool))
+    assert read_packs(location) == {hexhash:body}
+
+def test_recovered_pack_time(tmp_path):
+    """A spool that is recovered long after it was written is named by the time it is uploaded"""
+    location = str(tmp_path / 'cache')
+    spool    = tmp_path / 'spool'
+    writer   = PackWriter(location, spool_dir=str(spool))
+    body     = commit_bytes(2)
+    path     = os.path.join(writer.spool_dir, '999999999-1.spool')
+    with open(path, 'wb') as f:
+        f.write(hashlib.sha1(body).hexdigest().encode('ascii') + b' ' + body + b'\n')
+    os.utime(path, (0, 0))
+    t0 = time.time()
+    PackWriter(location, spool_dir=str(spool))
+    names = [os.path.relpath(os.path.join(d, name), location) for (d, ds, names) in os.walk(location) for name in names]
+    assert len(names)==2
+    assert all(object_cache_key_time(name) >= int(t0) - 1 for name in names)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import os
+import sys
+import pytest
+"""
+Test verifying files against their recorded observations.
+"""
+
+from os.path import dirname,abspath
+sys.path.append( dirname(dirname(abspath(__file__))))
+import dvs
+from dvs.dvs_constants import *
+from dvs.dvs_verify import *
+
+
+def statuses(results):
+    return {os.path.basename(path):status for (path, status, reason) in results}
+
+def test_verify(recorded_tree, tmp_path):
+    (dc, hexhash, paths) = (recorded_tree.dc, recorded_tree.hexhash, recorded_tree.paths)
+    # b has the same size and contents but a new mtime, c has new contents of the same size
+    recorded_tree.touch(paths[1])
+    recorded_tree.rewrite(paths[2], "CONTENTS of c\n")
+    os.unlink(paths[3])
+    extra = str(tmp_path / 'extra')
+    with open(extra, 'w') as f:
+        f.write("not recorded\n")
+
+    recorded = recorded_for_commit(dc, hexhash)
+    assert sorted(recorded)==sorted(paths)
+    (results, stats) = verify(recorded, threads=2)
+    assert statuses(results)=={'a':VERIFY_OK, 'b':VERIFY_OK, 'c':VERIFY_CHANGED, 'd':VERIFY_MISSING}
+    # Only the files whose mtime changed were hashed
+    assert stats['hashed']==2
+    assert stats[VERIFY_OK]==2 and stats[VERIFY_CHANGED]==1 and stats[VERIFY_MISSING]==1
+
+    (results, stats) = verify(recorded_for_paths(dc, paths[0:3] + [extra]), paths=paths[0:3] + [extra], full=True)
+    assert statuses(results)=={'a':VERIFY_OK, 'b':VERIFY_OK, 'c':VERIFY_CHANGED, 'extra':VERIFY_UNKNOWN}
+    assert stats['hashed']==3
+
+def test_same_filename(tmp_path):
+    """A path is found when more files with its name are recorded, in other directories, than a search returns"""
+    paths = []
+    for i in range(120):
+        (tmp_path / f'd{i}').mkdir()
+        path = tmp_path / f'd{i}' / 'same'
+        path.write_text(f"file in d{i}\n")
+        paths.append(str(path))
+    dc = dvs.DVS(local_store=str(tmp_path / 'store'))
+    dc.add_local_paths(COMMIT_BEFORE, paths)
+    dc.commit()
+    recorded = recorded_for_paths(dc, [paths[-1]])
+    assert list(recorded)==[paths[-1]]
+
+def test_like_characters(tmp_path):
+    """A path with LIKE wildcards in its name only matches itself, so that it is not crowded out by newer paths"""
+    (tmp_path / 'd%').mkdir()
+    path = tmp_path / 'd%' / 'same_'
+    path.write_text("the file\n")
+    dc = dvs.DVS(local_store=str(tmp_path / 'store'))
+    dc.add_local_paths(COMMIT_BEFORE, [str(path)])
+    dc.commit()
+    others = []
+    for i in range(120):
+        (tmp_path / f'd{i}').mkdir()
+        other = tmp_path / f'd{i}' / 'samex'
+        other.write_text(f"file in d{i}\n")
+        others.append(str(other))
+    dc = dvs.DVS(local_store=str(tmp_path / 'store'))
+    dc.add_local_paths(COMMIT_BEFORE, others)
+    dc.commit()
+    assert list(recorded_for_paths(dc, [str(path)]))==[str(path)]
+
+def test_unreadable(recorded_tree, monkeypatch):
+    """A file that cannot be read is reported, and the other files are still checked"""
+    paths    = recorded_tree.paths
+    recorded = recorded_for_commit(recorded_tree.dc, recorded_tree.hexhash)
+    def hash_file(path):
+        if path==paths[1]:
+            raise PermissionError(13, "Permission denied")
+        return dvs.dvs_helpers.hash_file(path)
+    monkeypatch.setattr(dvs.dvs_verify, 'hash_file', hash_file)
+    (results, stats) = verify(recorded, full=True)
+    assert statuses(results)=={'a':VERIFY_OK, 'b':VERIFY_ERROR, 'c':VERIFY_OK, 'd':VERIFY_OK}
+    assert [reason for (path, status, reason) in results if status==VERIFY_ERROR]==["Permission denied"]
+    assert stats[VERIFY_ERROR]==1
+
+def test_legacy_empty_digests(tmp_path):
+    """Observations recorded before the hashing fix have empty-input SHA256 and SHA512 digests, which are ignored"""
+    import hashlib
+    path = tmp_path / 'hello'
+    path.write_bytes(b"hello")
+    obj  = {FILE_HASHES:{SHA1:hashlib.sha1(b"hello").hexdigest(), MD5:hashlib.md5(b"hello").hexdigest(),
+                         SHA256:hashlib.sha256(b"").hexdigest(), SHA512:hashlib.sha512(b"").hexdigest()},
+            FILE_METADATA:{ST_SIZE:5}}
+    assert hash_check(str(path), obj)==(VERIFY_OK, "hash", 5)
+    path.write_bytes(b"HELLO")
+    assert hash_check(str(path), obj)[0]==VERIFY_CHANGED
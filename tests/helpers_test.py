@@ -39,6 +39,14 @@ def test_is_hexadecimal():
     assert is_hexadecimal("12345abcd")==True
     assert is_hexadecimal("Z12345abcd")==False
 
+def test_hex_prefix_range():
+    assert hex_prefix_range("ab", 2)==(b"\xab\x00", b"\xab\xff")
+    assert hex_prefix_range("ABC", 2)==(b"\xab\xc0", b"\xab\xcf")
+    assert hex_prefix_range("abcd", 2)==(b"\xab\xcd", b"\xab\xcd")
+    assert hex_prefix_range("abcde", 2) is None
+    assert hex_prefix_range("xyz", 2) is None
+    assert bin_to_hexhash(hexhash_to_bin("00ff"))=="00ff"
+
 def test_get_file_observation_with_hash():
     #warnings.filterwarnings("ignore", module="bottle")
     assert os.path.exists(DVS_DEMO_PATH)
@@ -53,3 +61,49 @@ def check_length_is_unique_prefix():
     assert check_length_is_unique_prefix(['aaa','bbb','abc'],2)==True
     assert length_of_unique_prefix(['aaa','bbb','abc'])==2
     assert length_of_unique_prefix(['aaa','bbb','abc','abcd'])==4
+
+def test_check_objects():
+    obj  = {'a':1, 'b':'two'}
+    key  = canonical_json_hexhash(obj)
+    bad  = 'f'*40
+    errors = [error for (k,o,text,error) in
+              check_objects([(key,obj), (bad,obj), ('nothex',obj), (bad,'nocolon'), (bad,3)])]
+    assert errors==[None, f"computed hash is {key}", "key is not a hexhash",
+                    "value is not a URL", "value is not a dict or a string"]
+    # Keys must be a whole SHA1, so an odd length or a short key is rejected before it reaches the database
+    for short in (key[0:39], key[0:38], key+'0'):
+        assert check_object(short, 's3://bucket/key')[2]=="key is not a hexhash"
+    assert check_object(key, obj)==(obj, canonical_json(obj), None)
+    assert check_object(bad, 's3://bucket/key')==('s3://bucket/key','s3://bucket/key',None)
+
+def test_object_lines():
+    obj   = {'b':2, 'a':1}
+    key   = canonical_json_hexhash(obj)
+    items = parse_object_lines(object_lines({key:obj}))
+    assert items==[(key, canonical_json(obj))]
+    assert check_objects(items, exact=True)==[(key, obj, canonical_json(obj), None)]
+    # The exact bytes are hashed, so a non-canonical encoding of the same object does not match its key
+    assert check_object(key, '{"b": 2, "a": 1}', exact=True)[2] is not None
+    assert check_object(key, '{"b": 2', exact=True)[2]=="value is not valid JSON"
+    try:
+        parse_object_lines(key+"\n")
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+def test_object_cache_key():
+    hexhash = hexhash_string("hello")
+    key = object_cache_key(hexhash, 86400*365 + 3723)
+    assert key == "1971-01-01/010203-" + hexhash
+    assert object_cache_hexhash(key) == hexhash
+    assert object_cache_hexhash("prefix/" + key) == hexhash
+    assert object_cache_hexhash(hexhash) == hexhash
+    assert object_cache_key_time(key) == 86400*365 + 3723
+    assert object_cache_key_time(hexhash) is None
+
+def test_read_manifest():
+    import io
+    assert list(read_manifest(io.BytesIO(b"a\nb c\r\n\nd"))) == ["a", "b c", "d"]
+    assert list(read_manifest(io.BytesIO(b"a\0b\nc\0"), chunk_size=2)) == ["a", "b\nc"]
+    assert list(read_manifest(io.BytesIO(b""))) == []
+    assert list(read_manifest(io.BytesIO(b"caf\xe9\0"))) == [os.fsdecode(b"caf\xe9")]
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import subprocess
+"""
+Guard the time that it takes to import dvs. The dvsc command is run thousands of times from shell
+pipelines, so modules that are only needed for S3 or by the server must not be imported by "import dvs".
+"""
+
+from os.path import dirname,abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+# Modules that must only be imported when they are used
+LAZY_MODULES = ['boto3', 'botocore', 'multiprocessing', 'subprocess', 'dvs.server', 'ctools', 'pymysql', 'zstandard']
+MAX_IMPORT_SECONDS = 2.0
+
+def test_import_dvs():
+    code = ("import sys, time, json\n"
+            "t0 = time.time()\n"
+            "import dvs\n"
+            "t1 = time.time()\n"
+            f"print(json.dumps({{'seconds':t1-t0, 'loaded':[m for m in {LAZY_MODULES!r} if m in sys.modules]}}))\n")
+    env = {**os.environ, 'PYTHONPATH':ROOT + os.pathsep + os.environ.get('PYTHONPATH','')}
+    out = json.loads(subprocess.check_output([sys.executable, '-c', code], cwd=ROOT, env=env))
+    assert out['loaded'] == []
+    assert out['seconds'] < MAX_IMPORT_SECONDS
+
+def test_lazy_submodule():
+    import dvs
+    assert dvs.server.MAX_SEARCH_OBJECTS == dvs.dvs_constants.MAX_SEARCH_OBJECTS